@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+
+import numpy
+from numpy.lib import format as npyFormat
+
+# Content addressed, on disk cache of analysis artifacts such as decoded waveforms and spectrograms.
+# Artifacts are stored as .npy files keyed by a hash of the source file's contents plus the parameters they were
+# computed with, so tweaking a heuristic further down the pipeline reuses them instead of recomputing them.
+# Artifacts are loaded memory mapped. Once the cache grows past maxBytes, the least recently used ones are evicted.
+class ArtifactCache:
+	# Bump when the way artifacts are computed changes, so stale artifacts are no longer matched.
+	VERSION = 2
+
+	def __init__(self, directory="cache", maxBytes=4 * 1024 ** 3):
+		self.directory = directory
+		self.maxBytes = maxBytes
+		self.fileHashes = {}	# (path, size, mtime) -> content hash, so a file is only hashed once per run
+		os.makedirs(self.directory, exist_ok=True)
+
+	# Hash of the file contents. The file is read in blocks so it is never held in memory as a whole.
+	def getFileHash(self, fileName):
+		stat = os.stat(fileName)
+		statKey = (os.path.abspath(fileName), stat.st_size, stat.st_mtime)
+		if statKey not in self.fileHashes:
+			fileHash = hashlib.sha1()
+			with open(fileName, 'rb') as f:
+				for block in iter(lambda: f.read(1024 * 1024), b''):
+					fileHash.update(block)
+			self.fileHashes[statKey] = fileHash.hexdigest()
+		return self.fileHashes[statKey]
+
+	def getKey(self, fileHash, name, **params):
+		params["version"] = ArtifactCache.VERSION
+		paramHash = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+		return "%s_%s_%s" % (fileHash, name, paramHash[:16])
+
+	def getPath(self, key):
+		return os.path.join(self.directory, key + ".npy")
+
+	# Returns the cached artifacts of a single source file.
+	def getArtifacts(self, fileName):
+		return FileArtifacts(self, self.getFileHash(fileName))
+
+	# Returns the artifact as a read only memory mapped array, or None if it is not cached.
+	def load(self, key):
+		path = self.getPath(key)
+		if not os.path.exists(path):
+			return None
+		os.utime(path)	# The modification time doubles as the last use time for eviction
+		return numpy.load(path, mmap_mode='r')
+
+	def store(self, key, array):
+		writer = self.openWriter(key, numpy.shape(array), numpy.asarray(array).dtype)
+		writer.array[...] = array
+		writer.close()
+
+	# Opens a writer for an artifact that is filled in incrementally, eg. as rows are generated.
+	# The artifact only becomes visible once the writer is closed; discarded writers leave nothing behind.
+	def openWriter(self, key, shape, dtype):
+		return ArtifactWriter(self, key, shape, dtype)
+
+	# Removes the least recently used artifacts until the cache fits in maxBytes.
+	def evict(self):
+		entries = []
+		for fileName in os.listdir(self.directory):
+			if fileName.endswith(".npy"):
+				stat = os.stat(os.path.join(self.directory, fileName))
+				entries.append((stat.st_mtime, stat.st_size, fileName))
+		entries.sort()
+		totalBytes = sum([e[1] for e in entries])
+		for mtime, size, fileName in entries:
+			if totalBytes <= self.maxBytes:
+				break
+			os.remove(os.path.join(self.directory, fileName))
+			totalBytes -= size
+
+	# Removes cached artifacts. Without a fileName, everything is removed. With a fileName, only that file's
+	# artifacts are removed, optionally only the ones called name.
+	def invalidate(self, fileName=None, name=None):
+		prefix = ""
+		if fileName is not None:
+			prefix = self.getFileHash(fileName) + "_"
+			if name is not None:
+				prefix += name + "_"
+		for cachedFileName in os.listdir(self.directory):
+			if cachedFileName.startswith(prefix) and cachedFileName.endswith(".npy"):
+				os.remove(os.path.join(self.directory, cachedFileName))
+
+
+# Writes an artifact into a temporary memory mapped .npy file and moves it into place when closed.
+class ArtifactWriter:
+	def __init__(self, cache, key, shape, dtype):
+		self.cache = cache
+		self.key = key
+		self.temporaryPath = cache.getPath(key) + ".tmp"
+		self.array = npyFormat.open_memmap(self.temporaryPath, mode='w+', dtype=dtype, shape=shape)
+
+	def close(self):
+		self.array.flush()
+		del self.array
+		os.replace(self.temporaryPath, self.cache.getPath(self.key))
+		self.cache.evict()
+
+	def discard(self):
+		del self.array
+		os.remove(self.temporaryPath)
+
+
+# Artifacts belonging to one source file. name identifies the kind of artifact and params are the analysis
+# parameters it depends on.
+class FileArtifacts:
+	def __init__(self, cache, fileHash):
+		self.cache = cache
+		self.fileHash = fileHash
+
+	def load(self, name, **params):
+		return self.cache.load(self.cache.getKey(self.fileHash, name, **params))
+
+	def store(self, name, array, **params):
+		self.cache.store(self.cache.getKey(self.fileHash, name, **params), array)
+
+	def openWriter(self, name, shape, dtype, **params):
+		return self.cache.openWriter(self.cache.getKey(self.fileHash, name, **params), shape, dtype)
@@ -0,0 +1,59 @@
+import itertools
+
+import numpy
+
+# Anti-aliased decimation of a waveform, placed between the file reader and the note processors.
+# Most of the spectrum of a 44.1 kHz file lies far above the highest note of interest and its harmonics. Decimating by
+# a factor of 2 halves the samples every FFT runs over and the width of every spectrum row, while the frequency
+# resolution of an FFT covering the same length of time stays the same.
+class Decimator:
+	# Only frequencies up to this fraction of the decimated sample rate are kept, the rest is the filter's transition band.
+	PASSBAND = 0.4
+	# Cutoff of the low pass filter, as a fraction of the decimated sample rate. Nyquist is 0.5.
+	CUTOFF = 0.45
+	# Number of filter taps per unit of decimation factor. Gives a stopband attenuation of about 80 dB.
+	TAPS_PER_FACTOR = 100
+
+	def __init__(self, factor):
+		self.factor = factor
+		self.taps = self.getFilterTaps()
+		self.delay = (len(self.taps) - 1) // 2	# Group delay of the filter, in input samples
+
+	# Largest power of 2 the sample rate can be divided by while still keeping maxFrequency.
+	# Powers of 2 keep the note processors' interval sizes whole numbers.
+	@staticmethod
+	def getFactor(sampleRate, maxFrequency):
+		factor = 1
+		while maxFrequency <= Decimator.PASSBAND * sampleRate / (factor * 2):
+			factor *= 2
+		return factor
+
+	# Windowed sinc low pass filter with unity gain at 0 Hz.
+	def getFilterTaps(self):
+		tapCount = Decimator.TAPS_PER_FACTOR * self.factor + 1
+		cutoff = Decimator.CUTOFF / self.factor	# In cycles per input sample
+		n = numpy.arange(tapCount) - (tapCount - 1) / 2
+		taps = numpy.sinc(2 * cutoff * n) * numpy.kaiser(tapCount, 8)
+		return taps / taps.sum()
+
+	# Decimates an indexable waveform (an ndarray or a MappedWaveform) into an ndarray, reading it block by block.
+	def decimate(self, waveform, samplesPerBlock=65536):
+		blocks = (waveform[i: i + samplesPerBlock] for i in range(0, len(waveform), samplesPerBlock))
+		return numpy.concatenate([numpy.zeros(0)] + list(self.decimateBlocks(blocks)))
+
+	# Decimates an iterable of sample blocks, yielding decimated blocks.
+	# Output sample j is centered on input sample j * factor, the filter's delay is compensated for.
+	def decimateBlocks(self, blocks):
+		history = numpy.zeros(len(self.taps) - 1)
+		skip = self.delay	# Filtered samples to drop before the next kept one
+		# Trailing zeros flush the samples held back by the filter's delay.
+		for block in itertools.chain(blocks, [numpy.zeros(self.delay)]):
+			if len(block) == 0:
+				continue
+			extended = numpy.concatenate((history, block))
+			history = extended[len(extended) - len(history):]
+			filtered = numpy.convolve(extended, self.taps, mode='valid')
+			decimated = filtered[skip::self.factor]
+			skip = (skip - len(filtered)) % self.factor if skip < len(filtered) else skip - len(filtered)
+			if len(decimated):
+				yield decimated
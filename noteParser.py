@@ -39,3 +39,12 @@ class NoteParser:
 			NoteParser.instance = NoteParser.__NoteParser()
 		return NoteParser.instance
 
+
+# A fixed list of notes with the NoteParser interface. Unlike the NoteParser singleton, it can be handed to other
+# processes.
+class NoteList:
+	def __init__(self, notes):
+		self.notes = notes
+
+	def parseNotes(self):
+		return self.notes
@@ -2,12 +2,44 @@ from noteParser import NoteParser
 import utils
 
 class AbstractNoteProcessor:
-	def __init__(self, waveform, sampleRate, noteParser=None):
+	# Set by processors that accept an iterator of sample blocks as their waveform.
+	supportsStreaming = False
+	# Set by processors that can transcribe a file in time segments, see SimpleMidiConverter. They implement
+	# generateNotes(), which yields notes without normalised loudness, and normaliseNotes(), which normalises the
+	# notes of all segments together.
+	supportsSegments = False
+	# Segments start at multiples of this many samples.
+	segmentAlignment = 1
+	# Samples each segment is extended by on both sides. Within the overlap, the processor settles into the state it
+	# would be in on the whole waveform, and sees the notes starting in the segment to their end.
+	segmentOverlap = 0
+	# Highest harmonic of a note the processor reads. None if it reads harmonics up to the top of the spectrum.
+	maxHarmonic = None
+
+	# artifacts is an optional FileArtifacts of the file the waveform was read from, used to cache spectrograms.
+	# decimationFactor is how many times the waveform was decimated from the file's sample rate. sampleRate is already
+	# the decimated rate.
+	def __init__(self, waveform, sampleRate, noteParser=None, artifacts=None, decimationFactor=1):
 		self.waveform = waveform
+		self.artifacts = artifacts
+		self.decimationFactor = decimationFactor
 		self.sampleRate = sampleRate
 		self.noteParser = noteParser or NoteParser()
 		self.noteList = self.noteParser.parseNotes()	# Parse list of all notes and their frequencies
 
+	# Arguments the processors of the segments of the waveform take, so they transcribe them like the whole waveform.
+	# See SimpleMidiConverter.getSegmentedNotes.
+	def getSegmentArgs(self):
+		return {}
+
+	# Highest frequency the processor reads off the spectrum when constructed with processorArgs, or None if it reads
+	# the whole spectrum. Decimation keeps the frequencies up to it, see SimpleMidiConverter.
+	@classmethod
+	def getHighestFrequency(cls, noteList, **processorArgs):
+		if cls.maxHarmonic is None:
+			return None
+		return max([n.frequency for n in noteList]) * cls.maxHarmonic
+
 	def getClosestNote(self, frequency):
 		closestNote = None
 		diffPercent = None
@@ -1,29 +1,166 @@
 
-from collections import deque
+import numpy
 import utils
 
 from activeNote import ActiveNote
 from noteProcessors.continuousNoteProcessor.columnProcessor import ColumnProcessor
+from noteProcessors.continuousNoteProcessor.columnProcessorGroup import ColumnProcessorGroup
 from noteProcessors.continuousNoteProcessor.constants import Constants
 from noteProcessors.continuousNoteProcessor.message import MessageType
+from noteProcessors.continuousNoteProcessor import propagation
+from noteProcessors.continuousNoteProcessor.ringBuffer import RingBuffer
+from noteProcessors.continuousNoteProcessor.tuning import TuningCurve
 
+# All column processors step through the rows of one buffer in one process. Within a row, the propagation, comb filling
+# and interpolation of each processor change columns that the harmonic windows of other processors read, so processors
+# split over processes would have to exchange every write on every row to find the same notes.
 class ColumnManager:
+	RESUM_ROWS = Constants.MAX_BUFFER_SIZE	# Columns are summed again from 0 at least this often
 
-	def __init__(self, outOfTune, noteParser, sampleRate, samplesPerFrame, samplesPerInterval, maxHarmonic=6):
-		self.globalIndex = 0 	# Index relative to start of global sample
+	# noteRange optionally limits the notes looked for to (lowestFrequency, highestFrequency).
+	# With sparse, rows only hold the frequency bins the column processors read, listed in columnBins. Rows are
+	# produced by a SparseGenerator over the same bins.
+	# dtype is the type rows are buffered as. float32 halves the buffer's memory at the cost of precision.
+	# outOfTune is how offtune the whole song is, or a TuningCurve the idle column processors are retuned to section by
+	# section, see retune. The rows of the curve are counted from the first row.
+	# firstRow is the index of the first row in the whole song, when the rows are of a segment of it.
+	def __init__(self, outOfTune, noteParser, sampleRate, samplesPerFrame, samplesPerInterval, maxHarmonic=6, noteRange=None, sparse=False,
+			dtype=numpy.float64, firstRow=0):
+		self.globalIndex = firstRow 	# Index relative to start of global sample
+		self.firstRow = firstRow
+		self.tuningCurve = None
+		if isinstance(outOfTune, TuningCurve):
+			assert not sparse, "Sparse rows only hold the bins of the initial tuning"
+			self.tuningCurve = outOfTune
+			outOfTune = self.tuningCurve.getOutOfTune(0)
 		self.outOfTune = outOfTune
 		self.sampleRate = sampleRate
+		self.samplesPerFrame = samplesPerFrame
 		self.samplesPerInterval = samplesPerInterval
+		self.frequencyBinCount = int(samplesPerFrame / 2)	# Width of a full spectrum row
 		self.columnProcessors = []
 		self.activeNotes = []
-		self.data = deque([], Constants.MAX_BUFFER_SIZE)
-		self.data.extend([[0 for i in range(int(samplesPerFrame / 2))] for i in range(Constants.MAX_BUFFER_SIZE)])
 		for note in noteParser.parseNotes():
+			if noteRange is not None and (note.frequency < noteRange[0] or note.frequency > noteRange[1]):
+				continue
+			# A decimated waveform's rows end below the highest notes, which then have no columns to process.
+			if note.frequency * outOfTune * samplesPerFrame / sampleRate + Constants.COLUMN_PROCESSOR_DATA_WIDTH >= samplesPerFrame / 2:
+				continue
 			self.columnProcessors.append(
 				ColumnProcessor(note, sampleRate, samplesPerFrame, note.frequency * outOfTune, maxHarmonic,  self)
 			)
+
+		self.columnBins = None
+		self.binColumns = None
+		columnCount = self.frequencyBinCount
+		# The running maximum is taken over the bins the column processors read, which are all a sparse row holds
+		self.readColumns = self.getRequiredBins()
+		if sparse:
+			self.columnBins = self.readColumns.tolist()
+			self.readColumns = None
+			self.binColumns = dict([(b, column) for column, b in enumerate(self.columnBins)])
+			columnCount = len(self.columnBins)
+			for columnProcessor in self.columnProcessors:
+				columnProcessor.useSparseColumns()
+
+		# Rows are buffered oldest first. Column processors index the buffer's rows relative to its oldest row.
+		self.buffer = RingBuffer(Constants.MAX_BUFFER_SIZE, columnCount, dtype)
+		# Running sums of the buffer's columns, by the number of the row they run up to (see RingBuffer.appendedRows):
+		# columnSums[n % sumSlots][c] is the sum of column c over the rows before row n, since the column was last
+		# summed from 0. The sum of a column over consecutive rows is the difference of two running sums. The running
+		# sums of the buffered rows take sumSlots slots, written in a circle like the buffer, so the running sums up to
+		# the oldest row stay in place as rows are appended.
+		# Columns are summed lazily when they are read, from their last running sum up to the newest row. summedRows[c]
+		# is the number of the row column c has running sums up to. Changing the values of the column from a row on moves
+		# it back to that row, see invalidateColumns. A column with no running sum up to the oldest row is summed from 0.
+		# Each row, a slice of the columns is made to be summed from 0, so every column is summed from 0 at least every
+		# RESUM_ROWS rows and the running sums do not grow without bound. Slices follow the rows of the whole song, so
+		# the sums of a segment of the song round off like those of the whole song once its columns were summed from 0.
+		self.sumSlots = Constants.MAX_BUFFER_SIZE + 1
+		self.columnSums = numpy.zeros((self.sumSlots, columnCount))
+		self.summedRows = numpy.zeros(columnCount, dtype=numpy.int64)
+		self.bandColumns = numpy.zeros(columnCount, dtype=bool)	# Columns in the band of a processor
+		for columnProcessor in self.columnProcessors:
+			self.bandColumns[columnProcessor.firstIndex: columnProcessor.lastIndex + 1] = True
+		self.columnProcessorGroup = ColumnProcessorGroup(self.columnProcessors, self)
 		self.runningMaximum = 0
 
+	# Frequency bins the column processors read, in order
+	def getRequiredBins(self):
+		bins = set()
+		for columnProcessor in self.columnProcessors:
+			bins.update(columnProcessor.getRequiredBins())
+		return numpy.array(sorted(bins), dtype=numpy.int64)
+
+	# Index of the column holding a frequency bin, and back.
+	def getColumn(self, frequencyBin):
+		if self.binColumns is None:
+			return frequencyBin
+		return self.binColumns[frequencyBin]
+
+	def getBin(self, column):
+		if self.columnBins is None:
+			return column
+		return self.columnBins[column]
+
+	# Has to be called after changing values of columns in the buffer, from row firstRow on. Columns are distinct, firstRow
+	# may also be one row per column.
+	def invalidateColumns(self, columns, firstRow=0):
+		firstRow = self.buffer.appendedRows - Constants.MAX_BUFFER_SIZE + firstRow
+		self.summedRows[columns] = numpy.minimum(self.summedRows[columns], firstRow)
+
+	# Makes the slice of columns of the newest row to be summed from 0
+	def restartColumnSums(self):
+		sliceWidth = -(-len(self.summedRows) // ColumnManager.RESUM_ROWS)
+		firstColumn = self.globalIndex % ColumnManager.RESUM_ROWS * sliceWidth
+		self.summedRows[firstColumn: firstColumn + sliceWidth] = self.buffer.appendedRows - Constants.MAX_BUFFER_SIZE - 1
+
+	# Slices of columnSums holding the running sums up to rows firstRow..lastRow - 1, by number. There are at most two.
+	def getSumSlices(self, firstRow, lastRow):
+		first = firstRow % self.sumSlots
+		last = first + lastRow - firstRow
+		if last <= self.sumSlots:
+			return [slice(first, last)]
+		return [slice(first, self.sumSlots), slice(0, last - self.sumSlots)]
+
+	# Brings the running sums of columns firstColumn..lastColumn - 1 up to the newest row.
+	def sumColumns(self, firstColumn, lastColumn):
+		summedRows = self.summedRows[firstColumn: lastColumn]
+		appendedRows = self.buffer.appendedRows
+		firstRow = summedRows.min()
+		if firstRow == appendedRows:
+			return
+		oldestRow = appendedRows - Constants.MAX_BUFFER_SIZE
+		if firstRow < oldestRow:
+			self.columnSums[oldestRow % self.sumSlots, numpy.flatnonzero(summedRows < oldestRow) + firstColumn] = 0
+			firstRow = oldestRow
+		sums = numpy.cumsum(self.buffer.getColumns(firstColumn, lastColumn, firstRow - oldestRow), axis=0)
+		sums += self.columnSums[firstRow % self.sumSlots, firstColumn: lastColumn]
+		for rows in self.getSumSlices(firstRow + 1, appendedRows + 1):
+			self.columnSums[rows, firstColumn: lastColumn] = sums[:rows.stop - rows.start]
+			sums = sums[rows.stop - rows.start:]
+		summedRows[:] = appendedRows
+
+	# Sum of the values in rows firstRow..lastRow - 1 and columns firstColumn..lastColumn - 1 of the buffer.
+	def getRectangleSum(self, firstRow, lastRow, firstColumn, lastColumn):
+		self.sumColumns(firstColumn, lastColumn)
+		oldestRow = self.buffer.appendedRows - Constants.MAX_BUFFER_SIZE
+		return (self.columnSums[(oldestRow + lastRow) % self.sumSlots, firstColumn: lastColumn] -
+			self.columnSums[(oldestRow + firstRow) % self.sumSlots, firstColumn: lastColumn]).sum()
+
+	# Sums of the rows firstRow..lastRow - 1 over columns firstColumn..lastColumn - 1 of the buffer, one per row.
+	def getRowSums(self, firstRow, lastRow, firstColumn, lastColumn):
+		self.sumColumns(firstColumn, lastColumn)
+		oldestRow = self.buffer.appendedRows - Constants.MAX_BUFFER_SIZE
+		columnSums = numpy.concatenate([self.columnSums[rows, firstColumn: lastColumn] for rows in self.getSumSlices(oldestRow + firstRow, oldestRow + lastRow + 1)])
+		return (columnSums[1:] - columnSums[:-1]).sum(axis=1)
+
+	# Maximum of the bins of a row that the column processors read
+	def getRowMaximum(self, row):
+		if self.readColumns is None or len(self.readColumns) == 0:
+			return row.max()
+		return row[self.readColumns].max()
+
 	# Approximate value for maximum, used for filtering out low-valued data
 	def updateRunningMaximum(self, maximum):
 		diff = utils.percentDiff(maximum, self.runningMaximum)
@@ -32,12 +169,34 @@ class ColumnManager:
 			existingWeight = 4 / diff
 		self.runningMaximum = self.runningMaximum * existingWeight / 5 + maximum * (5 - existingWeight) / 5
 
+	# Retunes the idle column processors to the tuning of the section of the row being processed. Processors in a note
+	# keep their columns until the note ends.
+	# Columns that enter a band were not kept propagated, so they are propagated in full.
+	def retune(self):
+		processingRow = self.globalIndex - self.firstRow - (Constants.MAX_BUFFER_SIZE - 1 - int(Constants.MAX_BUFFER_SIZE / 2))
+		outOfTune = self.tuningCurve.getOutOfTune(processingRow)
+		if outOfTune == self.outOfTune:
+			return
+		self.outOfTune = outOfTune
+		retunedColumns = self.columnProcessorGroup.retune(outOfTune)
+		newColumns = numpy.unique(retunedColumns[~self.bandColumns[retunedColumns]])
+		self.bandColumns[:] = False
+		for firstIndex, lastIndex in zip(self.columnProcessorGroup.firstIndex, self.columnProcessorGroup.lastIndex):
+			self.bandColumns[firstIndex: lastIndex + 1] = True
+		self.readColumns = self.getRequiredBins()
+		if len(newColumns) > 0:
+			rows = self.buffer.getPosition(numpy.arange(Constants.MAX_BUFFER_SIZE))
+			self.invalidateColumns(propagation.propagateUpColumns(self.buffer.array, rows, newColumns)[1])
+
 	def processNewDataRow(self, row):
-		self.data.append(row)
-		self.updateRunningMaximum(max(row))
-		# Each column processor will process the new row and potentially return a note.
-		for i in range(len(self.columnProcessors)):
-			message = self.columnProcessors[i].processNewDataRow()
+		self.buffer.append(row)
+		self.restartColumnSums()
+		self.updateRunningMaximum(self.getRowMaximum(row))
+		if self.tuningCurve is not None:
+			self.tuningCurve.addRow(self.globalIndex - self.firstRow, row)
+			self.retune()
+		# The column processors process the new row together and potentially return notes.
+		for message in self.columnProcessorGroup.processNewDataRow():
 			# If a new note is returned by a processor, we append it to the total list.
 			if message.messageType == MessageType.NEW_NOTE:
 				globalIndexOffset = self.globalIndex - Constants.MAX_BUFFER_SIZE - 1
@@ -56,14 +215,17 @@ class ColumnManager:
 
 
 	def getActiveNotes(self):
+		self.activeNotes = ColumnManager.normaliseActiveNotes(self.activeNotes)
+		return self.activeNotes
+
+	@staticmethod
+	def normaliseActiveNotes(activeNotes):
 		# Normalise loudness of notes
-		loudest = max([a.loudness for a in self.activeNotes])
+		loudest = max([a.loudness for a in activeNotes])
 		if loudest > ActiveNote.MAX_LOUDNESS:
-			for a in self.activeNotes:
+			for a in activeNotes:
 				a.loudness = a.loudness / loudest * ActiveNote.MAX_LOUDNESS
 
 		# loudness filter. Ideally, this is filtered before this step to reduce memory.
 		# However, loudness is a relative amount and makes sense to do this during post-processing.
-		self.activeNotes = [an for an in self.activeNotes if an.loudness > ActiveNote.MAX_LOUDNESS / 8]
-		return self.activeNotes
-
+		return [an for an in activeNotes if an.loudness > ActiveNote.MAX_LOUDNESS / 8]
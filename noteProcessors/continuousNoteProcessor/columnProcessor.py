@@ -1,5 +1,8 @@
+import numpy
+
 from noteProcessors.continuousNoteProcessor.constants import Constants
 from noteProcessors.continuousNoteProcessor.message import Message, MessageType, NewNoteMessage
+from noteProcessors.continuousNoteProcessor import propagation
 import utils
 
 
@@ -8,12 +11,19 @@ import utils
 
 # Having access to the manager's buffer of data, this class operates on the data buffer sort of like an assembly line.
 # At certain buffer indices, data is being processed and prepped for future operations.
+
+# Column indices are indices into the manager's rows. They are the same as frequency bin indices, unless the manager's
+# rows are sparse, in which case the manager maps between the two.
 class ColumnProcessor:
+	# Offtune shifts further than this fraction of the note's frequency discard the note
+	MAX_OFFTUNE = 0.02
+
 	def __init__(self, note, sampleRate, samplesPerFrame, modifiedFrequency, maxHarmonic, manager):
 		self.note = note # Note this processor is associated with
 		self.maxHarmonic = maxHarmonic # Maximum harmonic processor will look for
 
-		self.centerIndex = int(round(modifiedFrequency * samplesPerFrame / sampleRate)) # Index frequency is centered on
+		self.frequencyIndex = int(round(modifiedFrequency * samplesPerFrame / sampleRate)) # Frequency bin the note is centered on
+		self.centerIndex = self.frequencyIndex # Index frequency is centered on
 		self.firstIndex = self.centerIndex - int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)	# First and last frequency index the processor operates on
 		self.lastIndex = self.centerIndex + int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
  
@@ -26,7 +36,45 @@ class ColumnProcessor:
 		self.manager = manager # The manager where data comes from
 		self.previousLoudness = 0 # loudness of the previous note detected using this processor
 		self.processingIndex = 0 # Current row index that is being processed.
-		self.maxFrequencyIndex = len(self.manager.data[0])
+		self.maxFrequencyIndex = self.manager.frequencyBinCount
+		self.minIndex = 0 # Offtune shifts stop at the first and last index the processor may read
+		self.maxIndex = self.maxFrequencyIndex - 1
+
+	# Frequency bins this processor may read: the columns around its note, as far as an offtune shift goes before the
+	# note is discarded, and the harmonic windows of every shift a note is kept at.
+	def getRequiredBins(self):
+		halfWidth = int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
+		maxShift = int(self.frequencyIndex * ColumnProcessor.MAX_OFFTUNE) + 2
+		bins = set(range(self.getFirstShiftBin(), self.getLastShiftBin() + 1))
+		for h in range(2, self.maxHarmonic + 1):
+			bins.update(range((self.frequencyIndex - maxShift) * h - halfWidth, (self.frequencyIndex + maxShift) * h + halfWidth + 1))
+		return set([b for b in bins if b >= 0 and b < self.maxFrequencyIndex])
+
+	# First and last bin read while shifting the note's columns, including the 2 columns read past a discarding shift.
+	def getFirstShiftBin(self):
+		maxShift = int(self.frequencyIndex * ColumnProcessor.MAX_OFFTUNE) + 2
+		return max(0, self.frequencyIndex - maxShift - int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2) - 2)
+
+	def getLastShiftBin(self):
+		maxShift = int(self.frequencyIndex * ColumnProcessor.MAX_OFFTUNE) + 2
+		return min(self.maxFrequencyIndex - 1, self.frequencyIndex + maxShift + int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2) + 2)
+
+	# Moves all indices from frequency bins to the columns of the manager's sparse rows.
+	# The required bins around the note are contiguous, so neighbouring columns stay neighbouring bins.
+	def useSparseColumns(self):
+		self.minIndex = self.manager.getColumn(self.getFirstShiftBin())
+		self.maxIndex = self.manager.getColumn(self.getLastShiftBin())
+		self.centerIndex = self.manager.getColumn(self.frequencyIndex)
+		self.firstIndex = self.centerIndex - int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
+		self.lastIndex = self.centerIndex + int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
+
+	# Centers the processor on another frequency bin, when the song's tuning changes. Only for idle processors, whose
+	# columns are not shifted.
+	def retune(self, frequencyIndex):
+		self.frequencyIndex = frequencyIndex
+		self.centerIndex = frequencyIndex
+		self.firstIndex = self.centerIndex - int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
+		self.lastIndex = self.centerIndex + int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
 
 	# Resets all data relating to the peak value.
 	def resetPeak(self):
@@ -34,11 +82,9 @@ class ColumnProcessor:
 		self.lastIndex -= self.offTuneIndex
 		if self.offTuneIndex != 0:
 			if self.offTuneIndex < 0:
-				for i in range(self.lastIndex + self.offTuneIndex + 1, self.lastIndex + 1):
-					self.propagateUpColumn(i)
+				self.propagateUpColumns(range(self.lastIndex + self.offTuneIndex + 1, self.lastIndex + 1))
 			else:
-				for i in range(self.firstIndex, self.firstIndex + self.offTuneIndex):
-					self.propagateUpColumn(i)
+				self.propagateUpColumns(range(self.firstIndex, self.firstIndex + self.offTuneIndex))
 
 		self.preNoteOffset = 0
 		self.peakIndex = 0
@@ -55,33 +101,25 @@ class ColumnProcessor:
 	# 3. An exhaustive search will then be made to find the start index of the post-note class.
 	# arr is input array
 	# Indices is start index of each class/group
+	# Variances of all candidate classes come from running sums, so the search is linear in the length of arr.
 	def getNaturalBreaks(self, arr):
-		minVariance = -1
-		preNoteIndex = 0
+		sliceVariance = utils.SliceVariance(arr)
 		middleIndex = max(4, int(len(arr) / 2))
-		for i in range(0, 3):
-			var1 = utils.getVariance(arr[0 : i + 1])
-			var2 = utils.getVariance(arr[i + 1: middleIndex])
-			if var2 + var1 < minVariance or minVariance < 0:
-				minVariance = var1 + var2
-				preNoteIndex = i + 1
-
-		minVariance = -1
+		splits = numpy.arange(0, 3)
+		variances = sliceVariance.getVariance(0, splits + 1) + sliceVariance.getVariance(splits + 1, middleIndex)
+		preNoteIndex = int(numpy.argmin(variances)) + 1
+
 		postNoteIndex = 0
-		for i in range(preNoteIndex, len(arr) - 1):
-			var1 = utils.getVariance(arr[preNoteIndex : i + 1])
-			var2 = utils.getVariance(arr[i + 1: len(arr)])
-			if var2 + var1 < minVariance or minVariance < 0:
-				minVariance = var1 + var2
-				postNoteIndex = i + 1
+		splits = numpy.arange(preNoteIndex, len(arr) - 1)
+		if len(splits) > 0:
+			variances = sliceVariance.getVariance(preNoteIndex, splits + 1) + sliceVariance.getVariance(splits + 1, len(arr))
+			postNoteIndex = int(splits[numpy.argmin(variances)]) + 1
 		return preNoteIndex, postNoteIndex
 
 
 	# This is very expensive but is acceptable since it processes on each real note.
 	def getMoreAccurateIndices(self, startIndex, endIndex):
-		sums = []
-		for i in range(startIndex - 1, endIndex + 2):
-			sums.append(sum(self.manager.data[i][self.firstIndex: self.lastIndex + 1]))
+		sums = self.manager.getRowSums(startIndex - 1, endIndex + 2, self.firstIndex, self.lastIndex + 1).tolist()
 		indices = self.getNaturalBreaks(sums)
 		return indices[0] + startIndex - 1, indices[1] + startIndex - 1
 
@@ -97,39 +135,30 @@ class ColumnProcessor:
 
 			# Absolute loudness is the sum of all values in the current rectangle described by startIndex, endIndex,
 			# firstIndex, and lastIndex, divided by the number of rows.
-			absoluteLoudness = sum([
-				sum(
-					[self.manager.data[r][c] for c in range(self.firstIndex, self.lastIndex + 1)]
-				) for r in range(startIndex, endIndex)
-			]) / (endIndex - startIndex)
+			absoluteLoudness = self.manager.getRectangleSum(startIndex, endIndex, self.firstIndex, self.lastIndex + 1) / (endIndex - startIndex)
 
 			# Add in magnitudes from harmonics
-			originalCenter = (self.firstIndex + self.lastIndex) / 2
+			originalCenter = self.manager.getBin(self.firstIndex) + (self.lastIndex - self.firstIndex) / 2
 			for h in range(2, self.maxHarmonic + 1):
 				centerIndex = int(originalCenter * h)
 				if centerIndex >= self.maxFrequencyIndex:
 					break
-				firstIndex = centerIndex - int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
-				lastIndex = centerIndex + int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2)
-				for i in range(firstIndex, lastIndex + 1):
-					self.propagateUpColumn(i)
-				harmonicLoudness = sum([
-					sum(
-						[self.manager.data[r][c] for c in range(firstIndex, lastIndex + 1)]
-					) for r in range(startIndex, endIndex)
-				]) / (endIndex - startIndex)
+				firstIndex = self.manager.getColumn(centerIndex - int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2))
+				lastIndex = firstIndex + int(Constants.COLUMN_PROCESSOR_DATA_WIDTH / 2) * 2
+				self.propagateUpColumns(range(firstIndex, lastIndex + 1))
+				harmonicLoudness = self.manager.getRectangleSum(startIndex, endIndex, firstIndex, lastIndex + 1) / (endIndex - startIndex)
 				absoluteLoudness += harmonicLoudness
 			self.resetPeak()
 			# Update the preciousLoudness if this loudness is greater or similar in value
 			if absoluteLoudness > self.previousLoudness or utils.percentDiff(absoluteLoudness, self.previousLoudness) < 0.3:
 				self.previousLoudness = absoluteLoudness
-			return NewNoteMessage(startIndex, endIndex, self.note, absoluteLoudness, self.centerIndex + self.offTuneIndex)
+			return NewNoteMessage(startIndex, endIndex, self.note, absoluteLoudness, self.frequencyIndex + self.offTuneIndex)
 
 	# Sum a column
 	def getColumnSum(self, columnIndex, propagateColumn=False):
 		if propagateColumn:
-			self.propagateUpColumn(columnIndex)
-		return sum([self.manager.data[i][columnIndex] for i in range(self.peakIndex, self.processingIndex + 1)])
+			self.propagateUpColumns([columnIndex])
+		return self.manager.getRectangleSum(self.peakIndex, self.processingIndex + 1, columnIndex, columnIndex + 1)
 
 	# get the column sums at firstIndex and lastIndex
 	def getSideColumnSums(self):
@@ -140,18 +169,21 @@ class ColumnProcessor:
 	# This function is called on a column if we want to erase the column's value and use interpolated values instead.
 	# Should only be callued if the column is full of 0's
 	def interpolateColumn(self, columnIndex):
-		index = self.peakIndex
-		for index in range(self.peakIndex, self.processingIndex):
-			self.manager.data[index][columnIndex] = (self.manager.data[index][columnIndex - 1] + self.manager.data[index][columnIndex + 1]) / 2
+		self.manager.invalidateColumns(columnIndex, max(min(self.peakIndex, self.processingIndex), 0))
+		buffer = self.manager.buffer
+		# Each value is interpolated from its neighbouring columns only, so the rows can be interpolated at once.
+		rows = buffer.getPosition(numpy.arange(self.peakIndex, self.processingIndex))
+		buffer.array[rows, columnIndex] = (buffer.array[rows, columnIndex - 1] + buffer.array[rows, columnIndex + 1]) / 2
 
 		# We search down here
 		index = self.processingIndex
 		while index != Constants.MAX_BUFFER_SIZE:
 			# We interpolate past the current processingIndex until the values become non-zero, indicating the values have 
 			# become normal again
-			if self.manager.data[index][columnIndex] == 0:
-				if self.manager.data[index][columnIndex - 1] > 0 and self.manager.data[index][columnIndex - 1] > 0:
-					self.manager.data[index][columnIndex] = (self.manager.data[index][columnIndex - 1] + self.manager.data[index][columnIndex + 1]) / 2
+			row = buffer[index]
+			if row[columnIndex] == 0:
+				if row[columnIndex - 1] > 0 and row[columnIndex - 1] > 0:
+					row[columnIndex] = (row[columnIndex - 1] + row[columnIndex + 1]) / 2
 				else:
 					break
 			else:
@@ -179,6 +211,8 @@ class ColumnProcessor:
 				self.lastIndex -= 1
 			else:
 				break
+			if self.firstIndex - 2 < self.minIndex:	# Shifted too far for the note to be kept
+				break
 			leftOverColumnSum = self.getColumnSum(self.firstIndex - 1, True)
 			rightColumnSum = self.getColumnSum(self.lastIndex)
 		if shiftIndex != 0:
@@ -197,6 +231,8 @@ class ColumnProcessor:
 				self.lastIndex += 1
 			else:
 				break
+			if self.lastIndex + 2 > self.maxIndex:	# Shifted too far for the note to be kept
+				break
 			rightOverColumnSum = self.getColumnSum(self.lastIndex + 1, True)
 			leftColumnSum = self.getColumnSum(self.firstIndex)
 		if shiftIndex != 0:
@@ -206,7 +242,8 @@ class ColumnProcessor:
 
 	# Checks if offtune shift is now too far from ideal frequency
 	def checkNoteShift(self):
-		if utils.percentDiff((self.firstIndex + self.lastIndex) / 2, self.centerIndex) > 0.02:
+		shift = (self.firstIndex + self.lastIndex) / 2 - self.centerIndex
+		if utils.percentDiff(self.frequencyIndex + shift, self.frequencyIndex) > ColumnProcessor.MAX_OFFTUNE:
 			return True
 		return False
 
@@ -217,47 +254,23 @@ class ColumnProcessor:
 				return True
 		return False
 
-	# Propagates negative values in the current row up the columns
-	# The negative number will be pushed up, neutralising (sum to 0) values until it becomes 0.
-	def propagateUpNegativeRow(self):
-
-		for j in range(self.firstIndex, self.lastIndex + 1):
-			if self.manager.data[self.processingIndex][j] < 0:	# Propagate negative number up
-				rIndex = self.processingIndex
-				while rIndex > 0:
-					rIndex -= 1
-					if self.manager.data[rIndex][j] > -self.manager.data[self.processingIndex][j]:
-						self.manager.data[rIndex][j] += self.manager.data[self.processingIndex][j]
-						self.manager.data[self.processingIndex][j] = 0
-						break
-					else:
-						self.manager.data[self.processingIndex][j] += self.manager.data[rIndex][j]
-						self.manager.data[rIndex][j] = 0
-				self.manager.data[self.processingIndex][j] = 0
-
-	# Similar to propageUpNegativeRow, but column based. 
-	# Function will propagate up all negative values in the column
-	def propagateUpColumn(self, columnIndex):
-		dataIndex = Constants.MAX_BUFFER_SIZE
-		negativeCollector = 0
-		while dataIndex >= self.peakIndex - 3 - self.preNoteOffset:
-			dataIndex -= 1
-			if self.manager.data[dataIndex][columnIndex] < 0:	# Propagate negative number up
-				negativeCollector += self.manager.data[dataIndex][columnIndex]
-				self.manager.data[dataIndex][columnIndex] = 0
-			else:
-				if negativeCollector < 0:
-					if self.manager.data[dataIndex][columnIndex] > -negativeCollector:
-						self.manager.data[dataIndex][columnIndex] += negativeCollector
-						negativeCollector = 0
-					else:
-						negativeCollector += self.manager.data[dataIndex][columnIndex]
-						self.manager.data[dataIndex][columnIndex] = 0
+	# Similar to ColumnProcessorGroup.propagateUpNegativeRow, but column based.
+	# Function will propagate up all negative values in the columns, from the end of the buffer up to a few rows before
+	# the start of the note.
+	def propagateUpColumns(self, columns):
+		firstRow = self.peakIndex - 4 - self.preNoteOffset
+		buffer = self.manager.buffer
+		collector, changedColumns = propagation.propagateUpColumns(buffer.array, buffer.getPosition(numpy.arange(max(firstRow, 0), Constants.MAX_BUFFER_SIZE)), columns)
+		self.manager.invalidateColumns(changedColumns, max(firstRow, 0))
+		# A note starting at the top of the buffer walks on past the first row into the last rows, like negative indices do.
+		if firstRow < 0:
+			collector, changedColumns = propagation.propagateUpColumns(buffer.array, buffer.getPosition(numpy.arange(firstRow, 0)), columns, collector)
+			self.manager.invalidateColumns(changedColumns, Constants.MAX_BUFFER_SIZE + firstRow)
 
 	# Logic for detecting missed peaks. Under revision...
 	def checkPossibleMissedPeak(self, currentSum, currentIndex):
 		if self.checkPeak(currentSum, self.peakValue):
-			if self.checkPeak(currentSum, sum(self.manager.data[currentIndex - 8][self.firstIndex: self.lastIndex + 1])):
+			if self.checkPeak(currentSum, sum(self.manager.buffer[currentIndex - 8][self.firstIndex: self.lastIndex + 1])):
 				return True
 		return False
 
@@ -267,73 +280,32 @@ class ColumnProcessor:
 	# 1. Not really accounting for their harmonics. ie if some enough pixels are filled, harmonics are doubled.
 	# 2. I dont really know if this approximation method is sufficient
 	def fillComb(self):
+		row = self.manager.buffer[self.processingIndex]
 		for j in range(self.firstIndex, self.lastIndex + 1):
-			if self.manager.data[self.processingIndex][j] == 0:
-				if self.manager.data[self.processingIndex][j - 1] > 0 and self.manager.data[self.processingIndex][j + 1] > 0:
-					self.manager.data[self.processingIndex][j] = (self.manager.data[self.processingIndex][j - 1] + self.manager.data[self.processingIndex][j + 1]) / 2
-
-
-	def processNewDataRow(self):
-		# Manager class appends new data to deque so all relative indices are shifted down 1
-		self.peakIndex -= 1
-		# Buffer overflow. We would ideally have a longer buffer to account for longer notes. Currently we would have to discard this potential note.
-		if self.peakIndex - self.preNoteOffset - 2 < 0:
-			self.resetPeak()
-			self.peakIndex -= 1
-		# Propagate up the row upon data entry into buffer
-		self.processingIndex = Constants.MAX_BUFFER_SIZE - 1
-		self.propagateUpNegativeRow()
-		# Further up the buffer, perform other processes...
-		self.processingIndex = int(Constants.MAX_BUFFER_SIZE / 2)
-		self.fillComb()
-
-		row = self.manager.data[self.processingIndex][self.firstIndex: self.lastIndex + 1]
-		initialSum = sum(row)
-		referenceSum = sum(self.manager.data[self.processingIndex - 2][self.firstIndex: self.lastIndex + 1])
-		# If there is no peak, look for a peak. Else look for the end of the peak.
-		if self.peakIndex < 0:
-			# Look for new peak
-			if self.checkPeak(initialSum, referenceSum):
-				self.preNoteValue = referenceSum
-				self.peakIndex = self.processingIndex
-				self.peakValue = initialSum
-				self.maxValue = self.peakValue
-		else:
-			if initialSum > self.maxValue:
-				self.maxValue = initialSum
-			# Look for possible new peak, and end of peak.
-			# Criteria would be different than looking for fresh peak
-
-			# TODO: This logic is somewhat unstable because a fake peak could override a real one
-			if initialSum > self.peakValue and utils.percentDiff(initialSum, self.peakValue) > 2:
-				if self.checkPeak(initialSum, referenceSum):
-					indexFromLastPeak = self.processingIndex - self.peakIndex
-					# If the 2 peaks are close, we shift the peakIndex only.
-					if indexFromLastPeak <= 2:
-						self.preNoteOffset += indexFromLastPeak
-					else:
-						self.preNoteValue = referenceSum
-					self.peakIndex = self.processingIndex
-					self.peakValue = initialSum
+			if row[j] == 0:
+				if row[j - 1] > 0 and row[j + 1] > 0:
+					row[j] = (row[j - 1] + row[j + 1]) / 2
+
+
+	# Called when the processing row drops below the note's cut off, suggesting the end of the note.
+	# The checks that lead up to this are made for all processors at once by ColumnProcessorGroup.
+	def processNoteEnd(self):
+		# Check if note is offtune, which implies a possible longer duration
+		if self.tryOfftuneShift():
+			# If the note is offTune by a noticeable amount, it is discarded.
+			# It should have been caught by another processor in this case.
+			if self.checkNoteShift():
+				self.resetPeak()
+				return Message(MessageType.NO_EVENT)
+			self.peakValue = sum(self.manager.buffer[self.peakIndex][self.firstIndex: self.lastIndex + 1])
+			self.preNoteValue = sum(self.manager.buffer[self.peakIndex - 2 - self.preNoteOffset][self.firstIndex: self.lastIndex + 1])	# TODO: Negative?
+			# Check if it also satisfies note end after shift:
 			cutOff = self.maxValue / 10 + 9 * self.preNoteValue / 10
-			# Being lower than cutOff suggests a potential end of note
+			initialSum = sum(self.manager.buffer[self.processingIndex][self.firstIndex: self.lastIndex + 1])
 			if initialSum < cutOff or utils.percentDiff(initialSum, cutOff) < 0.2:
-				# Check if note is offtune, which implies a possible longer duration
-				if self.tryOfftuneShift():
-					# If the note is offTune by a noticeable amount, it is discarded.
-					# It should have been caught by another processor in this case.
-					if self.checkNoteShift():
-						self.resetPeak()
-						return Message(MessageType.NO_EVENT)
-					self.peakValue = sum(self.manager.data[self.peakIndex][self.firstIndex: self.lastIndex + 1])
-					self.preNoteValue = sum(self.manager.data[self.peakIndex - 2 - self.preNoteOffset][self.firstIndex: self.lastIndex + 1])	# TODO: Negative?
-					# Check if it also satisfies note end after shift:
-					cutOff = self.maxValue / 10 + 9 * self.preNoteValue / 10
-					initialSum = sum(self.manager.data[self.processingIndex][self.firstIndex: self.lastIndex + 1])
-					if initialSum < cutOff or utils.percentDiff(initialSum, cutOff) < 0.2:
-						return self.getNoteMessage(self.peakIndex - self.preNoteOffset, self.processingIndex)
-				else:
-					return self.getNoteMessage(self.peakIndex - self.preNoteOffset, self.processingIndex)
+				return self.getNoteMessage(self.peakIndex - self.preNoteOffset, self.processingIndex)
+		else:
+			return self.getNoteMessage(self.peakIndex - self.preNoteOffset, self.processingIndex)
 
 		# Im currently revising this logic, but something similar to it is greatly beneficial.
 		# Essentially, current logic to check for peak may miss them.
@@ -348,7 +320,7 @@ class ColumnProcessor:
 		# 	# In the case of a missed peak, we expect that there is a strictly non-decreasing climb from the base of the peak.
 		# 	while baseIndex > 0:
 		# 		baseIndex -= 1
-		# 		currentSum = sum(self.manager.data[baseIndex][self.firstIndex: self.lastIndex])
+		# 		currentSum = sum(self.manager.buffer[baseIndex][self.firstIndex: self.lastIndex])
 		# 		if currentSum > prevSum:
 		# 			break
 		# 		firstDerivatives.append(prevSum - currentSum)
@@ -360,12 +332,11 @@ class ColumnProcessor:
 		# 		modifiedFD = [firstDerivatives[i] * i for i in range(len(firstDerivatives))]
 		# 		trueBaseIndex = modifiedFD.index(max(modifiedFD))
 
-		# 		self.preNoteValue = sum(self.manager.data[self.processingIndex - trueBaseIndex - 2][self.firstIndex: self.lastIndex])
+		# 		self.preNoteValue = sum(self.manager.buffer[self.processingIndex - trueBaseIndex - 2][self.firstIndex: self.lastIndex])
 		# 		self.peakIndex = self.processingIndex - trueBaseIndex
 		# 		self.peakValue = initialSum
 		# 		self.maxValue = self.peakValue
 
-
 		return Message(MessageType.NO_EVENT)
 
 
@@ -0,0 +1,227 @@
+import numpy
+
+from noteProcessors.continuousNoteProcessor.constants import Constants
+from noteProcessors.continuousNoteProcessor.message import Message, MessageType
+from noteProcessors.continuousNoteProcessor import propagation
+import utils
+
+
+# Runs the per row step of all column processors of a manager at once.
+# The peak tracking state of every processor is held in arrays (one element per processor), so peak detection and the
+# end of note checks are a handful of array operations for each run of processors between the ones in a note, instead
+# of a Python call per processor.
+# Rare events, such as an offtune shift or a note ending, are handed to the ColumnProcessor objects, whose attributes
+# are loaded from the arrays before and stored back after.
+# Every processor is stepped on every row, idle ones included. A processor left out while its band is quiet would have to
+# replay the propagation and comb filling of the rows it missed to find the same notes, and in arrays an idle processor
+# costs little per row.
+class ColumnProcessorGroup:
+	# Attributes of ColumnProcessor mirrored in arrays
+	INT_STATE = ["peakIndex", "preNoteOffset", "offTuneIndex", "firstIndex", "lastIndex"]
+	FLOAT_STATE = ["peakValue", "maxValue", "preNoteValue"]
+
+	def __init__(self, columnProcessors, manager):
+		self.columnProcessors = columnProcessors
+		self.manager = manager
+		for name in ColumnProcessorGroup.INT_STATE:
+			setattr(self, name, numpy.array([getattr(p, name) for p in columnProcessors], dtype=numpy.int64))
+		for name in ColumnProcessorGroup.FLOAT_STATE:
+			setattr(self, name, numpy.array([getattr(p, name) for p in columnProcessors], dtype=numpy.float64))
+		self.columnOffsets = numpy.arange(Constants.COLUMN_PROCESSOR_DATA_WIDTH)
+		self.noteFrequencies = numpy.array([p.note.frequency for p in columnProcessors])
+		self.frequencyIndices = numpy.array([p.frequencyIndex for p in columnProcessors], dtype=numpy.int64)
+
+	def loadState(self, i):
+		columnProcessor = self.columnProcessors[i]
+		for name in ColumnProcessorGroup.INT_STATE + ColumnProcessorGroup.FLOAT_STATE:
+			setattr(columnProcessor, name, getattr(self, name)[i].item())
+		return columnProcessor
+
+	def storeState(self, i):
+		columnProcessor = self.columnProcessors[i]
+		for name in ColumnProcessorGroup.INT_STATE + ColumnProcessorGroup.FLOAT_STATE:
+			getattr(self, name)[i] = getattr(columnProcessor, name)
+
+	# Moves the idle processors, which are not in a note and not shifted offtune, to the frequency bins of their notes at
+	# the tuning outOfTune. Processors whose band would run past the end of the rows stay where they are.
+	# Returns the columns of the moved processors.
+	def retune(self, outOfTune):
+		frequencyIndices = numpy.rint(self.noteFrequencies * outOfTune * self.manager.samplesPerFrame / self.manager.sampleRate).astype(numpy.int64)
+		retuned = (self.peakIndex < 0) & (self.offTuneIndex == 0) & (frequencyIndices != self.frequencyIndices) & \
+			(frequencyIndices + Constants.COLUMN_PROCESSOR_DATA_WIDTH < self.manager.frequencyBinCount)
+		for i in numpy.flatnonzero(retuned):
+			self.loadState(i).retune(frequencyIndices[i].item())
+			self.storeState(i)
+		self.frequencyIndices[retuned] = frequencyIndices[retuned]
+		return self.getColumns()[retuned].ravel()
+
+	# Columns each processor operates on, one row per processor
+	def getColumns(self):
+		return self.firstIndex[:, None] + self.columnOffsets
+
+	# Same as utils.percentDiff, for arrays
+	def percentDiff(self, a, b):
+		minimum = numpy.minimum(a, b)
+		maximum = numpy.maximum(a, b)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			return numpy.where(minimum == 0, 999, numpy.abs(1 - maximum / minimum))
+
+	# Same as ColumnProcessor.checkPeak, for arrays
+	def checkPeak(self, currentSum, referenceSum):
+		return (currentSum - referenceSum > self.manager.runningMaximum / 10 * Constants.COLUMN_PROCESSOR_DATA_WIDTH) & \
+			(self.percentDiff(currentSum, referenceSum) > 3)
+
+	# Propagates negative values in the current row up the columns
+	# A propagated column has no negative left in the row, so each column shared by several processors only needs to be
+	# propagated once.
+	def propagateUpNegativeRow(self, processingIndex, columns):
+		rows = self.manager.buffer.getPosition(numpy.arange(processingIndex + 1))
+		changedColumns, depths = propagation.propagateUpNegativeRow(self.manager.buffer.array, rows, columns)
+		self.manager.invalidateColumns(changedColumns, processingIndex - depths)
+
+	# Same as ColumnProcessor.fillComb, for the columns of several processors stepped in turn. columns are sorted and
+	# owners[i] is the turn of the first processor columns[i] is filled by. Later processors find nothing left to fill.
+	# A column sees its neighbours as they are at its turn: propagated and filled by the processors before it, or as
+	# they were before the row was propagated (unpropagated) if they are propagated later. A fill can only make another
+	# column fillable, so columns are filled at once until no more turn out fillable.
+	def fillComb(self, processingIndex, columns, owners, unpropagated):
+		row = self.manager.buffer[processingIndex]
+		neighbours = columns[1:] - columns[:-1] == 1
+		# Neighbours propagated after a column's turn, by their index into columns
+		laterLeft = numpy.flatnonzero(numpy.concatenate(([False], neighbours & (owners[:-1] > owners[1:]))))
+		laterRight = numpy.flatnonzero(numpy.concatenate((neighbours & (owners[1:] > owners[:-1]), [False])))
+		fillable = row[columns] == 0
+		while fillable.any():
+			left = row[columns - 1]
+			left[laterLeft] = unpropagated[laterLeft - 1]
+			right = row[columns + 1]
+			right[laterRight] = unpropagated[laterRight + 1]
+			filled = fillable & (left > 0) & (right > 0)
+			if not filled.any():
+				break
+			row[columns[filled]] = (left[filled] + right[filled]) / 2
+			self.manager.invalidateColumns(columns[filled], processingIndex)
+			fillable &= ~filled
+
+	# Processes the newest row of the manager's buffer for every processor. Returns the messages of the processors that
+	# produced an event, in processor order.
+	# Processors step through the row in turn, each seeing the propagation, comb filling and note ends of the ones before
+	# it. Only a processor in a note may end it, and only a processor reset from an offtune shift changes the data before
+	# its turn, so the processors in between are stepped together.
+	def processNewDataRow(self):
+		messages = []
+		# Manager class appends new data to the buffer so all relative indices are shifted down 1
+		self.peakIndex -= 1
+		# Buffer overflow. We would ideally have a longer buffer to account for longer notes. Currently we would have to discard this potential note.
+		overflow = self.peakIndex - self.preNoteOffset - 2 < 0
+		# Resetting a shifted processor propagates the columns it shifted over, which is left to the processor in its turn.
+		shifted = overflow & (self.offTuneIndex != 0)
+		reset = overflow & ~shifted
+		for name in ["peakIndex", "preNoteOffset", "offTuneIndex", "peakValue", "maxValue", "preNoteValue"]:
+			getattr(self, name)[reset] = 0
+		self.peakIndex[reset] -= 1
+		active = (self.peakIndex >= 0) & ~shifted
+
+		first = 0
+		while first < len(self.columnProcessors):
+			if shifted[first]:
+				self.loadState(first).resetPeak()
+				self.storeState(first)
+				self.peakIndex[first] -= 1
+			last = self.getLastTurn(first, active, shifted)
+			message = self.stepProcessors(first, last + 1)
+			if message.messageType != MessageType.NO_EVENT:
+				messages.append(message)
+			first = last + 1
+		return messages
+
+	# Last processor that is stepped together with processor first. The processors after it wait for the end of a note
+	# it may find, or for the reset of a shifted processor.
+	def getLastTurn(self, first, active, shifted):
+		resets = numpy.flatnonzero(shifted[first + 1:])
+		last = first + resets[0] if len(resets) > 0 else len(self.columnProcessors) - 1
+		inNote = first + numpy.flatnonzero(active[first: last + 1])
+		if len(inNote) > 0:
+			mayEnd = self.mayEndNote(inNote)
+			if mayEnd.any():
+				last = inNote[mayEnd.argmax()]
+		return last
+
+	# Whether the processors in a note may find its end in this row. A processor can not if the propagation of its
+	# columns stops short of the rows it sums, and the sum of the processing row is well above any cut off the sums lead
+	# to. Filling its columns only adds to the sum, which keeps it above.
+	def mayEndNote(self, processors):
+		buffer = self.manager.buffer
+		processingIndex = int(Constants.MAX_BUFFER_SIZE / 2)
+		columns = self.firstIndex[processors, None] + self.columnOffsets
+		bottom = buffer[Constants.MAX_BUFFER_SIZE - 1][columns.ravel()]
+		reaching = numpy.zeros(columns.size, dtype=bool)
+		negative = numpy.flatnonzero(bottom < 0)
+		if len(negative) > 0:
+			# Same walk as propagation.propagateUpNegativeRow, down to the row below the processing row
+			rows = buffer.getPosition(numpy.arange(Constants.MAX_BUFFER_SIZE - 2, processingIndex, -1))
+			running = numpy.cumsum(numpy.vstack((bottom[negative], buffer.array[rows[:, None], columns.ravel()[negative]])), axis=0)
+			reaching[negative] = ~(running[1:] > 0).any(axis=0)
+
+		initialSum = buffer[processingIndex][columns].sum(axis=1)
+		referenceSum = buffer[processingIndex - 2][columns].sum(axis=1)
+		cutOff = numpy.maximum(self.maxValue[processors], initialSum) / 10 + 9 * numpy.maximum(self.preNoteValue[processors], referenceSum) / 10
+		return reaching.reshape(columns.shape).any(axis=1) | ~((initialSum > 0) & (initialSum >= 1.25 * cutOff))
+
+	# Steps processors first..last - 1 through the row, of which only the last one may find the end of its note. Returns
+	# the message of the note it ends.
+	def stepProcessors(self, first, last):
+		columns = self.firstIndex[first: last, None] + self.columnOffsets
+		# Each column is propagated and filled in the turn of the first processor it belongs to
+		uniqueColumns, firstPositions = numpy.unique(columns, return_index=True)
+		owners = firstPositions // Constants.COLUMN_PROCESSOR_DATA_WIDTH
+		processingIndex = int(Constants.MAX_BUFFER_SIZE / 2)
+		unpropagated = self.manager.buffer[processingIndex][uniqueColumns]
+
+		# Propagate up the row upon data entry into buffer
+		self.propagateUpNegativeRow(Constants.MAX_BUFFER_SIZE - 1, uniqueColumns)
+
+		# Further up the buffer, perform other processes...
+		self.fillComb(processingIndex, uniqueColumns, owners, unpropagated)
+
+		initialSum = self.manager.buffer[processingIndex][columns].sum(axis=1)
+		referenceSum = self.manager.buffer[processingIndex - 2][columns].sum(axis=1)
+		peakIndex, preNoteOffset = self.peakIndex[first: last], self.preNoteOffset[first: last]
+		peakValue, maxValue, preNoteValue = self.peakValue[first: last], self.maxValue[first: last], self.preNoteValue[first: last]
+		# If there is no peak, look for a peak. Else look for the end of the peak.
+		searching = peakIndex < 0
+		active = ~searching
+
+		# Look for new peak
+		newPeak = searching & self.checkPeak(initialSum, referenceSum)
+		preNoteValue[newPeak] = referenceSum[newPeak]
+		peakIndex[newPeak] = processingIndex
+		peakValue[newPeak] = initialSum[newPeak]
+		maxValue[newPeak] = initialSum[newPeak]
+
+		raised = active & (initialSum > maxValue)
+		maxValue[raised] = initialSum[raised]
+		# Look for possible new peak, and end of peak.
+		# Criteria would be different than looking for fresh peak
+
+		# TODO: This logic is somewhat unstable because a fake peak could override a real one
+		higherPeak = active & (initialSum > peakValue) & (self.percentDiff(initialSum, peakValue) > 2) & \
+			self.checkPeak(initialSum, referenceSum)
+		indexFromLastPeak = processingIndex - peakIndex
+		# If the 2 peaks are close, we shift the peakIndex only.
+		closePeak = higherPeak & (indexFromLastPeak <= 2)
+		preNoteOffset[closePeak] += indexFromLastPeak[closePeak]
+		farPeak = higherPeak & ~closePeak
+		preNoteValue[farPeak] = referenceSum[farPeak]
+		peakIndex[higherPeak] = processingIndex
+		peakValue[higherPeak] = initialSum[higherPeak]
+
+		cutOff = maxValue[-1] / 10 + 9 * preNoteValue[-1] / 10
+		# Being lower than cutOff suggests a potential end of note
+		if active[-1] and (initialSum[-1] < cutOff or utils.percentDiff(initialSum[-1], cutOff) < 0.2):
+			columnProcessor = self.loadState(last - 1)
+			columnProcessor.processingIndex = processingIndex
+			message = columnProcessor.processNoteEnd()
+			self.storeState(last - 1)
+			return message
+		return Message(MessageType.NO_EVENT)
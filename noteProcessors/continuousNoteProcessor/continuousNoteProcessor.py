@@ -1,7 +1,10 @@
 
+import collections.abc
 import copy
 from collections import deque
 from collections import defaultdict
+import itertools
+import numpy
 from numpy import fft
 import time
 
@@ -9,64 +12,96 @@ from activeNote import ActiveNote
 from noteParser import Note
 from noteProcessors.abstractNoteProcessor import AbstractNoteProcessor
 from noteProcessors.continuousNoteProcessor.columnManager import ColumnManager
+from noteProcessors.continuousNoteProcessor.columnProcessor import ColumnProcessor
 from noteProcessors.continuousNoteProcessor.constants import Constants
 from noteProcessors.continuousNoteProcessor.message import Message, MessageType, NewNoteMessage
-from noteProcessors.continuousNoteProcessor.rowGenerators import ContinuousGenerator, RecursiveGenerator
+from noteProcessors.continuousNoteProcessor.pipeline import PipelinedGenerator
+from noteProcessors.continuousNoteProcessor import propagation
+from noteProcessors.continuousNoteProcessor.rowGenerators import ContinuousGenerator, RecursiveGenerator, SparseGenerator
+from noteProcessors.continuousNoteProcessor import tuning
+from noteProcessors.continuousNoteProcessor.tuning import TuningCurve
 import utils
 
 
 class ContinuousNoteProcessor(AbstractNoteProcessor):
-	def __init__(self, waveform, sampleRate, noteParser=None, shapeStrategy=None):
-		super(ContinuousNoteProcessor, self).__init__(waveform, sampleRate, noteParser)
-
-	# Estimates how much the whole song is offtune by. This will increase search capabilities.
-	# The assumption here is that all notes of a song are offtune by a similar amount.
-	# TODO: Change this so each section of the song has its own set of approximation.
-	def getOutOfTune(self):
-		def getLocalMax(arr):
-			localMax = []
-			for i in range(1, len(arr) - 1):
-				if arr[i] > arr[i - 1] and arr[i] > arr[i + 1]:
-					localMax.append(i)
-			return localMax
-
-		# Number of notes to take when calculating the offset.
-		referenceNoteCount = 6
+	# waveform may also be an iterator of sample blocks, which is consumed as the rows are generated.
+	supportsStreaming = True
+	supportsSegments = True
+	# A frame step of the row generator, at every decimation factor. Segments then have the rows and tuning sections of
+	# the whole waveform.
+	segmentAlignment = 512 * (128 - ContinuousGenerator.trimFrames * 2)
+	# A buffer of rows for the longest note, which is dropped once it overflows the buffer, one for the rows the column
+	# processors look back over when a note ends, and one for the running maximum to settle and every column to be
+	# summed from 0, see ColumnManager. Whole frame steps.
+	segmentOverlap = segmentAlignment * -(-3 * Constants.MAX_BUFFER_SIZE // (128 - ContinuousGenerator.trimFrames * 2))
+	# Highest harmonic the column processors add in
+	maxHarmonic = 6
+	# Arbitrary start index and duration in seconds of the samples used to estimate how offtune the song is.
+	referenceStartIndex = 10000
+	referenceSeconds = 5
+
+	# noteRange optionally limits the notes looked for to (lowestFrequency, highestFrequency).
+	# sparse computes only the frequency bins the column processors read, which pays off when noteRange is narrow.
+	# pipelineDepth generates rows on a background thread, up to pipelineDepth rows ahead of the column processors.
+	# outOfTune fixes how offtune the whole song is instead of estimating it.
+	# referenceOutOfTune is how offtune the whole song is estimated to be from its reference section, see getOutOfTune.
+	# Given when the waveform is a segment of a song, which may not hold the reference section.
+	# firstSample is the sample of the whole song the waveform starts at, when it is a segment. Notes are timed relative
+	# to the whole song.
+	def __init__(self, waveform, sampleRate, noteParser=None, shapeStrategy=None, artifacts=None, decimationFactor=1, noteRange=None, sparse=False,
+			pipelineDepth=None, outOfTune=None, referenceOutOfTune=None, firstSample=0):
+		super(ContinuousNoteProcessor, self).__init__(waveform, sampleRate, noteParser, artifacts, decimationFactor)
+		self.noteRange = noteRange
+		self.sparse = sparse
+		self.pipelineDepth = pipelineDepth
+		self.outOfTune = outOfTune
+		self.referenceOutOfTune = referenceOutOfTune
+		self.firstSample = firstSample
+		self.columnManager = None
+
+	# Harmonics of the highest note of noteRange, shifted as far offtune as a column processor follows a note.
+	# How offtune the whole song is stays within the decimator's transition band.
+	@classmethod
+	def getHighestFrequency(cls, noteList, noteRange=None, **processorArgs):
+		frequencies = [n.frequency for n in noteList if noteRange is None or noteRange[0] <= n.frequency <= noteRange[1]]
+		if not frequencies:
+			return None
+		return max(frequencies) * (1 + ColumnProcessor.MAX_OFFTUNE) * cls.maxHarmonic
+
+	# Estimates how much the whole song is offtune by, from a reference section of the song. This will increase search
+	# capabilities. Songs shorter than the reference section are estimated from all of their samples.
+	# Sections of the song whose tuning can not be told from their rows take this, see TuningCurve.
+	def getOutOfTune(self, waveform=None):
+		if waveform is None:
+			waveform = self.waveform
 		# Duration of time to take as samples when calculating offset
-		referenceDuration = self.sampleRate * 5
-		# Arbitrary start index of offset
-		referenceStartIndex = 10000
-		referenceFFT = fft.fft(self.waveform[referenceStartIndex: referenceStartIndex + referenceDuration])
-		referenceFFT = [abs(f) for f in referenceFFT][:int(len(referenceFFT) / 2)]
-
-		localMax = getLocalMax(referenceFFT)
-		localMax.sort(key=lambda x: -referenceFFT[x])
-
-		i = 0
-		existingNotes = []
-		percentDiffs = []
-
-		# Get double the reference note count
-		while len(existingNotes) <= referenceNoteCount * 2:
-			index = localMax[i]
-			i += 1
-			frequency = index * self.sampleRate / referenceDuration
-			closestNote, percentDiff = self.getClosestNote(frequency)
-			if closestNote in existingNotes:
-				continue
-			existingNotes.append(closestNote)
-			percentDiffs.append(percentDiff)
-
-		# Remove the notes that increase deviation within the set the most
-		iterations = len(existingNotes) - referenceNoteCount
-		for i in range(referenceNoteCount):
-			avg = sum(percentDiffs) / len(percentDiffs)
-			percentDiffs.sort(key=lambda x: abs(x - avg))
-			percentDiffs = percentDiffs[:-1]
-
-		outOfTune = sum(percentDiffs) / len(percentDiffs)
+		referenceDuration = int(self.sampleRate * ContinuousNoteProcessor.referenceSeconds)
+		# Arbitrary start index of offset, moved back for songs that end before the reference section does
+		referenceStartIndex = max(0, min(ContinuousNoteProcessor.referenceStartIndex // self.decimationFactor, len(waveform) - referenceDuration))
+		referenceWaveform = numpy.asarray(waveform[referenceStartIndex: referenceStartIndex + referenceDuration])
+		referenceFFT = numpy.abs(fft.fft(referenceWaveform))[:int(len(referenceWaveform) / 2)]
+		outOfTune = tuning.estimateOutOfTune(referenceFFT, self.sampleRate, len(referenceWaveform), numpy.array([n.frequency for n in self.noteList]))
+		if outOfTune is None:
+			return 1	# Too few notes to tell
 		return outOfTune
 
+	# Segments take how offtune the whole song is, since they may not hold its reference section. The tuning curve of
+	# full rows is estimated section by section, which a segment does the same as the whole song.
+	def getSegmentArgs(self):
+		if self.outOfTune is None and self.referenceOutOfTune is None:
+			return {"referenceOutOfTune": self.getOutOfTune()}
+		return {}
+
+	# Tuning of each section of the song, estimated by the column manager from the rows it processes. A curve estimated
+	# before is loaded from the artifacts. referenceOutOfTune is how offtune the whole song is.
+	def getTuningCurve(self, rowGenerator, referenceOutOfTune):
+		tunings = None
+		if self.artifacts is not None:
+			tunings = self.artifacts.load("tuningCurve", **rowGenerator.getRowParams())
+		rowsPerSection = rowGenerator.intervalsPerFrame - ContinuousGenerator.trimFrames * 2
+		return TuningCurve(rowsPerSection, self.sampleRate, rowGenerator.samplesPerInterval * rowGenerator.intervalsPerFrame,
+			[n.frequency for n in self.noteList], referenceOutOfTune, tunings)
+
 	# The purpose of this function is to meld the instances where a row is 0x0x0x0... where x is a positive number.
 	# In these cases, it is likely a case of interference from a previous note in the same frame.
 	# Temporarily deprecated
@@ -107,38 +142,77 @@ class ContinuousNoteProcessor(AbstractNoteProcessor):
 			row[index] = (row[index - 1] + row[index + 1]) / 2
 
 
-	def run(self):
-		samplesPerInterval = 512
+	# Reads blocks off the front of a stream until sampleCount samples are read or the stream ends.
+	# Returns the samples read and an iterator that replays them ahead of the rest of the stream.
+	def peekStream(self, blocks, sampleCount):
+		peekedBlocks = []
+		peekedCount = 0
+		for block in blocks:
+			peekedBlocks.append(block)
+			peekedCount += len(block)
+			if peekedCount >= sampleCount:
+				break
+		peekedSamples = numpy.concatenate(peekedBlocks) if peekedBlocks else numpy.zeros(0)
+		return peekedSamples, itertools.chain(peekedBlocks, blocks)
+
+	# Yields notes as soon as they are found, so the first notes are available before the whole input is read.
+	# Loudness is not normalised here since that needs every note, run() takes care of it.
+	def generateNotes(self):
+		# Intervals and frames cover the same time at every decimation factor, which keeps the frequency of each
+		# spectrum bin the same while rows get narrower.
+		samplesPerInterval = 512 // self.decimationFactor
 		intervalsPerFrame = 128
 		samplesPerFrame = samplesPerInterval * intervalsPerFrame
-		rowGenerator = ContinuousGenerator(samplesPerInterval, intervalsPerFrame, self.waveform)
+		waveform = self.waveform
+		referenceOutOfTune = self.referenceOutOfTune
+		if self.outOfTune is None and referenceOutOfTune is None:
+			if isinstance(waveform, collections.abc.Iterator):
+				# Only the reference section of a stream is buffered, the rest is handed on to the row generator.
+				referenceWaveform, waveform = self.peekStream(waveform,
+					ContinuousNoteProcessor.referenceStartIndex // self.decimationFactor + self.sampleRate * ContinuousNoteProcessor.referenceSeconds)
+				referenceOutOfTune = self.getOutOfTune(referenceWaveform)
+			else:
+				referenceOutOfTune = self.getOutOfTune()
+		rowGenerator = None
+		if not self.sparse:
+			rowGenerator = ContinuousGenerator(samplesPerInterval, intervalsPerFrame, waveform, self.artifacts)
+		if self.outOfTune is not None:
+			outOfTune = self.outOfTune
+		# Sparse rows only hold the bins around the notes, which have no peaks to pick between them.
+		elif self.sparse:
+			outOfTune = referenceOutOfTune
+		else:
+			outOfTune = self.getTuningCurve(rowGenerator, referenceOutOfTune)
+		self.columnManager = ColumnManager(outOfTune, self.noteParser, self.sampleRate, samplesPerFrame, samplesPerInterval,
+			maxHarmonic=ContinuousNoteProcessor.maxHarmonic, noteRange=self.noteRange, sparse=self.sparse, firstRow=self.firstSample // samplesPerInterval)
+		if self.sparse:
+			rowGenerator = SparseGenerator(samplesPerInterval, intervalsPerFrame, waveform, self.columnManager.columnBins, self.artifacts)
 		rows = rowGenerator.generate()
-		outOfTune = self.getOutOfTune()
-		columnManager = ColumnManager(outOfTune, self.noteParser, self.sampleRate, samplesPerFrame, samplesPerInterval)
+		if self.pipelineDepth is not None:
+			rows = PipelinedGenerator(rows, self.pipelineDepth).generate()
 
 		visualise = False
+		d2Array = []
 		for row in rows:
 			if visualise:
-				d2Array.append(d2Row[:2000])
-			columnManager.processNewDataRow(row)
+				d2Array.append(row[:2000])
+			noteCount = len(self.columnManager.activeNotes)
+			self.columnManager.processNewDataRow(row)
+			for activeNote in self.columnManager.activeNotes[noteCount:]:
+				yield activeNote
+		if isinstance(outOfTune, TuningCurve) and not outOfTune.complete and self.artifacts is not None:
+			self.artifacts.store("tuningCurve", outOfTune.getTunings(), **rowGenerator.getRowParams())
 
 		if visualise:
-			for columnIndex in range(len(d2Array[0])):
-				dataIndex = len(d2Array)
-				negativeCollector = 0
-				while dataIndex > 0:
-					dataIndex -= 1
-					if d2Array[dataIndex][columnIndex] < 0:	# Propagate negative number up
-						negativeCollector += d2Array[dataIndex][columnIndex]
-						d2Array[dataIndex][columnIndex] = 0
-					else:
-						if negativeCollector < 0:
-							if d2Array[dataIndex][columnIndex] > -negativeCollector:
-								d2Array[dataIndex][columnIndex] += negativeCollector
-								negativeCollector = 0
-							else:
-								negativeCollector += d2Array[dataIndex][columnIndex]
-								d2Array[dataIndex][columnIndex] = 0
+			d2Array = numpy.array(d2Array)
+			propagation.propagateUpColumns(d2Array, numpy.arange(len(d2Array)), numpy.arange(d2Array.shape[1]))
 			utils.d2Plot(d2Array, "out/continous2.png", widthCompression=100, heightCompression=10)
 
-		return columnManager.getActiveNotes()
+	def run(self):
+		for activeNote in self.generateNotes():
+			pass
+		return self.columnManager.getActiveNotes()
+
+	@staticmethod
+	def normaliseNotes(activeNotes):
+		return ColumnManager.normaliseActiveNotes(activeNotes)
@@ -0,0 +1,52 @@
+import queue
+import threading
+
+# Runs a row generator on a background thread, so rows are generated while the previous ones are being processed.
+# Rows are handed over through a queue of at most depth rows. The producer blocks once the queue is full, which keeps
+# it from running ahead of the consumer and bounds the memory held by rows in flight.
+# FFTs release the GIL, so on multiple cores the total time approaches that of the slower of the two stages.
+class PipelinedGenerator:
+	# Marks the end of the rows in the queue
+	END = object()
+
+	def __init__(self, rows, depth=64):
+		self.rows = rows
+		self.queue = queue.Queue(maxsize=depth)
+		self.stopped = threading.Event()	# Set when the consumer stops early
+		self.error = None
+		self.thread = None
+
+	def produce(self):
+		try:
+			for row in self.rows:
+				if not self.put(row):
+					self.rows.close()	# Lets the row generator clean up, eg. discard a partly written artifact
+					return
+		except BaseException as e:
+			self.error = e
+		self.put(PipelinedGenerator.END)
+
+	# Blocks while the queue is full. Returns False if the consumer stopped in the meantime.
+	def put(self, item):
+		while not self.stopped.is_set():
+			try:
+				self.queue.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def generate(self):
+		self.thread = threading.Thread(target=self.produce, daemon=True)
+		self.thread.start()
+		try:
+			while True:
+				row = self.queue.get()
+				if row is PipelinedGenerator.END:
+					break
+				yield row
+		finally:
+			self.stopped.set()
+			self.thread.join()
+		if self.error is not None:
+			raise self.error
@@ -0,0 +1,82 @@
+import numpy
+
+# Kernels that propagate negative values up the columns of 2d data. A negative value is pushed up its column,
+# neutralising (sum to 0) the positive values above it until it becomes 0.
+# Rows are given as indices into the array, listed top to bottom, so the rows of a RingBuffer can be walked in their
+# logical order. Columns are processed all at once: walking a column upwards is a running cumulative sum of its
+# values, clipped at 0.
+
+# Rows at least this far up are only looked at for the columns whose negative values are still not neutralised.
+FIRST_DEPTH = 8
+# The first rows looked at hold at least this many values, so a few columns are walked in a few chunks.
+FIRST_VALUES = 1024
+
+
+# Propagates the negative values of the bottom row up their columns. Each negative value is neutralised by the values
+# directly above it, the rows above the one that neutralises it are left untouched.
+# Returns the columns that were changed, and for each of them the number of rows above the bottom row it was changed in.
+def propagateUpNegativeRow(array, rows, columns):
+	bottom = rows[-1]
+	columns = numpy.asarray(columns)
+	columns = columns[array[bottom, columns] < 0]
+	changedColumns = columns
+	depths = numpy.zeros(len(columns), dtype=numpy.int64)
+	if len(columns) == 0:
+		return changedColumns, depths
+	remaining = numpy.arange(len(columns))	# Indices into changedColumns of the columns still being propagated
+	collector = array[bottom, columns]
+	array[bottom, columns] = 0
+	above = rows[-2::-1]
+	# Most values are neutralised within a few rows, so the rows are looked at in chunks of growing depth.
+	start = 0
+	depth = max(FIRST_DEPTH, FIRST_VALUES // len(columns))
+	while len(columns) > 0 and start < len(above):
+		chunkRows = above[start: start + depth]
+		block = array[numpy.ix_(chunkRows, columns)]
+		# running[k] is the collector after taking in k rows. Summing in walking order gives the same values as
+		# collecting one row at a time.
+		running = numpy.cumsum(numpy.vstack((collector, block)), axis=0)[1:]
+		neutralised = running > 0
+		stopped = neutralised.any(axis=0)
+		stopIndex = numpy.where(stopped, neutralised.argmax(axis=0), len(chunkRows))
+		# Rows below the neutralising row are taken in completely, the neutralising row keeps what is left over.
+		block[numpy.arange(len(chunkRows))[:, None] < stopIndex] = 0
+		stoppedColumns = numpy.flatnonzero(stopped)
+		block[stopIndex[stopped], stoppedColumns] = running[stopIndex[stopped], stoppedColumns]
+		array[numpy.ix_(chunkRows, columns)] = block
+		depths[remaining] = start + numpy.where(stopped, stopIndex + 1, len(chunkRows))
+
+		collector = running[-1][~stopped]
+		columns = columns[~stopped]
+		remaining = remaining[~stopped]
+		start += len(chunkRows)
+		depth *= 2
+	return changedColumns, depths
+
+
+# Propagates up all negative values in the columns, walking the rows from the bottom up. collector holds negative
+# values carried in from below the rows, one per column. Returns what is left of the collectors above the top row, and
+# the columns that were changed.
+def propagateUpColumns(array, rows, columns, collector=None):
+	columns = numpy.asarray(columns)
+	if collector is None:
+		collector = numpy.zeros(len(columns), dtype=array.dtype)
+	walk = rows[::-1]
+	block = array[numpy.ix_(walk, columns)]
+	# Columns without negative values are left untouched
+	negative = (block < 0).any(axis=0) | (collector < 0)
+	if not negative.any():
+		return collector, columns[negative]
+	block = block[:, negative]
+	# With sums[k] the collector plus the first k values of the walk, the collector after k values is
+	# sums[k] - max(0, sums[1..k]), since it is emptied whenever it would become positive.
+	sums = numpy.cumsum(numpy.vstack((collector[negative], block)), axis=0)
+	highest = numpy.maximum.accumulate(numpy.maximum(sums, 0), axis=0)
+	collectors = sums - highest
+	# A value takes in the collector from below, down to 0. Values with nothing to take in keep their exact value.
+	propagated = numpy.where((collectors[:-1] == 0) & (block >= 0), block, numpy.maximum(collectors[:-1] + block, 0))
+	array[numpy.ix_(walk, columns[negative])] = propagated
+
+	collector = collector.copy()
+	collector[negative] = collectors[-1]
+	return collector, columns[negative]
@@ -0,0 +1,43 @@
+import numpy
+
+# Fixed size buffer of rows, backed by one 2d array that is written in a circle.
+# Rows are indexed in logical order: row 0 is the oldest row and row -1 or size - 1 the newest. A logical row is found
+# in the backing array at getPosition(index). Rows and their column slices are views, so writes to them land in the
+# buffer.
+# Appending overwrites the oldest row in place and only moves the position of the oldest row.
+class RingBuffer:
+	def __init__(self, size, width, dtype=numpy.float64):
+		self.size = size
+		self.array = numpy.zeros((size, width), dtype=dtype)
+		self.start = 0	# Position of the oldest row in the backing array
+		self.appendedRows = 0	# Rows appended so far. The rows the buffer starts with are numbered -size..-1.
+
+	def __len__(self):
+		return self.size
+
+	# View of a logical row
+	def __getitem__(self, index):
+		return self.array[(self.start + index) % self.size]
+
+	# Position of a logical row in the backing array. index may be an array of indices.
+	def getPosition(self, index):
+		return (self.start + index) % self.size
+
+	def append(self, row):
+		self.array[self.start] = row
+		self.start = (self.start + 1) % self.size
+		self.appendedRows += 1
+
+	# Slices of the backing array holding logical rows firstIndex..lastIndex - 1, in order. There are at most two.
+	def getSlices(self, firstIndex, lastIndex):
+		first = self.start + firstIndex
+		last = self.start + lastIndex
+		if last <= self.size:
+			return [slice(first, last)]
+		if first >= self.size:
+			return [slice(first - self.size, last - self.size)]
+		return [slice(first, self.size), slice(0, last - self.size)]
+
+	# Copy of columns firstColumn..lastColumn - 1 of rows firstIndex.. of the buffer, in logical order.
+	def getColumns(self, firstColumn, lastColumn, firstIndex=0):
+		return numpy.concatenate([self.array[rows, firstColumn: lastColumn] for rows in self.getSlices(firstIndex, self.size)])
@@ -1,53 +1,166 @@
+import collections.abc
 import gc
 import math
+import numpy
 from numpy import fft
 
 from noteProcessors.continuousNoteProcessor.constants import Constants
 class ContinuousGenerator:
-	def __init__(self, samplesPerInterval, intervalsPerFrame, waveform):
+	trimFrames = 5
+
+	# artifacts is an optional FileArtifacts. Generated rows are stored in it and replayed by later runs.
+	def __init__(self, samplesPerInterval, intervalsPerFrame, waveform, artifacts=None):
 		self.samplesPerInterval = samplesPerInterval
 		self.intervalsPerFrame = intervalsPerFrame
 		self.waveform = waveform
+		self.artifacts = artifacts
+
+	# waveform is either indexable (a list, ndarray or MappedWaveform) or an iterator of sample blocks, in which case
+	# frames are assembled from the blocks as they arrive and nothing past the current frame is held in memory.
+	def isStreaming(self):
+		return isinstance(self.waveform, collections.abc.Iterator)
+
+	# Yields the samples of each frame, advancing samplesPerFrameStep samples between frames.
+	# A frame is only produced if samplesPerFrame + samplesPerInterval - 1 samples are available from its start.
+	def getFrameSamples(self, samplesPerFrame, samplesPerFrameStep):
+		requiredSamples = samplesPerFrame + self.samplesPerInterval - 1
+		if not self.isStreaming():
+			sampleIndex = 0
+			while sampleIndex + requiredSamples <= len(self.waveform):
+				yield self.waveform[sampleIndex: sampleIndex + samplesPerFrame]
+				sampleIndex += samplesPerFrameStep
+			return
+
+		pending = numpy.zeros(0)
+		for block in self.waveform:
+			pending = numpy.concatenate((pending, block))
+			while len(pending) >= requiredSamples:
+				yield pending[:samplesPerFrame]
+				pending = pending[samplesPerFrameStep:]
+
+	# Number of values in a row
+	def getRowWidth(self):
+		return int(self.samplesPerInterval * self.intervalsPerFrame / 2)
+
+	# Parameters the rows depend on, which key them in the artifact cache
+	def getRowParams(self):
+		return {"samplesPerInterval": self.samplesPerInterval, "intervalsPerFrame": self.intervalsPerFrame, "trimFrames": ContinuousGenerator.trimFrames}
 
 	def generate(self):
+		rowParams = self.getRowParams()
+		cachedRows = None
+		if self.artifacts is not None:
+			cachedRows = self.artifacts.load("continuousRows", **rowParams)
+
+		if cachedRows is not None:
+			for row in cachedRows:
+				yield numpy.array(row)	# Copied out of the read only artifact, processors write into their rows
+		elif self.artifacts is not None and not self.isStreaming():
+			# The number of rows is known up front, so rows are written into the artifact as they are generated.
+			rowCount = self.getFrameCount() * (self.intervalsPerFrame - ContinuousGenerator.trimFrames * 2)
+			writer = self.artifacts.openWriter("continuousRows", (rowCount, self.getRowWidth()), numpy.float64, **rowParams)
+			completed = False
+			try:
+				for rowIndex, row in enumerate(self.generateFrameRows()):
+					writer.array[rowIndex] = row
+					yield row
+				completed = True
+			finally:
+				if completed:
+					writer.close()
+				else:
+					writer.discard()
+		else:
+			yield from self.generateFrameRows()
+
+		# Shove a bunch of 0's to the processors to ensure completion
+		for i in range(Constants.MAX_BUFFER_SIZE):
+			yield numpy.zeros(self.getRowWidth())
+
+	def getFrameStep(self):
+		# Frames overlap so that the trimmed rows of one frame are covered by the next.
+		return self.samplesPerInterval * (self.intervalsPerFrame - ContinuousGenerator.trimFrames * 2)
+
+	# Number of frames an indexable waveform is split into.
+	def getFrameCount(self):
+		maxSample = len(self.waveform) - self.samplesPerInterval * (self.intervalsPerFrame + 1) + 1
+		if maxSample < 0:
+			return 0
+		return maxSample // self.getFrameStep() + 1
+
+	def generateFrameRows(self):
 		samplesPerFrame = self.samplesPerInterval * self.intervalsPerFrame
-		trimFrames = 5
+		trimFrames = ContinuousGenerator.trimFrames
+		samplesPerFrameStep = self.getFrameStep()
 
-		sampleIndex = 0
-		# TODO: since waveform is the max space, this effectively almost doubles space requirement for this program
-		# We can re-write paddedWaveform as wrapper around waveform if this becomes a problem
-		# You know I just wish python ints didnt take 28 bytes
-		paddedWaveform = [0 for i in range(samplesPerFrame - self.samplesPerInterval)]
-		paddedWaveform.extend(self.waveform)
+		# Every frame starts "clean": the i-th FFT of a frame covers the first i + 1 intervals of the frame, left padded
+		# with zeros. Only the samples of the current frame are sliced out of the waveform, so a lazily decoded
+		# waveform is never materialised as a whole.
+		paddedFrame = numpy.zeros(2 * samplesPerFrame - self.samplesPerInterval)
+		# Strided view of the windows of a frame, without copying. Rows are differences of consecutive windows, so
+		# the window before the first untrimmed row is needed as well. We trim the first few and last few rows
+		# because of the anomolies they may contain.
+		windows = numpy.lib.stride_tricks.sliding_window_view(paddedFrame, samplesPerFrame)[
+			(trimFrames - 1) * self.samplesPerInterval: (self.intervalsPerFrame - trimFrames) * self.samplesPerInterval: self.samplesPerInterval]
 
-		maxSample = len(paddedWaveform) - (2 * samplesPerFrame) + 1
 		counter = 0
-		maxCounter = int(maxSample / (samplesPerFrame - self.samplesPerInterval * trimFrames * 2)) + 1
-		while sampleIndex <= maxSample:
+		maxCounter = "?"	# Unknown when streaming
+		if not self.isStreaming():
+			maxCounter = self.getFrameCount()
+		for frameSamples in self.getFrameSamples(samplesPerFrame, samplesPerFrameStep):
 			counter += 1
 			print("Processing Frame: %s / %s" % (counter, maxCounter))
-			gc.collect()
 
-			currentFFT = []
-			prevFFT = [0 for i in range(int(samplesPerFrame / 2))]
-
-			startingSampleIndex = sampleIndex
-			for i in range(self.intervalsPerFrame):
-				currentFFT = fft.fft(paddedWaveform[sampleIndex: sampleIndex + samplesPerFrame])[:int(samplesPerFrame / 2)]
-				d2Row = [abs(currentFFT[j]) - abs(prevFFT[j]) for j in range(len(currentFFT))]
-				prevFFT = currentFFT
-				sampleIndex += self.samplesPerInterval
-
-				# We trim the first few and last few frames because of the anomolies they may contain.
-				if i >= trimFrames and i < self.intervalsPerFrame - trimFrames:
-					yield d2Row
-			sampleIndex -= self.samplesPerInterval * trimFrames * 2
-			# Set the samples used in the current frame to 0, so that the beginning of the next frame is "clean"
-			for i in range(max(sampleIndex, startingSampleIndex + samplesPerFrame - self.samplesPerInterval) , sampleIndex + samplesPerFrame - self.samplesPerInterval):
-				paddedWaveform[i] = 0
-		# Shove a bunch of 0's to the processors to ensure completion
-		for i in range(Constants.MAX_BUFFER_SIZE):
-			yield [0 for i in range(len(currentFFT))]
+			paddedFrame[samplesPerFrame - self.samplesPerInterval:] = frameSamples
+			# One FFT over the whole batch of windows
+			magnitudes = numpy.abs(fft.rfft(windows, axis=1)[:, :int(samplesPerFrame / 2)])
+			for d2Row in numpy.diff(magnitudes, axis=0):
+				yield d2Row
+
+# Computes only the frequency bins in bins, in the order given, instead of whole rows.
+# The i-th window of a frame is the first i + 1 intervals of the frame, left padded with zeros. Padding only rotates the
+# phase of a bin, so its magnitude is that of a running DFT over the frame's samples, which is brought up to date one
+# interval at a time. The update of every interval of a frame is a single matrix product with the bins' twiddle
+# factors, so the cost grows with the number of bins rather than the FFT size.
+class SparseGenerator(ContinuousGenerator):
+	def __init__(self, samplesPerInterval, intervalsPerFrame, waveform, bins, artifacts=None):
+		super(SparseGenerator, self).__init__(samplesPerInterval, intervalsPerFrame, waveform, artifacts)
+		self.bins = numpy.array(bins, dtype=numpy.int64)
+
+	def getRowWidth(self):
+		return len(self.bins)
+
+	def getRowParams(self):
+		rowParams = super(SparseGenerator, self).getRowParams()
+		rowParams["bins"] = self.bins.tolist()
+		return rowParams
+
+	def generateFrameRows(self):
+		samplesPerFrame = self.samplesPerInterval * self.intervalsPerFrame
+		trimFrames = ContinuousGenerator.trimFrames
+		# Only the intervals up to the last untrimmed window contribute to a row.
+		intervalCount = self.intervalsPerFrame - trimFrames
+
+		# Phases are reduced modulo samplesPerFrame in integers to keep them exact for high bins.
+		intervalOffsets = numpy.arange(self.samplesPerInterval)
+		twiddles = numpy.exp(-2j * numpy.pi * ((self.bins[:, None] * intervalOffsets) % samplesPerFrame) / samplesPerFrame)
+		intervalStarts = numpy.arange(intervalCount) * self.samplesPerInterval
+		intervalPhases = numpy.exp(-2j * numpy.pi * ((self.bins[:, None] * intervalStarts) % samplesPerFrame) / samplesPerFrame)
+
+		counter = 0
+		maxCounter = "?"	# Unknown when streaming
+		if not self.isStreaming():
+			maxCounter = self.getFrameCount()
+		for frameSamples in self.getFrameSamples(samplesPerFrame, self.getFrameStep()):
+			counter += 1
+			print("Processing Frame: %s / %s" % (counter, maxCounter))
+
+			intervals = numpy.reshape(frameSamples[:intervalCount * self.samplesPerInterval], (intervalCount, self.samplesPerInterval))
+			intervalDFTs = (twiddles.real @ intervals.T + 1j * (twiddles.imag @ intervals.T)) * intervalPhases
+			# Column i is the DFT of the first i + 1 intervals, ie. of window i
+			magnitudes = numpy.abs(numpy.cumsum(intervalDFTs, axis=1)[:, trimFrames - 1:]).T
+			for d2Row in numpy.diff(magnitudes, axis=0):
+				yield d2Row
 
 class RecursiveGenerator:
 	def __init__(self, samplesPerInterval, intervalsPerFrame, waveform):
@@ -0,0 +1,91 @@
+import numpy
+
+# Estimates how offtune a song is: the ratio of the frequencies its notes are played at to the frequencies of the notes.
+# The assumption is that all notes of a section of a song are offtune by a similar amount.
+
+# Number of notes the tuning is averaged over. Twice as many of the strongest peaks are matched to notes and the half
+# that deviates the most is left out.
+REFERENCE_NOTE_COUNT = 6
+# Most a section's tuning may differ from that of the whole song, relatively. The peaks of a single frame can be too few
+# to tell the tuning by more than this.
+MAX_SECTION_DEVIATION = 0.005
+
+
+# Estimates how offtune the peaks of a magnitude spectrum are. The spectrum is the first half of an FFT of fftLength
+# samples and noteFrequencies are the sorted frequencies of all notes. Returns None if the spectrum has too few peaks.
+def estimateOutOfTune(spectrum, sampleRate, fftLength, noteFrequencies):
+	spectrum = numpy.asarray(spectrum)
+	localMax = numpy.flatnonzero((spectrum[1:-1] > spectrum[:-2]) & (spectrum[1:-1] > spectrum[2:])) + 1
+	# Strongest peaks first, peaks of equal magnitude in bin order
+	localMax = localMax[numpy.argsort(-spectrum[localMax], kind='stable')]
+
+	# Each peak is matched to the closest note, of the notes below and above its frequency.
+	frequencies = localMax * sampleRate / fftLength
+	lower = numpy.clip(numpy.searchsorted(noteFrequencies, frequencies, side='right') - 1, 0, len(noteFrequencies) - 2)
+	lowerNotePercent = frequencies / noteFrequencies[lower]
+	higherNotePercent = noteFrequencies[lower + 1] / frequencies
+	closestNotes = numpy.where(lowerNotePercent < higherNotePercent, lower, lower + 1)
+	percentDiffs = numpy.where(lowerNotePercent < higherNotePercent, lowerNotePercent, 1 / higherNotePercent)
+
+	# Only the strongest peak of each note is taken
+	_, firstPeaks = numpy.unique(closestNotes, return_index=True)
+	firstPeaks = numpy.sort(firstPeaks)[:REFERENCE_NOTE_COUNT * 2 + 1]
+	if len(firstPeaks) <= REFERENCE_NOTE_COUNT * 2:
+		return None
+	percentDiffs = percentDiffs[firstPeaks].tolist()
+
+	# Remove the notes that increase deviation within the set the most
+	for i in range(REFERENCE_NOTE_COUNT):
+		avg = sum(percentDiffs) / len(percentDiffs)
+		percentDiffs.sort(key=lambda x: abs(x - avg))
+		percentDiffs = percentDiffs[:-1]
+	return sum(percentDiffs) / len(percentDiffs)
+
+
+# Tuning of each section of a song, estimated from the rows a ColumnManager processes as they arrive.
+# A section is the rows of one frame of the row generator. The rows of a frame are the differences between the
+# spectra of its growing windows, so they add up to the spectrum of the whole frame (less that of its first few
+# intervals), which is peak picked once the section's last row arrived.
+# The rows of a section are all in before the first of them reaches the processing index of the column processors,
+# see ColumnManager.retune.
+# Sections with too few peaks to estimate their tuning, or estimated to be tuned more than MAX_SECTION_DEVIATION from
+# referenceOutOfTune, the tuning of the whole song, take the tuning of the whole song.
+class TuningCurve:
+	def __init__(self, rowsPerSection, sampleRate, samplesPerFrame, noteFrequencies, referenceOutOfTune, tunings=None):
+		self.rowsPerSection = rowsPerSection
+		self.sampleRate = sampleRate
+		self.samplesPerFrame = samplesPerFrame
+		self.noteFrequencies = numpy.array(sorted(noteFrequencies))
+		self.referenceOutOfTune = referenceOutOfTune
+		self.complete = tunings is not None	# Loaded tunings are not added to
+		self.tunings = [] if tunings is None else list(tunings)
+		self.rowCount = 0
+		self.spectrum = None
+
+	# Adds the rowIndex-th row of the song. Rows are only taken in once, so managers sharing a curve may all add them.
+	def addRow(self, rowIndex, row):
+		if self.complete or rowIndex != self.rowCount:
+			return
+		self.rowCount += 1
+		if self.spectrum is None:
+			self.spectrum = numpy.array(row, dtype=numpy.float64)
+		else:
+			self.spectrum += row
+		if self.rowCount % self.rowsPerSection == 0:
+			outOfTune = estimateOutOfTune(self.spectrum, self.sampleRate, self.samplesPerFrame, self.noteFrequencies)
+			if outOfTune is None:
+				outOfTune = self.referenceOutOfTune
+			self.tunings.append(outOfTune)
+			self.spectrum = None
+
+	# Tuning of the section holding the rowIndex-th row, or of the last section estimated so far.
+	def getOutOfTune(self, rowIndex):
+		if not self.tunings:
+			return self.referenceOutOfTune
+		outOfTune = self.tunings[min(max(rowIndex, 0) // self.rowsPerSection, len(self.tunings) - 1)]
+		if abs(outOfTune / self.referenceOutOfTune - 1) > MAX_SECTION_DEVIATION:
+			return self.referenceOutOfTune
+		return outOfTune
+
+	def getTunings(self):
+		return numpy.array(self.tunings)
@@ -1,122 +1,182 @@
-import copy
+import numpy
+
+from noteProcessors.discreteNoteProcessor.shapeIndex import ShapeIndex
+from noteProcessors.discreteNoteProcessor.shapeRuns import ShapeRuns
+from noteProcessors.discreteNoteProcessor.shapeStore import ShapeStore
 
 # FrequencyTimeShape describes a cluster of points deemed to represent a single note.
-# The points are stored in the class and so are some of its calculated properties.
+# The points and magnitudes of the shape are stored in a ShapeStore, and so are some of its calculated properties.
+# Main and auxiliary points are each ordered by time index in the store.
+# Properties are calculated on construction if frequencyTimeArray is given. Otherwise they are left to
+# ShapeStore.calculateProperties, which calculates them for many shapes at once.
 # TODO: should split this class into its own base class
 class FrequencyTimeShape:
-	def __init__(self, points, auxiliaryPoints, frequencyTimeArray, magnitudeByTime=[]):
+	__slots__ = ["store", "pointRange", "auxiliaryRange", "magnitudeRange", "centerOfMass", "magnitude", "timeIndexStart",
+		"timeIndexEnd", "isBaseCandidate", "usedAsHarmonic", "harmonicCount", "reconsolidatedShape"]
 
-		self.points = points	# Main points that the shape contains
-		self.auxiliaryPoints = auxiliaryPoints	# Auxiliary set of points that the shape may contain
+	def __init__(self, store, pointRange, auxiliaryRange, frequencyTimeArray=None, magnitudeRange=None):
+		self.store = store	# ShapeStore holding the points and magnitudes of the shape
+		self.pointRange = pointRange	# Range of the store holding the main points that the shape contains
+		self.auxiliaryRange = auxiliaryRange	# Range of the store holding the auxiliary set of points that the shape may contain
 		self.centerOfMass = None	# Center of mass of all points (for frequency only)
 		self.magnitude = None	# Arbitrary value to denote overall magnitude of shape
 		self.timeIndexStart = None	# First time index of all points
 		self.timeIndexEnd = None	# Last time index of all points
 		self.isBaseCandidate = True	# If this note qualifies as a base note (ie. not a harmonic)
-		self.usedAsHarmonic = []	# Array to keep track of which shape each time index of this shape is a harmonic for.
+		self.usedAsHarmonic = None	# Number of shapes each time index of this shape is a harmonic for. Allocated on first use.
 		self.harmonicCount = 0	# Number of harmonics detected when this shape is used as base frequency.
-		self.magnitudeByTime = magnitudeByTime	# Magnitude over time indices. Index 0 here corresponds to timeIndexStart of main array
+		self.magnitudeRange = magnitudeRange	# Range of the store holding the magnitude over time indices
 		self.reconsolidatedShape = False	# This is used in edge case of restructing the shape internally. TODO: make less hacky
-		if self.magnitudeByTime:
+		if self.magnitudeRange is not None:
 			self.reconsolidatedShape = True
-		self.calculateProperties(frequencyTimeArray)
+		if frequencyTimeArray is not None:
+			self.calculateProperties(frequencyTimeArray)
+
+	# Main points as a list of [timeIndex, frequencyIndex]
+	@property
+	def points(self):
+		return self.store.getPoints(self.pointRange)
+
+	@property
+	def auxiliaryPoints(self):
+		return self.store.getPoints(self.auxiliaryRange)
+
+	# Magnitude over time indices. Index 0 here corresponds to timeIndexStart of main array.
+	# A view of the store, so it is written to in place.
+	@property
+	def magnitudeByTime(self):
+		return self.store.magnitudes[self.magnitudeRange[0]: self.magnitudeRange[1]]
 
 	def calculateProperties(self, frequencyTimeArray):
-		timeIndices = [p[0] for p in self.points]
-		self.timeIndexStart = min(timeIndices)
-		self.timeIndexEnd = max(timeIndices)
-
-		if not self.reconsolidatedShape:	# MagnitudeByTime will not be recalculated
-			self.magnitudeByTime = [0 for i in range(self.timeIndexStart, self.timeIndexEnd + 1)]
-		self.usedAsHarmonic = [[] for i in range(self.timeIndexStart, self.timeIndexEnd + 1)]
-
-		totalMagnitude = 0
-		weightedMagnitude = 0
-		allPoints = copy.deepcopy(self.points)
-		allPoints.extend(self.auxiliaryPoints)
-		for p in allPoints:
-			# We reduce the magnitude of each column by what we think is the noise
-			magnitude = frequencyTimeArray[p[0]][p[1]]
-			weightedMagnitude += p[1] * magnitude 
-			totalMagnitude += magnitude
-			if not self.reconsolidatedShape:	# MagnitudeByTime will not be recalculated
-				self.magnitudeByTime[p[0] - self.timeIndexStart] += magnitude
-
-
-		self.centerOfMass = weightedMagnitude / totalMagnitude
-		self.magnitude = sum(self.magnitudeByTime) / len(self.magnitudeByTime)
+		self.store.calculateProperties([self], frequencyTimeArray)
 
 	def print(self):
 		print("com: %s" % self.centerOfMass)
 		print("index: %d - %d" % (self.timeIndexStart, self.timeIndexEnd))
-		print(self.magnitudeByTime)
+		print(self.magnitudeByTime.tolist())
 
 	# This function is called when another shape uses this one as a harmonic.
 	# If more than half of this shape's time duration is used as a harmonic, this shape is no longer a base frequency candidate.
 	def updateBaseCandidate(self, startIndex, endIndex, shape):
-		for i in range(startIndex, endIndex + 1):
-			self.usedAsHarmonic[i - self.timeIndexStart].append(shape)
-		if len(self.usedAsHarmonic) < len([x for x in self.usedAsHarmonic if x != []]) * 2:
+		if self.usedAsHarmonic is None:
+			self.usedAsHarmonic = numpy.zeros(self.timeIndexEnd - self.timeIndexStart + 1, dtype=numpy.int32)
+		self.usedAsHarmonic[startIndex - self.timeIndexStart: endIndex - self.timeIndexStart + 1] += 1
+		if len(self.usedAsHarmonic) < numpy.count_nonzero(self.usedAsHarmonic) * 2:
 			self.isBaseCandidate = False
 
 	def getEndingPoints(self):
-		return [p for p in self.points if p[0] == self.timeIndexEnd]
+		return self.store.getPoints(self.store.getTimeRange(self.pointRange, self.timeIndexEnd, self.timeIndexEnd))
+
+	# Shape of the points of this shape within time indices startIndex..endIndex. It shares the ranges of the store of
+	# this shape, magnitudes included.
+	def getSubShape(self, startIndex, endIndex, frequencyTimeArray=None):
+		magnitudeStart = self.magnitudeRange[0] - self.timeIndexStart
+		return FrequencyTimeShape(self.store, self.store.getTimeRange(self.pointRange, startIndex, endIndex),
+			self.store.getTimeRange(self.auxiliaryRange, startIndex, endIndex), frequencyTimeArray,
+			(magnitudeStart + startIndex, magnitudeStart + endIndex + 1))
+
+	# Copy of this shape in another store, with its points, magnitudes and properties.
+	def getCopy(self, store):
+		shape = FrequencyTimeShape(store, store.addPointArray(self.store.points[self.pointRange[0]: self.pointRange[1]]),
+			store.addPointArray(self.store.points[self.auxiliaryRange[0]: self.auxiliaryRange[1]]), None, store.addMagnitudes(self.magnitudeByTime))
+		for attribute in ["centerOfMass", "magnitude", "timeIndexStart", "timeIndexEnd", "isBaseCandidate", "usedAsHarmonic",
+				"harmonicCount", "reconsolidatedShape"]:
+			setattr(shape, attribute, getattr(self, attribute))
+		return shape
 
+	# Shape of the points of this shape followed by those of nextShape, which starts after this shape ends.
+	# Magnitudes are carried over to preserve combined harmonics.
+	def getJoinedShape(self, nextShape, frequencyTimeArray):
+		magnitudes = numpy.concatenate((self.magnitudeByTime, nextShape.magnitudeByTime))
+		if magnitudes.sum() < 0:
+			magnitudes[:] = 0
+		return FrequencyTimeShape(self.store, self.store.joinPoints([self.pointRange, nextShape.pointRange]),
+			self.store.joinPoints([self.auxiliaryRange, nextShape.auxiliaryRange]), frequencyTimeArray,
+			self.store.addMagnitudes(magnitudes))
+
+# Shapes are found in two stages: getUnconsolidatedShapeList finds them, then consolidateShapeList filters and reshapes
+# them with thresholds relative to the loudest of them. When the array is processed in tiles (see TiledShapeFinder),
+# the largest local maximum and the loudness threshold are taken from the whole array and set on the strategy.
 class BaseShapeStrategy:
-	def __init__(self, sampleRate, intervalsPerSecond):
+	MAX_INCREMENT = 1.41	# Arbitrary number indicating the relative difference between elements of the same shape
+	LOUDEST_SHAPES = 150	# Loudest shapes the loudness threshold is taken from
+
+	# shapeExtraction is how shapes are found from local maxima:
+	# "walk": getShape is called for each local maximum
+	# "runs": shapes of all local maxima are found at once, see ShapeRuns. getShape is only called for the few shapes
+	# that run into points of shapes found before.
+	# "check": both, asserting they find the same shapes
+	def __init__(self, sampleRate, intervalsPerSecond, shapeExtraction="runs"):
+		assert shapeExtraction in ["walk", "runs", "check"]
 		self.sampleRate = sampleRate
 		self.intervalsPerSecond = intervalsPerSecond
-		self.usedPointsCache = None
+		self.shapeExtraction = shapeExtraction
+		self.shapeIndex = None	# Shapes owning each point of the array, see ShapeIndex
+		self.shapeStore = None	# Points and magnitudes of all shapes, see ShapeStore
+		self.frequencyTimeArray = None	# The array shapes are taken from, as a numpy array
+		self.largestLocalMaximum = None	# Local maxima are filtered relative to this instead of the largest of the array
+		self.loudnessThreshold = None	# Shapes are consolidated relative to this instead of the loudest of the array
 
-	# Diagonals count for local maximum
+	# Local maxima of d2Array, as an array of row indices and an array of column indices in row major order.
+	# Diagonals count for local maximum. Every cell is compared with the 8 shifted views of its neighbours at once.
 	def get2dLocalMaxima(self, d2Array):
-		maxima = []
-		for i in range(1, len(d2Array) - 1):
-			for j in range(1, len(d2Array[0]) - 1):
-				if (d2Array[i][j] > d2Array[i - 1][j] and 
-				d2Array[i][j] > d2Array[i + 1][j] and 
-				d2Array[i][j] > d2Array[i][j - 1] and 
-				d2Array[i][j] > d2Array[i][j + 1] and 
-				d2Array[i][j] > d2Array[i - 1][j - 1] and 
-				d2Array[i][j] > d2Array[i - 1][j + 1] and 
-				d2Array[i][j] > d2Array[i + 1][j - 1] and 
-				d2Array[i][j] > d2Array[i + 1][j + 1]):
-					maxima.append((i, j))
-		return maxima
+		d2Array = numpy.asarray(d2Array, dtype=numpy.float64)
+		rowCount, columnCount = d2Array.shape
+		center = d2Array[1: rowCount - 1, 1: columnCount - 1]
+		isMaximum = numpy.ones(center.shape, dtype=bool)
+		for rowShift in (-1, 0, 1):
+			for columnShift in (-1, 0, 1):
+				if rowShift != 0 or columnShift != 0:
+					isMaximum &= center > d2Array[1 + rowShift: rowCount - 1 + rowShift, 1 + columnShift: columnCount - 1 + columnShift]
+		rows, columns = numpy.nonzero(isMaximum)
+		return rows + 1, columns + 1
 
 	# filterIntensity is percent of max magnitude to be used as filtering criteria
 	def filter2dLocalMaximaByFraction(self, d2Array, localMaxima, filterIntensity):
-		largestMagnitude = max([d2Array[m[0]][m[1]] for m in localMaxima])
-		filteredByMagnitude = [m for m in localMaxima if d2Array[m[0]][m[1]] > largestMagnitude / filterIntensity]
-		return filteredByMagnitude
+		rows, columns = localMaxima
+		magnitudes = numpy.asarray(d2Array, dtype=numpy.float64)[rows, columns]
+		largestMagnitude = magnitudes.max() if self.largestLocalMaximum is None else self.largestLocalMaximum
+		filteredByMagnitude = magnitudes > largestMagnitude / filterIntensity
+		return rows[filteredByMagnitude], columns[filteredByMagnitude]
 
 	def getD2arrayAverage(self, d2Array):
-		rowAverage = [sum(d2Array[i]) / len(d2Array[i]) for i in range(len(d2Array))]
-		average = sum(rowAverage) / len(rowAverage)
-		return average
+		return numpy.asarray(d2Array, dtype=numpy.float64).mean(axis=1).mean()
 
 	def filter2dLocalMaximaByThreshhold(self, d2Array, localMaxima, threshold):
-		filteredByMagnitude = [m for m in localMaxima if d2Array[m[0]][m[1]] > threshold]
-		return filteredByMagnitude
+		rows, columns = localMaxima
+		filteredByMagnitude = numpy.asarray(d2Array, dtype=numpy.float64)[rows, columns] > threshold
+		return rows[filteredByMagnitude], columns[filteredByMagnitude]
+
+	# Local maxima bigger than largest / filterIntensity of the largest maximum and than threshold, as a list of (row, column).
+	# The array is converted once for all the stages.
+	def getFilteredLocalMaxima(self, d2Array, filterIntensity=None, threshold=None):
+		d2Array = numpy.asarray(d2Array, dtype=numpy.float64)
+		localMaxima = self.get2dLocalMaxima(d2Array)
+		if filterIntensity is not None and len(localMaxima[0]) > 0:
+			localMaxima = self.filter2dLocalMaximaByFraction(d2Array, localMaxima, filterIntensity)
+		if threshold is not None:
+			localMaxima = self.filter2dLocalMaximaByThreshhold(d2Array, localMaxima, threshold)
+		return list(zip(localMaxima[0].tolist(), localMaxima[1].tolist()))
 
 	# This function will get the shape for a given maximum.
 	# This function uses only heuristics, and does not have full logical coverage for all possible cases.
 	# This function is the core of this note processor's idea and will be improved over time.
+	# d2Array is a numpy array. Elements are read one at a time as Python floats.
 	def getShape(self, lm, d2Array, isOriginalLm = True):
 		points = [lm]
 		# Search down
 		y, x = lm
-		currentValue = d2Array[y][x]
+		currentValue = d2Array.item(y, x)
 		lmValue = currentValue
 		halfCache = 0	# Used to store value of element when the value halfsizes
-		maxIncrement = 1.41	# Arbitrary number indicating the relative difference between elements of the same shape
+		maxIncrement = BaseShapeStrategy.MAX_INCREMENT
 		while True:
 			y += 1
 			if y >= len(d2Array):
 				break
-			if self.usedPointsCache[y][x]:	# Element already used in another shape
+			if self.shapeIndex.isUsed(y, x):	# Element already used in another shape
 				break
-			newValue = d2Array[y][x]
+			newValue = d2Array.item(y, x)
 			if halfCache != 0 and currentValue < halfCache / maxIncrement: # Conditional end of current shape
 				break
 			if newValue < currentValue / (maxIncrement ** 2): # End of current shape
@@ -134,15 +194,15 @@ class BaseShapeStrategy:
 			currentValue = newValue
 		# Search up
 		y, x = lm
-		currentValue = d2Array[y][x]
+		currentValue = d2Array.item(y, x)
 		halfCache = 0
 		while True:
 			y -= 1
 			if y < 0:
 				break
-			if self.usedPointsCache[y][x]:
+			if self.shapeIndex.isUsed(y, x):
 				break
-			newValue = d2Array[y][x]
+			newValue = d2Array.item(y, x)
 			if newValue < currentValue / 2:
 				break
 			points.append((y, x))
@@ -153,13 +213,13 @@ class BaseShapeStrategy:
 			# be discarded again
 
 		# Sum the points in the current column and the left and right adjacent columns
-		currentColumnSum = sum([d2Array[y][x] for (y, x) in points])
+		currentColumnSum = sum([d2Array.item(y, x) for (y, x) in points])
 		rightColumnSum = 1
 		if points[0][1] < len(d2Array[0]) - 1:
-			rightColumnSum = sum([d2Array[y][x + 1] for (y, x) in points])
+			rightColumnSum = sum([d2Array.item(y, x + 1) for (y, x) in points])
 		leftColumnSum = 1
 		if points[0][1] > 1:
-			leftColumnSum = sum([d2Array[y][x - 1] for (y, x) in points])
+			leftColumnSum = sum([d2Array.item(y, x - 1) for (y, x) in points])
 
 		greaterSum = max(leftColumnSum, rightColumnSum)
 		greaterColumn = -1
@@ -167,7 +227,7 @@ class BaseShapeStrategy:
 			greaterColumn = 1
 
 		if greaterSum > currentColumnSum:
-			if [self.usedPointsCache[y][x + greaterColumn] for (y, x) in points if self.usedPointsCache[y][x + greaterColumn]]:
+			if any([self.shapeIndex.isUsed(y, x + greaterColumn) for (y, x) in points]):
 			# If either adjacent column is dominating and is a shape, shape would have branched out from that column.
 				return None, None
 			else:
@@ -178,8 +238,8 @@ class BaseShapeStrategy:
 				maxValue = 0
 				# Look for the largest element on the larger column. Not necessarily a local max.
 				for (y, x) in points:
-					if d2Array[y][x + greaterColumn] > maxValue:
-						maxValue = d2Array[y][x + greaterColumn]
+					if d2Array.item(y, x + greaterColumn) > maxValue:
+						maxValue = d2Array.item(y, x + greaterColumn)
 						newLm = (y, x + greaterColumn)
 				return self.getShape(newLm, d2Array, isOriginalLm=False)
 
@@ -190,28 +250,91 @@ class BaseShapeStrategy:
 
 		return points, auxiliaryPoints
 
+	# Shape of the i-th local maximum lm, from shapeRuns unless getShape has to find it. Returns None if there is none.
+	def extractShape(self, shapeRuns, i, lm, d2Array):
+		status = ShapeRuns.WALK if shapeRuns is None else shapeRuns.getStatus(i, self.shapeIndex.labels.ravel())
+		if status == ShapeRuns.WALK:
+			points, auxiliaryPoints = self.getShape(lm, d2Array)
+			return self.createShape(points, auxiliaryPoints) if points else None
+		if status == ShapeRuns.OWN:
+			pointRange, auxiliaryRange = shapeRuns.getPointRanges(i)
+		if self.shapeExtraction == "check":
+			walkedPoints, walkedAuxiliaryPoints = self.getShape(lm, d2Array)
+			if status == ShapeRuns.NONE:
+				assert walkedPoints is None, "Walked shape of %s is not found from runs" % (lm,)
+			else:
+				# Points of the store are ordered by time index
+				assert sorted(walkedPoints, key=lambda p: p[0]) == [tuple(p) for p in self.shapeStore.getPoints(pointRange)] and \
+					sorted(walkedAuxiliaryPoints, key=lambda p: p[0]) == [tuple(p) for p in self.shapeStore.getPoints(auxiliaryRange)], \
+					"Shape of %s differs from the walked shape" % (lm,)
+		if status == ShapeRuns.NONE:
+			return None
+		return FrequencyTimeShape(self.shapeStore, pointRange, auxiliaryRange)
+
+	# Shape of the given lists of (timeIndex, frequencyIndex), stored in the shapeStore. Its properties are left to be
+	# calculated, see ShapeStore.calculateProperties.
+	def createShape(self, points, auxiliaryPoints):
+		return FrequencyTimeShape(self.shapeStore, self.shapeStore.addPoints(points), self.shapeStore.addPoints(auxiliaryPoints))
+
 	def getShapeList(self, d2Array):
-		# Get all local maxima of the array which are bigger than average. (below average is defnitely noise)
-		localMaxima = self.get2dLocalMaxima(d2Array)
-		average = self.getD2arrayAverage(d2Array)
-		localMaxima = self.filter2dLocalMaximaByFraction(d2Array, localMaxima, 100)
+		return self.consolidateShapeList(self.getUnconsolidatedShapeList(d2Array), d2Array)
+
+	def getUnconsolidatedShapeList(self, d2Array):
+		self.frequencyTimeArray = numpy.asarray(d2Array, dtype=numpy.float64)
+		# Get all local maxima of the array which are bigger than a fraction of the largest one.
+		localMaxima = self.getFilteredLocalMaxima(self.frequencyTimeArray, filterIntensity=100)
 
 		shapeList = []
-		self.usedPointsCache = [[[] for i in range(len(d2Array[0]))] for i in range(len(d2Array))]
+		self.shapeIndex = ShapeIndex(len(d2Array), len(d2Array[0]))
+		self.shapeStore = ShapeStore()
+		shapeRuns = None
+		if self.shapeExtraction != "walk":
+			shapeRuns = ShapeRuns(self.frequencyTimeArray, localMaxima, BaseShapeStrategy.MAX_INCREMENT)
+			shapeRuns.storePoints(self.shapeStore)
 
 		# Iterate through all localMaxima and tries to derive a shape from each.
-		for lm in localMaxima:
+		for i, lm in enumerate(localMaxima):
 			# lm already part of another shape. continue
-			if self.usedPointsCache[lm[0]][lm[1]]:
+			if self.shapeIndex.isUsed(lm[0], lm[1]):
 				continue
-			points, auxiliaryPoints = self.getShape(lm, d2Array)
-			if points:
-				shape = FrequencyTimeShape(points, auxiliaryPoints, d2Array)
+			shape = self.extractShape(shapeRuns, i, lm, self.frequencyTimeArray)
+			if shape is not None:
 				shapeList.append(shape)
 
-				for point in points:
-					self.usedPointsCache[point[0]][point[1]].append(shape)
+				self.shapeIndex.addShape(shape)
 
+		self.shapeStore.calculateProperties(shapeList, self.frequencyTimeArray)
 		return shapeList
 
+	def consolidateShapeList(self, shapeList, d2Array):
+		return shapeList
+
+	# Largest magnitude over time of each of the LOUDEST_SHAPES loudest base candidates, loudest first
+	def getLoudestMagnitudes(self, shapeList):
+		maxMagnitudePerShape = [max(shape.magnitudeByTime) for shape in shapeList if shape.isBaseCandidate]
+		maxMagnitudePerShape.sort(key=lambda x: -x)
+		return maxMagnitudePerShape[:BaseShapeStrategy.LOUDEST_SHAPES]
+
+	# Sets some arbitrary global thresholds that dictate what is audible and what is not.
+	# In the future, the goal is to use both local and global measurements to determine this.
+	@staticmethod
+	def getLoudnessThreshold(loudestMagnitudes):
+		loudestMagnitudes = sorted(loudestMagnitudes, key=lambda x: -x)
+		return sum(loudestMagnitudes[50:BaseShapeStrategy.LOUDEST_SHAPES]) / 100
+
+	# Copies of shapes of this strategy in a new store that holds nothing else, eg. to send them to another process.
+	def copyShapeList(self, shapeList):
+		store = ShapeStore()
+		return [shape.getCopy(store) for shape in shapeList]
+
+	# Consolidates the shapes getUnconsolidatedShapeList found in d2Array, with another strategy. shapeList is a copy,
+	# see copyShapeList.
+	def consolidateCopiedShapeList(self, shapeList, d2Array):
+		self.frequencyTimeArray = numpy.asarray(d2Array, dtype=numpy.float64)
+		self.shapeStore = shapeList[0].store if shapeList else ShapeStore()
+		self.shapeIndex = ShapeIndex(len(d2Array), len(d2Array[0]))
+		for shape in shapeList:
+			self.shapeIndex.addShape(shape)
+		return self.consolidateShapeList(shapeList, d2Array)
+
 
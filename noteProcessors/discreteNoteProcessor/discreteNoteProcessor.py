@@ -1,35 +1,32 @@
 from collections import defaultdict
-from numpy import fft
+
+import numpy
 
 from activeNote import ActiveNote
 from noteProcessors.abstractNoteProcessor import AbstractNoteProcessor
 from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy
 from noteProcessors.discreteNoteProcessor.shapeStrategies import FilterShapeStrategy
+from noteProcessors.discreteNoteProcessor.spectrogram import Spectrogram
+from noteProcessors.discreteNoteProcessor.tiledShapeFinder import TiledShapeFinder
 import utils
 
 
 
-# An interval property holds information regarding a segment of data samples,
-# including the fourier transform and the time it corresponds to.
-class IntervalProperty:
-	def __init__(self, fourierTransform):
-		self.fourierTransform = fourierTransform
-		self.startTime = None
-		self.endTime = None
-
-	def setTimeRange(self, startTime, endTime):
-		self.startTime = startTime
-		self.endTime = endTime
-
-
 # This note processor strategy uses a non-continuous way to find notes.
 # The original sound samples are split into numerous time-chunks.
 # Frequency is calculated within each time chunk and visualised/analysed using a 2d array.
 # The analysis/processing strategy within the 2d array is isolated in class ShapeStrategy
 
 class DiscreteNoteProcessor(AbstractNoteProcessor):
-	def __init__(self, waveform, sampleRate, noteParser=None, shapeStrategy=None):
-		super(DiscreteNoteProcessor, self).__init__(waveform, sampleRate, noteParser)
+	# Seconds each tile is extended by on both sides, see TiledShapeFinder. Covers all but the longest shapes.
+	TILE_HALO_SECONDS = 4
+
+	# shapeExtraction is how the shape strategy finds shapes, see BaseShapeStrategy.
+	# tileSeconds processes the spectrogram in tiles of that many seconds, on tileWorkers processes (one per core if None),
+	# instead of all at once, see TiledShapeFinder. The spectrogram is then neither cached nor plotted.
+	def __init__(self, waveform, sampleRate, noteParser=None, shapeStrategy=None, artifacts=None, decimationFactor=1, shapeExtraction="runs",
+			tileSeconds=None, tileWorkers=None):
+		super(DiscreteNoteProcessor, self).__init__(waveform, sampleRate, noteParser, artifacts, decimationFactor)
 
 		# Number of intervals per second
 		# Too high means inaccurate perceived frequencies, too low means inacurate time periods
@@ -40,7 +37,14 @@ class DiscreteNoteProcessor(AbstractNoteProcessor):
 		# it could give us better time and frequency precision
 
 		self.samplesPerInterval = int(self.sampleRate / self.intervalsPerSecond)	# Note that intervalsPerSecond is approximate value
-		self.shapeStrategy = shapeStrategy(self.sampleRate, self.samplesPerInterval) or FilterShapeStrategy(self.sampleRate, self.samplesPerInterval)
+		self.shapeStrategy = (shapeStrategy or FilterShapeStrategy)(self.sampleRate, self.samplesPerInterval, shapeExtraction=shapeExtraction)
+		self.tiledShapeFinder = None
+		if tileSeconds is not None:
+			self.tiledShapeFinder = TiledShapeFinder(type(self.shapeStrategy), self.sampleRate, self.samplesPerInterval,
+				max(1, round(tileSeconds * self.intervalsPerSecond)), round(DiscreteNoteProcessor.TILE_HALO_SECONDS * self.intervalsPerSecond),
+				tileWorkers, shapeExtraction)
+		self.spectrogram = Spectrogram(self.sampleRate, self.samplesPerInterval)
+		self.intervalTimes = None	# Start time of each interval, set once the intervals are transformed
 
 
 
@@ -57,36 +61,22 @@ class DiscreteNoteProcessor(AbstractNoteProcessor):
 			# Creates a note with start and end times. Loudness is approximated here.
 			# TODO: Find the exact relation between loudness & velocity of note (as used by midi files)
 			a = ActiveNote(closestNote, 
-				shape.timeIndexStart * self.samplesPerInterval / self.sampleRate, 
-				shape.timeIndexEnd * self.samplesPerInterval / self.sampleRate, 
+				self.intervalTimes[shape.timeIndexStart].item(), 
+				self.intervalTimes[shape.timeIndexEnd].item(), 
 				(shape.magnitude ** 0.5 / largestMagnitude ** 0.5) * 100)
 			activeNotes.append(a)
 
 		return activeNotes
 
 
-	def getIntervalProperty(self, interval):
-		return IntervalProperty(fft.fft(interval))
-
-	def getIntervalPropertyList(self, waveform):
-		# Split entire waveform into several "intervals" by time.
-		intervalPropertyList = []
-		for i in range(0, int(len(waveform) / self.samplesPerInterval)):
-			startIndex = i * self.samplesPerInterval
-			endIndex = (i + 1) * self.samplesPerInterval
-			intervalProperty = self.getIntervalProperty(waveform[startIndex : endIndex])
-			intervalProperty.setTimeRange(startIndex / self.sampleRate, endIndex / self.sampleRate)
-			intervalPropertyList.append(intervalProperty)
-
-		return intervalPropertyList
-
-
-	def getActiveNotesFromIntervalPropertyList(self, intervalPropertyList):
-		timeFrequencyArray = []
-		for intervalProperty in intervalPropertyList:
-			modifiedFourierTransform = [abs(a) for a in intervalProperty.fourierTransform][: self.samplesPerInterval // 2]
-			timeFrequencyArray.append(modifiedFourierTransform)
+	# Magnitude spectrum of each interval the waveform is split into by time, one row per interval.
+	# sampleOffset is where the first interval starts. The waveform is sliced a batch of intervals at a time, so a lazily
+	# decoded waveform is read block by block.
+	def getTimeFrequencyArray(self, waveform, sampleOffset=0):
+		timeFrequencyArray, self.intervalTimes = self.spectrogram.compute(waveform, sampleOffset)
+		return timeFrequencyArray
 
+	def getActiveNotesFromTimeFrequencyArray(self, timeFrequencyArray):
 		shapeList = self.shapeStrategy.getShapeList(timeFrequencyArray)
 
 		# Debug plots.
@@ -94,13 +84,12 @@ class DiscreteNoteProcessor(AbstractNoteProcessor):
 		# shape.png will store the filtered list of "shapes" from the original frequency vales.
 		# A shape is a consecutive cluster of 2dArray elements that will be grouped into one note.
 		utils.d2Plot(timeFrequencyArray, "out/values.png")
-		shapeArray = [[0 for i in range(len(timeFrequencyArray[0]))] for j in range(len(timeFrequencyArray))]
+		shapeArray = numpy.zeros(numpy.shape(timeFrequencyArray))
 		for shape in shapeList:
 			if shape.isBaseCandidate:
 				freq = int(round(shape.centerOfMass))
-				for i in range(len(shape.magnitudeByTime)):
-					if shapeArray[i + shape.timeIndexStart][freq] < shape.magnitudeByTime[i]:
-						shapeArray[i + shape.timeIndexStart][freq] = shape.magnitudeByTime[i]
+				column = shapeArray[shape.timeIndexStart: shape.timeIndexStart + len(shape.magnitudeByTime), freq]
+				numpy.maximum(column, shape.magnitudeByTime, out=column)
 		utils.d2Plot(shapeArray, "out/shape.png")
 
 		activeNotes = self.getActiveNotesFromShapeList(shapeList)
@@ -109,5 +98,19 @@ class DiscreteNoteProcessor(AbstractNoteProcessor):
 	def run(self):
 		# Superimpose all channels into one waveform.
 		sampleOffset = round(self.sampleRate * self.offset)
-		intervalPropertyList = self.getIntervalPropertyList(self.waveform[sampleOffset:])
-		return self.getActiveNotesFromIntervalPropertyList(intervalPropertyList)
+		if self.tiledShapeFinder is not None:
+			shapeList = self.tiledShapeFinder.getShapes(self.waveform, sampleOffset)
+			self.intervalTimes = self.spectrogram.getIntervalTimes(self.spectrogram.getIntervalCount(self.waveform, sampleOffset))
+			return self.getActiveNotesFromShapeList(shapeList)
+		timeFrequencyArray = None
+		if self.artifacts is not None:
+			timeFrequencyArray = self.artifacts.load("timeFrequencyArray", samplesPerInterval=self.samplesPerInterval, sampleOffset=sampleOffset,
+				decimationFactor=self.decimationFactor)
+		if timeFrequencyArray is None:
+			timeFrequencyArray = self.getTimeFrequencyArray(self.waveform, sampleOffset)
+			if self.artifacts is not None:
+				self.artifacts.store("timeFrequencyArray", timeFrequencyArray, samplesPerInterval=self.samplesPerInterval, sampleOffset=sampleOffset,
+				decimationFactor=self.decimationFactor)
+		else:
+			self.intervalTimes = self.spectrogram.getIntervalTimes(len(timeFrequencyArray))
+		return self.getActiveNotesFromTimeFrequencyArray(timeFrequencyArray)
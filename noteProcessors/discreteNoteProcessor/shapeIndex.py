@@ -0,0 +1,121 @@
+import bisect
+from collections import defaultdict
+import numpy
+
+# Records which shapes own each point of a time frequency array.
+# Each cell holds the label of its first owner in an integer array, 0 for none. Shapes are numbered in a table as they
+# are first added. The rare cells owned by more than one shape keep their other owners in an overflow dict, in the
+# order they were added, so a cell behaves like the list of its owners.
+class ShapeIndex:
+	def __init__(self, rowCount, columnCount):
+		self.labels = numpy.zeros((rowCount, columnCount), dtype=numpy.int32)
+		self.overflow = {}	# (row, column) -> labels of the owners after the first
+		self.shapes = [None]	# Shape of each label
+		self.shapeLabels = {}	# Label of each shape
+
+	def getLabel(self, shape):
+		label = self.shapeLabels.get(shape)
+		if label is None:
+			label = len(self.shapes)
+			self.shapes.append(shape)
+			self.shapeLabels[shape] = label
+		return label
+
+	# Every shape added so far, including the ones whose points were all removed since
+	def getShapes(self):
+		return self.shapes[1:]
+
+	# True if any shape owns the point
+	def isUsed(self, y, x):
+		return self.labels[y, x] != 0
+
+	# Owners of the point, in the order they were added
+	def get(self, y, x):
+		label = self.labels[y, x]
+		if label == 0:
+			return []
+		shapes = [self.shapes[label]]
+		if (y, x) in self.overflow:
+			shapes.extend([self.shapes[l] for l in self.overflow[(y, x)]])
+		return shapes
+
+	def contains(self, y, x, shape):
+		label = self.shapeLabels.get(shape)
+		if label is None or self.labels[y, x] == 0:
+			return False
+		return self.labels[y, x] == label or label in self.overflow.get((y, x), ())
+
+	def add(self, y, x, shape):
+		label = self.getLabel(shape)
+		if self.labels[y, x] == 0:
+			self.labels[y, x] = label
+		else:
+			self.overflow.setdefault((y, x), []).append(label)
+
+	# Removes one ownership of the point by shape. Raises ValueError if shape does not own the point, like list.remove.
+	def remove(self, y, x, shape):
+		label = self.shapeLabels.get(shape)
+		others = self.overflow.get((y, x))
+		if label is not None and self.labels[y, x] == label:
+			if others:
+				self.labels[y, x] = others.pop(0)
+				if not others:
+					del self.overflow[(y, x)]
+			else:
+				self.labels[y, x] = 0
+		elif others and label in others:
+			others.remove(label)
+			if not others:
+				del self.overflow[(y, x)]
+		else:
+			raise ValueError("Shape does not own point (%d, %d)" % (y, x))
+
+	# Adds the main points of shape
+	def addShape(self, shape):
+		label = self.getLabel(shape)
+		for y, x in shape.points:
+			if self.labels[y, x] == 0:
+				self.labels[y, x] = label
+			else:
+				self.overflow.setdefault((y, x), []).append(label)
+
+	# Removes the main points of shape
+	def removeShape(self, shape):
+		for y, x in shape.points:
+			self.remove(y, x, shape)
+
+
+# Shapes ordered by their center of mass, to look up the shapes around a frequency that overlap a range of time indices.
+# Shapes are filed under every block of BLOCK_INTERVALS time indices they overlap, and ordered by center of mass within
+# a block, so a query bisects the few blocks its time range covers.
+class FrequencyIndex:
+	BLOCK_INTERVALS = 16
+
+	def __init__(self, shapes):
+		blocks = defaultdict(list)
+		for shape in shapes:
+			for block in range(shape.timeIndexStart // FrequencyIndex.BLOCK_INTERVALS, shape.timeIndexEnd // FrequencyIndex.BLOCK_INTERVALS + 1):
+				blocks[block].append(shape)
+		self.blocks = {}
+		for block, blockShapes in blocks.items():
+			blockShapes.sort(key=lambda s: s.centerOfMass)
+			self.blocks[block] = (blockShapes, [s.centerOfMass for s in blockShapes])
+
+	# Shapes whose center of mass is within lowFrequency..highFrequency and whose time indices overlap
+	# startIndex..endIndex, in no particular order.
+	def query(self, lowFrequency, highFrequency, startIndex, endIndex):
+		shapes = []
+		firstBlock = startIndex // FrequencyIndex.BLOCK_INTERVALS
+		for block in range(firstBlock, endIndex // FrequencyIndex.BLOCK_INTERVALS + 1):
+			blockEntry = self.blocks.get(block)
+			if blockEntry is None:
+				continue
+			blockShapes, centersOfMass = blockEntry
+			first = bisect.bisect_left(centersOfMass, lowFrequency)
+			last = bisect.bisect_right(centersOfMass, highFrequency, first)
+			for shape in blockShapes[first: last]:
+				# A shape filed under several blocks is taken from the first block of the query it is in
+				if shape.timeIndexStart <= endIndex and shape.timeIndexEnd >= startIndex and \
+						max(firstBlock, shape.timeIndexStart // FrequencyIndex.BLOCK_INTERVALS) == block:
+					shapes.append(shape)
+		return shapes
@@ -0,0 +1,184 @@
+import numpy
+
+# Runs of points down and up the columns of a time frequency array, one run per starting point.
+# The points of each run are in the order BaseShapeStrategy.getShape finds them: the starting point, the run down, then
+# the run up. Each attribute is an array with one element per run, except pointRows and runIds (one per point).
+class Runs:
+	def __init__(self, rows, columns, firstRows, starts, lengths, pointRows, runIds, greaterColumns, dominated, newRows):
+		self.rows = rows
+		self.columns = columns
+		self.firstRows = firstRows	# Row of the first point of each run by time
+		self.starts = starts	# Index of the first point of each run
+		self.lengths = lengths
+		self.pointRows = pointRows
+		self.runIds = runIds	# Run of each point
+		self.greaterColumns = greaterColumns	# 1 if the column on the right is the larger adjacent column, else -1
+		self.dominated = dominated	# If the larger adjacent column is larger than the run
+		self.newRows = newRows	# Row of the largest point of the larger adjacent column, -1 if there is none
+
+
+# Shapes of all local maxima of a time frequency array at once, with the criteria of BaseShapeStrategy.getShape.
+# The runs of all local maxima down and up their columns are found together, one row per step, and so are the sums of
+# their adjacent columns and the runs of the dominating adjacent columns that shapes move to. Shape extraction takes a
+# handful of array operations per row of the longest run, instead of Python steps per point.
+#
+# getShape also stops a run at points used by shapes found before, which depends on the order shapes are found in.
+# Shapes here are found as if no point was used, along with the points getShape checks for use on the way. Where none
+# of these points are used, getShape returns the shape found here. Otherwise the shape is left to getShape.
+class ShapeRuns:
+	OWN = 0	# The shape is the run of the local maximum or of the adjacent column it moved to
+	NONE = 1	# getShape finds no shape
+	WALK = 2	# Left to getShape: runs at or moving to the outermost columns, and dominating columns without a maximum
+
+	def __init__(self, d2Array, localMaxima, maxIncrement):
+		self.d2Array = d2Array	# numpy array
+		self.maxIncrement = maxIncrement
+		columnCount = d2Array.shape[1]
+		rows = numpy.array([lm[0] for lm in localMaxima], dtype=numpy.int64)
+		columns = numpy.array([lm[1] for lm in localMaxima], dtype=numpy.int64)
+
+		first = self.getRuns(rows, columns)
+		self.status = numpy.where(first.dominated, ShapeRuns.NONE, ShapeRuns.OWN)
+		self.status[(columns < 1) | (columns > columnCount - 2)] = ShapeRuns.WALK
+
+		# Points checked for use, as flat indices of the array: the run of the local maximum, then the dominating column
+		cells = [first.pointRows * columnCount + first.columns[first.runIds]]
+		cellIds = [first.runIds]
+		dominatedPoints = first.dominated[first.runIds]
+		cells.append(first.pointRows[dominatedPoints] * columnCount + (first.columns + first.greaterColumns)[first.runIds[dominatedPoints]])
+		cellIds.append(first.runIds[dominatedPoints])
+
+		# A dominated run moves to the largest point of the dominating column, if none of the column is used
+		self.status[(self.status == ShapeRuns.NONE) & (first.newRows < 0)] = ShapeRuns.WALK
+		moved = numpy.flatnonzero((self.status == ShapeRuns.NONE) & (first.newRows >= 0))
+		if len(moved):
+			second = self.getRuns(first.newRows[moved], columns[moved] + first.greaterColumns[moved])
+			# A run that moved is not moved again
+			secondStatus = numpy.where(second.dominated, ShapeRuns.NONE, ShapeRuns.OWN)
+			secondStatus[(second.columns < 1) | (second.columns > columnCount - 2)] = ShapeRuns.WALK
+			self.status[moved] = secondStatus
+			cells.append(second.pointRows * columnCount + second.columns[second.runIds])
+			cellIds.append(moved[second.runIds])
+
+		cellIds = numpy.concatenate(cellIds)
+		order = numpy.argsort(cellIds, kind='stable')
+		self.cells = numpy.concatenate(cells)[order]
+		cellCounts = numpy.bincount(cellIds, minlength=len(rows))
+		self.cellEnds = numpy.cumsum(cellCounts).tolist()
+		self.cellStarts = [end - count for end, count in zip(self.cellEnds, cellCounts.tolist())]
+		self.status = self.status.tolist()
+
+		# Points of each shape in the order of a ShapeStore: main points by time index, the point of the run before the
+		# one of the larger adjacent column, then auxiliary points by time index.
+		# The run of a shape that moved is the one of the adjacent column
+		firstRows = first.firstRows.copy()
+		lengths = first.lengths.copy()
+		runColumns = first.columns.copy()
+		greaterColumns = first.greaterColumns.copy()
+		if len(moved):
+			firstRows[moved] = second.firstRows
+			lengths[moved] = second.lengths
+			runColumns[moved] = second.columns
+			greaterColumns[moved] = second.greaterColumns
+		shapeIds = numpy.repeat(numpy.arange(len(rows)), lengths)
+		pointStarts = numpy.cumsum(lengths) - lengths
+		timeIndices = firstRows[shapeIds] + numpy.arange(len(shapeIds)) - pointStarts[shapeIds]
+		shapeColumns = runColumns[shapeIds]
+		shapeGreaterColumns = greaterColumns[shapeIds]
+		self.points = numpy.column_stack((numpy.repeat(timeIndices, 2),
+			numpy.column_stack((shapeColumns, shapeColumns + shapeGreaterColumns)).ravel())).astype(numpy.int32)
+		self.auxiliaryPoints = numpy.column_stack((timeIndices, shapeColumns - shapeGreaterColumns)).astype(numpy.int32)
+		self.pointStarts = pointStarts.tolist()
+		self.pointEnds = (pointStarts + lengths).tolist()
+		self.pointOffset = None	# Where the points are in a ShapeStore, see storePoints
+		self.auxiliaryOffset = None
+
+	# Runs of the given starting points down and up their columns, with the sums of their adjacent columns.
+	def getRuns(self, rows, columns):
+		d2Array = self.d2Array
+		rowCount, columnCount = d2Array.shape
+		maxIncrement = self.maxIncrement
+		startValues = d2Array[rows, columns]
+
+		# Search down
+		downLengths = numpy.zeros(len(rows), dtype=numpy.int64)
+		currentValues = startValues.copy()
+		halfCaches = numpy.zeros(len(rows))	# Used to store value of element when the value halfsizes
+		active = numpy.flatnonzero(rows + 1 < rowCount)
+		while len(active):
+			newValues = d2Array[rows[active] + downLengths[active] + 1, columns[active]]
+			currentValue = currentValues[active]
+			halfCache = halfCaches[active]
+			stop = (halfCache != 0) & (currentValue < halfCache / maxIncrement)	# Conditional end of current shape
+			stop |= newValues < currentValue / (maxIncrement ** 2)	# End of current shape
+			halving = newValues < currentValue / maxIncrement	# Conditional end of current shape
+			stop |= halving & (halfCache != 0)
+			halfCaches[active[halving & ~stop]] = newValues[halving & ~stop]
+			stop |= newValues > currentValue * maxIncrement	# New Shape
+			stop |= newValues < startValues[active] / (maxIncrement ** 3)	# End of shape, too much decay?
+			active = active[~stop]
+			downLengths[active] += 1
+			currentValues[active] = newValues[~stop]
+			active = active[rows[active] + downLengths[active] + 1 < rowCount]
+
+		# Search up
+		upLengths = numpy.zeros(len(rows), dtype=numpy.int64)
+		currentValues = startValues.copy()
+		active = numpy.flatnonzero(rows > 0)
+		while len(active):
+			newValues = d2Array[rows[active] - upLengths[active] - 1, columns[active]]
+			keep = ~(newValues < currentValues[active] / 2)
+			active = active[keep]
+			upLengths[active] += 1
+			currentValues[active] = newValues[keep]
+			active = active[rows[active] - upLengths[active] > 0]
+
+		# Points of each run: offsets 0, 1 .. downLength, then -1 .. -upLength from the starting point
+		lengths = 1 + downLengths + upLengths
+		starts = numpy.cumsum(lengths) - lengths
+		runIds = numpy.repeat(numpy.arange(len(rows)), lengths)
+		positions = numpy.arange(len(runIds)) - starts[runIds]
+		pointDownLengths = downLengths[runIds]
+		pointRows = rows[runIds] + numpy.where(positions <= pointDownLengths, positions, pointDownLengths - positions)
+		pointColumns = columns[runIds]
+
+		# Sum the points in the current column and the left and right adjacent columns. numpy.bincount adds the points of
+		# each run in order, like sum() does.
+		currentColumnSums = numpy.bincount(runIds, weights=d2Array[pointRows, pointColumns], minlength=len(rows))
+		rightColumnSums = numpy.where(columns < columnCount - 1, numpy.bincount(runIds,
+			weights=d2Array[pointRows, numpy.minimum(pointColumns + 1, columnCount - 1)], minlength=len(rows)), 1)
+		leftColumnSums = numpy.where(columns > 1, numpy.bincount(runIds,
+			weights=d2Array[pointRows, numpy.maximum(pointColumns - 1, 0)], minlength=len(rows)), 1)
+		# max() keeps the left sum unless the right one is larger, and equal sums go to the right column
+		greaterColumns = numpy.where(leftColumnSums > rightColumnSums, -1, 1)
+		greaterSums = numpy.where(greaterColumns == 1, rightColumnSums, leftColumnSums)
+		dominated = greaterSums > currentColumnSums
+
+		# The first largest element on the larger column, if it is above 0. Not necessarily a local max.
+		greaterValues = d2Array[pointRows, numpy.clip(pointColumns + greaterColumns[runIds], 0, columnCount - 1)]
+		maxValues = numpy.maximum.reduceat(greaterValues, starts) if len(rows) else numpy.zeros(0)
+		newPositions = numpy.full(len(rows), len(runIds))
+		numpy.minimum.at(newPositions, runIds[greaterValues == maxValues[runIds]], positions[greaterValues == maxValues[runIds]])
+		newRows = numpy.where(maxValues > 0, rows + numpy.where(newPositions <= downLengths, newPositions, downLengths - newPositions), -1)
+
+		return Runs(rows, columns, rows - upLengths, starts, lengths, pointRows, runIds, greaterColumns, dominated, newRows)
+
+	# How the shape of the i-th local maximum is found given the used points in labels, a flat view of
+	# ShapeIndex.labels. The shape is left to getShape if getShape would find a point used on the way.
+	def getStatus(self, i, labels):
+		status = self.status[i]
+		if status != ShapeRuns.WALK and labels.take(self.cells[self.cellStarts[i]: self.cellEnds[i]]).any():
+			return ShapeRuns.WALK
+		return status
+
+	# Adds the points of all shapes to a ShapeStore at once. A shape that is not found here leaves its points unused.
+	def storePoints(self, store):
+		self.pointOffset = store.addPointArray(self.points)[0]
+		self.auxiliaryOffset = store.addPointArray(self.auxiliaryPoints)[0]
+
+	# Ranges of the store holding the main and auxiliary points of the shape of the i-th local maximum, see
+	# storePoints. The shape must have the status OWN.
+	def getPointRanges(self, i):
+		start = self.pointStarts[i]
+		end = self.pointEnds[i]
+		return (self.pointOffset + 2 * start, self.pointOffset + 2 * end), (self.auxiliaryOffset + start, self.auxiliaryOffset + end)
@@ -0,0 +1,110 @@
+import numpy
+
+# Columnar storage of the points and magnitudes of all shapes of a shape strategy.
+# The (time index, frequency index) of all points are kept in a shared int32 array, and the magnitudes over time of
+# all shapes in a shared float array. A shape only records the ranges of these arrays it owns, so shapes cut out of
+# another shape share its ranges and nothing is copied.
+# The arrays grow by doubling, which moves them, so shapes index the store on every access instead of keeping views.
+# The properties of shapes are calculated for many shapes at once, with one pass over all their points.
+class ShapeStore:
+	INITIAL_SIZE = 1024
+
+	def __init__(self):
+		self.points = numpy.empty((ShapeStore.INITIAL_SIZE, 2), dtype=numpy.int32)
+		self.pointCount = 0
+		self.magnitudes = numpy.empty(ShapeStore.INITIAL_SIZE, dtype=numpy.float64)
+		self.magnitudeCount = 0
+
+	def grow(self, array, size):
+		if size <= len(array):
+			return array
+		grown = numpy.empty((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+		grown[:len(array)] = array
+		return grown
+
+	# Time indices of a range of points
+	def getRows(self, pointRange):
+		return self.points[pointRange[0]: pointRange[1], 0]
+
+	# Points of a range as a list of [timeIndex, frequencyIndex]
+	def getPoints(self, pointRange):
+		return self.points[pointRange[0]: pointRange[1]].tolist()
+
+	# Appends a list of (timeIndex, frequencyIndex), ordered by time index. Points of the same time index keep their order.
+	# Returns the range of the store they are in.
+	def addPoints(self, points):
+		return self.addPointArray(numpy.array(sorted(points, key=lambda p: p[0]), dtype=numpy.int32).reshape(-1, 2))
+
+	def addPointArray(self, points):
+		start = self.pointCount
+		self.pointCount += len(points)
+		self.points = self.grow(self.points, self.pointCount)
+		self.points[start: self.pointCount] = points
+		return start, self.pointCount
+
+	# Appends the points of the ranges, which are each ordered by time index and follow each other in time
+	def joinPoints(self, ranges):
+		return self.addPointArray(numpy.concatenate([self.points[start: end] for start, end in ranges]))
+
+	# Appends magnitudes and returns the range of the store they are in
+	def addMagnitudes(self, magnitudes):
+		start = self.magnitudeCount
+		self.magnitudeCount += len(magnitudes)
+		self.magnitudes = self.grow(self.magnitudes, self.magnitudeCount)
+		self.magnitudes[start: self.magnitudeCount] = magnitudes
+		return start, self.magnitudeCount
+
+	# Sub range of a range of points, of the points with time indices within startIndex..endIndex
+	def getTimeRange(self, pointRange, startIndex, endIndex):
+		start, end = numpy.searchsorted(self.getRows(pointRange), (startIndex, endIndex + 1)).tolist()
+		return pointRange[0] + start, pointRange[0] + end
+
+	# Indices of the store of all the ranges given by their starts and ends, one range after the other
+	def getIndices(self, starts, ends):
+		lengths = ends - starts
+		offsets = numpy.cumsum(lengths) - lengths
+		return numpy.repeat(starts - offsets, lengths) + numpy.arange(lengths.sum()), lengths
+
+	# Calculates the properties of FrequencyTimeShapes of this store, see FrequencyTimeShape.calculateProperties.
+	# Shapes without a magnitudeRange get their magnitudes over time summed from their points.
+	# The sums are accumulated with numpy.bincount, which adds up the points of a shape in order.
+	def calculateProperties(self, shapes, frequencyTimeArray):
+		if not shapes:
+			return
+		shapeIds = numpy.arange(len(shapes))
+		ranges = numpy.array([shape.pointRange + shape.auxiliaryRange for shape in shapes], dtype=numpy.int64)
+		timeIndexStarts = self.points[ranges[:, 0], 0].astype(numpy.int64)
+		timeIndexEnds = self.points[ranges[:, 1] - 1, 0].astype(numpy.int64)
+		# Main points of all shapes, then auxiliary points
+		indices, lengths = self.getIndices(ranges[:, [0, 2]].T.ravel(), ranges[:, [1, 3]].T.ravel())
+		pointShapeIds = numpy.repeat(numpy.concatenate((shapeIds, shapeIds)), lengths)
+		rows = self.points[indices, 0]
+		columns = self.points[indices, 1]
+		# We reduce the magnitude of each column by what we think is the noise
+		magnitudes = frequencyTimeArray[rows, columns]
+		centersOfMass = numpy.bincount(pointShapeIds, weights=columns * magnitudes, minlength=len(shapes)) / \
+			numpy.bincount(pointShapeIds, weights=magnitudes, minlength=len(shapes))
+
+		# MagnitudeByTime will not be recalculated for shapes that have one
+		summed = numpy.array([shape.magnitudeRange is None for shape in shapes])
+		if summed.any():
+			durations = timeIndexEnds - timeIndexStarts + 1
+			magnitudeStarts = numpy.zeros(len(shapes), dtype=numpy.int64)
+			magnitudeStarts[summed] = self.magnitudeCount + numpy.cumsum(durations[summed]) - durations[summed]
+			pointSummed = summed[pointShapeIds]
+			bins = (magnitudeStarts - timeIndexStarts)[pointShapeIds[pointSummed]] + rows[pointSummed] - self.magnitudeCount
+			self.addMagnitudes(numpy.bincount(bins, weights=magnitudes[pointSummed], minlength=durations[summed].sum()))
+			for shape, start, duration in zip([shape for shape in shapes if shape.magnitudeRange is None],
+					magnitudeStarts[summed].tolist(), durations[summed].tolist()):
+				shape.magnitudeRange = (start, start + duration)
+
+		magnitudeRanges = numpy.array([shape.magnitudeRange for shape in shapes], dtype=numpy.int64)
+		indices, lengths = self.getIndices(magnitudeRanges[:, 0], magnitudeRanges[:, 1])
+		averageMagnitudes = numpy.bincount(numpy.repeat(shapeIds, lengths), weights=self.magnitudes[indices], minlength=len(shapes)) / lengths
+
+		for shape, timeIndexStart, timeIndexEnd, centerOfMass, magnitude in zip(shapes, timeIndexStarts.tolist(), timeIndexEnds.tolist(),
+				centersOfMass.tolist(), averageMagnitudes.tolist()):
+			shape.timeIndexStart = timeIndexStart
+			shape.timeIndexEnd = timeIndexEnd
+			shape.centerOfMass = centerOfMass
+			shape.magnitude = magnitude
@@ -1,7 +1,7 @@
 from collections import defaultdict
-import copy
 
-from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy, FrequencyTimeShape
+from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy
+from noteProcessors.discreteNoteProcessor.shapeIndex import FrequencyIndex, ShapeIndex
 import utils
 
 # The goal of this shape strategy is to filter down the huge set of shapes to only those which contributes to the main melody.
@@ -12,9 +12,12 @@ import utils
 # 4. re-separation of shapes based on internal structure
 # 5. Filtering out shapes whose values are bloated by false harmonics
 class FilterShapeStrategy(BaseShapeStrategy):
-	def getShapeList(self, d2Array):
-		shapeList = super(FilterShapeStrategy, self).getShapeList(d2Array)
+	SCAN_INTERVALS = 4	# Shapes shorter than this many intervals look for harmonics point by point, see getHarmonicCells
+
+	def getUnconsolidatedShapeList(self, d2Array):
+		shapeList = super(FilterShapeStrategy, self).getUnconsolidatedShapeList(d2Array)
 		shapeList.sort(key=lambda s: s.centerOfMass)
+		frequencyIndex = FrequencyIndex(self.shapeIndex.getShapes())
 		for shape in shapeList:
 			# Completely disregard any shape below the minimal precision. TODO: improve.
 			# Ideally , the check should be < 50, which converts to the equivalent of where consecutive note frequencies are
@@ -25,48 +28,81 @@ class FilterShapeStrategy(BaseShapeStrategy):
 			if shape.isBaseCandidate:
 				baseFrequencyIndex = shape.centerOfMass
 				currentHarmonic = 2
-				currentIndex = int(baseFrequencyIndex * currentHarmonic)	# Index of where to look for currentHarmonic in usedPointsCache
+				currentIndex = int(baseFrequencyIndex * currentHarmonic)	# Index of where to look for currentHarmonic in shapeIndex
 				while currentIndex < len(d2Array[0]) - 1:
 					harmonicSearched = []	# List of harmonic shapes already searched by this shap
-					for timeIndex in range(shape.timeIndexStart, shape.timeIndexEnd + 1):
-						# We look for the harmonic in 2 adjacent cache locations, to allow for some error.
-						for cache in [self.usedPointsCache[timeIndex][currentIndex], self.usedPointsCache[timeIndex][currentIndex + 1]]:
-							if cache in harmonicSearched:
-								continue
-							for cachedShape in cache:
-								harmonicSearched.append(cache)
+					# We look for the harmonic in 2 adjacent cache locations, to allow for some error.
+					for timeIndex, column in self.getHarmonicCells(frequencyIndex, shape, currentHarmonic, 0.015, (currentIndex, currentIndex + 1)):
+						cache = self.shapeIndex.get(timeIndex, column)
+						if cache in harmonicSearched:
+							continue
+						for cachedShape in cache:
+							harmonicSearched.append(cache)
 
-								# Maybe we can make check more precise in frequency precision cases
-								# It seems this value is critical so that if too low, harmonic frequencies dont get grouped
-								# If too high, false harmonics are detected
-								if utils.percentDiff(cachedShape.centerOfMass / currentHarmonic, baseFrequencyIndex) < 0.015:
-									# Get the time indices that are shared between the base and harmonic shapes.
-									sharedStartIndex = max([shape.timeIndexStart, cachedShape.timeIndexStart])
-									sharedEndIndex = min([shape.timeIndexEnd, cachedShape.timeIndexEnd])
-									baseFrequencyMagnitude = sum(shape.magnitudeByTime[sharedStartIndex - shape.timeIndexStart : sharedEndIndex - shape.timeIndexStart])
-									harmonicFrequencyMagnitude = sum(cachedShape.magnitudeByTime[sharedStartIndex - cachedShape.timeIndexStart : sharedEndIndex - cachedShape.timeIndexStart])
-									# The base frequency must be sizable compared to the harmonic to be considered related.
-									# TODO: This rule is somewhat unrealiable and requires more thinking
-									if baseFrequencyMagnitude * (1 + currentHarmonic * 0.1) < harmonicFrequencyMagnitude:
-										continue
+							# Maybe we can make check more precise in frequency precision cases
+							# It seems this value is critical so that if too low, harmonic frequencies dont get grouped
+							# If too high, false harmonics are detected
+							if utils.percentDiff(cachedShape.centerOfMass / currentHarmonic, baseFrequencyIndex) < 0.015:
+								# Get the time indices that are shared between the base and harmonic shapes.
+								sharedStartIndex = max([shape.timeIndexStart, cachedShape.timeIndexStart])
+								sharedEndIndex = min([shape.timeIndexEnd, cachedShape.timeIndexEnd])
+								baseFrequencyMagnitude = sum(shape.magnitudeByTime[sharedStartIndex - shape.timeIndexStart : sharedEndIndex - shape.timeIndexStart])
+								harmonicFrequencyMagnitude = sum(cachedShape.magnitudeByTime[sharedStartIndex - cachedShape.timeIndexStart : sharedEndIndex - cachedShape.timeIndexStart])
+								# The base frequency must be sizable compared to the harmonic to be considered related.
+								# TODO: This rule is somewhat unrealiable and requires more thinking
+								if baseFrequencyMagnitude * (1 + currentHarmonic * 0.1) < harmonicFrequencyMagnitude:
+									continue
 
-									# Re-evaluate the base-candidacy of the harmonic shape
-									cachedShape.updateBaseCandidate(sharedStartIndex, sharedEndIndex, shape)
-									shape.harmonicCount += 1
+								# Re-evaluate the base-candidacy of the harmonic shape
+								cachedShape.updateBaseCandidate(sharedStartIndex, sharedEndIndex, shape)
+								shape.harmonicCount += 1
 
-									# Combine the magnitudes by time
-									for i in range(sharedStartIndex, sharedEndIndex + 1):
-										shape.magnitudeByTime[i - shape.timeIndexStart] += cachedShape.magnitudeByTime[i - cachedShape.timeIndexStart]
-									break	# One harmonic shape per cache
+								# Combine the magnitudes by time
+								shape.magnitudeByTime[sharedStartIndex - shape.timeIndexStart : sharedEndIndex - shape.timeIndexStart + 1] += \
+									cachedShape.magnitudeByTime[sharedStartIndex - cachedShape.timeIndexStart : sharedEndIndex - cachedShape.timeIndexStart + 1]
+								break	# One harmonic shape per cache
 
 
 					currentHarmonic += 1
 					currentIndex = int(baseFrequencyIndex * currentHarmonic)
 
 		shapeList = self.filterHarmonicsRules(shapeList, d2Array)
-		shapeList = self.consolidateShapeList(shapeList, d2Array)
 		return shapeList
 
+	# Shapes of frequencyIndex that could be the harmonic-th harmonic of shape: their center of mass over harmonic is
+	# within percentDiff tolerance of the shape's, and they overlap the shape in time.
+	def getHarmonicCandidates(self, frequencyIndex, shape, harmonic, tolerance):
+		if tolerance <= 0:
+			return []
+		harmonicFrequency = shape.centerOfMass * harmonic
+		candidates = frequencyIndex.query(harmonicFrequency / (1 + tolerance) * 0.999, harmonicFrequency * (1 + tolerance) * 1.001,
+			shape.timeIndexStart, shape.timeIndexEnd)
+		if not candidates:
+			return candidates
+		return [c for c in candidates if utils.percentDiff(c.centerOfMass / harmonic, shape.centerOfMass) < tolerance]
+
+	# Points of the columns at the time indices of shape where its harmonic-th harmonic may be, by time index then column.
+	# Short shapes probe every point, which takes fewer lookups than querying frequencyIndex. Longer shapes only probe the
+	# points owned by their candidates (see getHarmonicCandidates), which visits the same candidates in the same order.
+	def getHarmonicCells(self, frequencyIndex, shape, harmonic, tolerance, columns):
+		if shape.timeIndexEnd - shape.timeIndexStart + 1 < FilterShapeStrategy.SCAN_INTERVALS:
+			return [(timeIndex, column) for timeIndex in range(shape.timeIndexStart, shape.timeIndexEnd + 1) for column in columns]
+		candidates = self.getHarmonicCandidates(frequencyIndex, shape, harmonic, tolerance)
+		return self.getOwnedCells(candidates, shape.timeIndexStart, shape.timeIndexEnd, columns)
+
+	# Points of the columns at time indices startIndex..endIndex that one of the shapes owns, by time index then column.
+	# The other points there are empty or only owned by shapes that are not candidates, so walking these visits the
+	# same candidates in the same order as walking every point.
+	def getOwnedCells(self, shapes, startIndex, endIndex, columns):
+		if not shapes:
+			return []
+		cells = set()
+		for shape in shapes:
+			for (y, x) in shape.points:
+				if startIndex <= y <= endIndex and x in columns and self.shapeIndex.contains(y, x, shape):
+					cells.add((y, x))
+		return sorted(cells)
+
 	def filterHarmonicsRules(self, shapeList, d2Array):
 		return shapeList
 
@@ -78,16 +114,13 @@ class FilterShapeStrategy(BaseShapeStrategy):
 			if shape.isBaseCandidate:
 				newShapeList.append(shape)
 			else:
-				for point in shape.points:
-					self.usedPointsCache[point[0]][point[1]].remove(shape)
+				self.shapeIndex.removeShape(shape)
 		shapeList = newShapeList
 		print("Filtering Notes: %d " % len(shapeList))
 
-		# Sets some arbitrary global thresholds that dictate what is audible and what is not.
-		# In the future, the goal is to use both local and global measurements to determine this.
-		maxMagnitudePerShape = [max(shape.magnitudeByTime) for shape in shapeList]
-		maxMagnitudePerShape.sort(key=lambda x: -x)
-		threshold = sum(maxMagnitudePerShape[50:150]) / 100
+		threshold = self.loudnessThreshold
+		if threshold is None:
+			threshold = self.getLoudnessThreshold(self.getLoudestMagnitudes(shapeList))
 		# mag < lowRange: inaudible
 		# lowRange < mag < mediumRange: conditionally audible
 		lowRange = threshold / 16
@@ -100,62 +133,58 @@ class FilterShapeStrategy(BaseShapeStrategy):
 			if max(shape.magnitudeByTime) > lowRange:
 				newShapeList.append(shape)
 			else:
-				for point in shape.points:
-					self.usedPointsCache[point[0]][point[1]].remove(shape)
+				self.shapeIndex.removeShape(shape)
 		shapeList = newShapeList
 		print("Filtering Notes: %d " % len(shapeList))
 
 
 		shapeList.sort(key=lambda shape: shape.magnitude)
 		# Evaluate each shape internally and remove all uneeded points
-		self.usedPointsCache = [[[] for i in range(len(d2Array[0]))] for i in range(len(d2Array))]
+		self.shapeIndex = ShapeIndex(len(d2Array), len(d2Array[0]))
 		newShapeList = []
+		splitShapes = []	# Properties of the split shapes are calculated at once
 		for shape in shapeList:
-			for i in range(len(shape.magnitudeByTime)):
+			magnitudeByTime = shape.magnitudeByTime	# View of the store, written to in place
+			for i in range(len(magnitudeByTime)):
 				# LowRange is inaudible
-				if shape.magnitudeByTime[i] < lowRange:
-					shape.magnitudeByTime[i] = -1
+				if magnitudeByTime[i] < lowRange:
+					magnitudeByTime[i] = -1
 				# Between medium and high range, the note is audible if it is at the end of a shape.
-				if shape.magnitudeByTime[i] >= lowRange and shape.magnitudeByTime[i] < mediumRange:
+				if magnitudeByTime[i] >= lowRange and magnitudeByTime[i] < mediumRange:
 					isPoint = False
-					if (i == len(shape.magnitudeByTime) - 1 and
-						len(shape.magnitudeByTime) != 1 and
-						shape.magnitudeByTime[i - 1] >= mediumRange and 
-						utils.percentDiff(shape.magnitudeByTime[i - 1], shape.magnitudeByTime[i]) > 0.2):
+					if (i == len(magnitudeByTime) - 1 and
+						len(magnitudeByTime) != 1 and
+						magnitudeByTime[i - 1] >= mediumRange and 
+						utils.percentDiff(magnitudeByTime[i - 1], magnitudeByTime[i]) > 0.2):
 						isPoint = True
 					if (i == 0 and 
-						len(shape.magnitudeByTime) != 1 and
-						shape.magnitudeByTime[i + 1] >= mediumRange and 
-						utils.percentDiff(shape.magnitudeByTime[i + 1], shape.magnitudeByTime[i]) > 0.2):
+						len(magnitudeByTime) != 1 and
+						magnitudeByTime[i + 1] >= mediumRange and 
+						utils.percentDiff(magnitudeByTime[i + 1], magnitudeByTime[i]) > 0.2):
 						isPoint = True
 					if not isPoint:
-						shape.magnitudeByTime[i] = -1
-			points = []
-			auxiliaryPoints = []
+						magnitudeByTime[i] = -1
+			start = None	# Time index the current run of points starts at
 			# Separate the shapes based off the "-1"s
-			for i in range(len(shape.magnitudeByTime) + 1):
-				if i == len(shape.magnitudeByTime) or shape.magnitudeByTime[i] < 0:
-					if points:
-						timeIndices = [p[0] for p in points]
-						start = min(timeIndices)
-						end = max(timeIndices)
-						s = FrequencyTimeShape(points, auxiliaryPoints, d2Array, shape.magnitudeByTime[start - shape.timeIndexStart : end - shape.timeIndexStart + 1])
-						# Im assumming that the shapes that are split and dont satisfy this are irrelevant.
-						# Could possibly be that earlier logic didnt group shape properly.
-						if s.magnitude > 0:
-							newShapeList.append(s)
-							for p in s.points:
-								self.usedPointsCache[p[0]][p[1]].append(s)
-						points = []
-						auxiliaryPoints = []
-				else:
-					points.extend([p for p in shape.points if p[0] == i + shape.timeIndexStart])
-					auxiliaryPoints.extend([p for p in shape.auxiliaryPoints if p[0] == i + shape.timeIndexStart])
+			for i in range(len(magnitudeByTime) + 1):
+				if i == len(magnitudeByTime) or magnitudeByTime[i] < 0:
+					if start is not None:
+						splitShapes.append(shape.getSubShape(start, i - 1 + shape.timeIndexStart))
+						start = None
+				elif start is None:
+					start = i + shape.timeIndexStart
+		self.shapeStore.calculateProperties(splitShapes, self.frequencyTimeArray)
+		for s in splitShapes:
+			# Im assumming that the shapes that are split and dont satisfy this are irrelevant.
+			# Could possibly be that earlier logic didnt group shape properly.
+			if s.magnitude > 0:
+				newShapeList.append(s)
+				self.shapeIndex.addShape(s)
 		shapeList = newShapeList
 		print("Filtering Notes: %d " % len(shapeList))
 		for shape in shapeList:
 			for point in shape.points:
-				if not(shape in self.usedPointsCache[point[0]][point[1]]):
+				if not self.shapeIndex.contains(point[0], point[1], shape):
 					import pdb;pdb.set_trace()
 
 		# Combine existing shapes that are consecutive in time, and share similar frequencies.
@@ -164,7 +193,7 @@ class FilterShapeStrategy(BaseShapeStrategy):
 		for shape in shapeList:
 			# Check if a point is in cache. If not, it was removed by earlier iteration of this so we do not add to newShapeList
 			# Should be correct since this processes shapes top down
-			if shape in self.usedPointsCache[shape.points[0][0]][shape.points[0][1]]:
+			if self.shapeIndex.contains(shape.points[0][0], shape.points[0][1], shape):
 				lookForConnection = True	# Set to true if a connecting shape is found, indicating that there could be more connecting shapes.
 				while lookForConnection:
 					possibleConnectingShapes = set([])
@@ -179,7 +208,7 @@ class FilterShapeStrategy(BaseShapeStrategy):
 							if p[1] < len(d2Array[0]) - 1:
 								cachePoints.add((p[0] + 1, p[1] + 1))
 					for cachePoint in cachePoints:
-						possibleConnectingShapes.update(self.usedPointsCache[cachePoint[0]][cachePoint[1]])
+						possibleConnectingShapes.update(self.shapeIndex.get(cachePoint[0], cachePoint[1]))
 					for connectingShape in possibleConnectingShapes:
 						# Checks that the 2 shapes are consecutive in time, have similar centerOfMass, and 
 						# the connecting magnitudeByTimes are similar
@@ -188,27 +217,12 @@ class FilterShapeStrategy(BaseShapeStrategy):
 							utils.percentDiff(shape.magnitudeByTime[-1], connectingShape.magnitudeByTime[0] < 0.5)):
 						
 							# Combine the 2 shapes into 1 shape by emptying connectingShape and unloading to shape
-							points = copy.deepcopy(connectingShape.points)
-							points.extend(shape.points)
-							auxiliaryPoints = copy.deepcopy(connectingShape.auxiliaryPoints)
-							auxiliaryPoints.extend(shape.auxiliaryPoints)
-
-							timeIndices = [p[0] for p in points]
-							start = min(timeIndices)
-							end = max(timeIndices)
 							# We transfer magnitudes to the new shape to preserve combined harmonics
-							magnitudeToTransfer = shape.magnitudeByTime[start - shape.timeIndexStart :]
-							magnitudeToTransfer.extend(connectingShape.magnitudeByTime[: end - connectingShape.timeIndexStart + 1])
-							if sum(magnitudeToTransfer) < 0:
-								magnitudeToTransfer = [0 for m in magnitudeToTransfer]
-							for p in shape.points:
-								self.usedPointsCache[p[0]][p[1]].remove(shape)
-							shape = FrequencyTimeShape(points, auxiliaryPoints, d2Array, magnitudeToTransfer)
+							self.shapeIndex.removeShape(shape)
+							shape = shape.getJoinedShape(connectingShape, self.frequencyTimeArray)
 							# Remove the connecting shape from cache
-							for cp in connectingShape.points:
-								self.usedPointsCache[cp[0]][cp[1]].remove(connectingShape)
-							for p in shape.points:
-								self.usedPointsCache[p[0]][p[1]].append(shape)
+							self.shapeIndex.removeShape(connectingShape)
+							self.shapeIndex.addShape(shape)
 							lookForConnection = True
 							break
 				newShapeList.append(shape)
@@ -216,11 +230,12 @@ class FilterShapeStrategy(BaseShapeStrategy):
 		print("Filtering Notes: %d " % len(shapeList))
 		for shape in shapeList:
 			for point in shape.points:
-				if not(shape in self.usedPointsCache[point[0]][point[1]]):
+				if not self.shapeIndex.contains(point[0], point[1], shape):
 					import pdb;pdb.set_trace()
 
 
 		# Evaluate each shape relative to time-local information.
+		frequencyIndex = FrequencyIndex(self.shapeIndex.getShapes())
 		newShapeList = []
 		for shape in shapeList:			
 			# Rule 1:
@@ -232,12 +247,12 @@ class FilterShapeStrategy(BaseShapeStrategy):
 			currentHarmonic = 2
 			currentIndex = int(shape.centerOfMass * currentHarmonic)
 			while currentIndex < len(d2Array[0]) - 1:
-				for timeIndex in range(shape.timeIndexStart, shape.timeIndexEnd + 1):
-					for cache in [self.usedPointsCache[timeIndex][currentIndex], self.usedPointsCache[timeIndex][currentIndex + 1]]:
-						for cachedShape in cache:
-							# The chance of higher harmonics being the victim is lower
-							if utils.percentDiff(cachedShape.centerOfMass / currentHarmonic, shape.centerOfMass) < (5 - currentHarmonic) * 0.005 + 0.015:
-								allPossibleHarmonics.add(cachedShape)
+				# The chance of higher harmonics being the victim is lower
+				tolerance = (5 - currentHarmonic) * 0.005 + 0.015
+				for timeIndex, column in self.getHarmonicCells(frequencyIndex, shape, currentHarmonic, tolerance, (currentIndex, currentIndex + 1)):
+					for cachedShape in self.shapeIndex.get(timeIndex, column):
+						if utils.percentDiff(cachedShape.centerOfMass / currentHarmonic, shape.centerOfMass) < tolerance:
+							allPossibleHarmonics.add(cachedShape)
 				currentHarmonic += 1
 				currentIndex = int(shape.centerOfMass * currentHarmonic)
 
@@ -259,7 +274,7 @@ class FilterShapeStrategy(BaseShapeStrategy):
 			# 	firstMagnitude = shape.magnitudeByTime[1]
 			# possibleShapes = set([])
 			# for i in range(len(d2Array[0])):
-			# 	possibleShapes.update(self.usedPointsCache[startIndex][i])
+			# 	possibleShapes.update(self.shapeIndex.get(startIndex, i))
 			# for possibleShape in possibleShapes:
 			# 	if possibleShape != shape:
 			# 		if possibleShape.magnitudeByTime[startIndex - possibleShape.timeIndexStart] / firstMagnitude > 1.2:
@@ -267,8 +282,7 @@ class FilterShapeStrategy(BaseShapeStrategy):
 			if not (coveredByHarmonic or coveredByNearbyNote):
 				newShapeList.append(shape)
 			else:
-				for p in shape.points:
-					self.usedPointsCache[p[0]][p[1]].remove(shape)
+				self.shapeIndex.removeShape(shape)
 		shapeList = newShapeList
 		print("Filtering Notes: %d " % len(shapeList))
 
@@ -0,0 +1,35 @@
+import numpy
+from numpy import fft
+
+# Magnitude spectra of the consecutive, non overlapping intervals of a waveform.
+# Intervals are reshaped into a 2d array of one interval per row and transformed with a single rfft along the rows, a
+# batch of intervals at a time. Magnitudes are written straight into one contiguous array, one row per interval.
+class Spectrogram:
+	# Intervals transformed at once. Bounds the samples sliced out of a lazily decoded waveform at a time.
+	BATCH_INTERVALS = 1024
+
+	def __init__(self, sampleRate, samplesPerInterval):
+		self.sampleRate = sampleRate
+		self.samplesPerInterval = samplesPerInterval
+
+	# Number of whole intervals in the waveform after sampleOffset
+	def getIntervalCount(self, waveform, sampleOffset=0):
+		return int((len(waveform) - sampleOffset) / self.samplesPerInterval)
+
+	# Start time in seconds of each interval, relative to the first interval
+	def getIntervalTimes(self, intervalCount):
+		return numpy.arange(intervalCount) * self.samplesPerInterval / self.sampleRate
+
+	# Returns the magnitudes of the first samplesPerInterval // 2 frequency bins of each interval, and the start time of
+	# each interval. sampleOffset is where the first interval starts.
+	def compute(self, waveform, sampleOffset=0):
+		intervalCount = self.getIntervalCount(waveform, sampleOffset)
+		binCount = self.samplesPerInterval // 2
+		magnitudes = numpy.empty((intervalCount, binCount))
+		for firstInterval in range(0, intervalCount, Spectrogram.BATCH_INTERVALS):
+			lastInterval = min(firstInterval + Spectrogram.BATCH_INTERVALS, intervalCount)
+			samples = numpy.asarray(waveform[sampleOffset + firstInterval * self.samplesPerInterval: sampleOffset + lastInterval * self.samplesPerInterval],
+				dtype=numpy.float64)
+			intervals = samples.reshape(lastInterval - firstInterval, self.samplesPerInterval)
+			magnitudes[firstInterval: lastInterval] = numpy.abs(fft.rfft(intervals, axis=1)[:, :binCount])
+		return magnitudes, self.getIntervalTimes(intervalCount)
@@ -0,0 +1,190 @@
+import collections
+import concurrent.futures
+import os
+import pickle
+import tempfile
+
+import numpy
+
+from noteProcessors.discreteNoteProcessor.spectrogram import Spectrogram
+import utils
+
+# Properties of a shape found in a tile, with the time indices of the whole array. Stands in for the FrequencyTimeShape
+# once the tile it was found in is gone.
+class TileShape:
+	__slots__ = ["timeIndexStart", "timeIndexEnd", "centerOfMass", "magnitude"]
+
+	def __init__(self, timeIndexStart, timeIndexEnd, centerOfMass, magnitude):
+		self.timeIndexStart = timeIndexStart
+		self.timeIndexEnd = timeIndexEnd
+		self.centerOfMass = centerOfMass
+		self.magnitude = magnitude
+
+
+# Finds the shapes of the spectrogram of a waveform tile by tile, so the spectrogram of the whole waveform is never held.
+# Each tile covers tileIntervals intervals and is extended by haloIntervals on both sides. A tile keeps the shapes
+# starting within it, which it sees whole unless they are longer than the halo. Tiles run on a pool of worker processes,
+# a few tiles per worker at a time, so memory does not grow with the length of the waveform. Only the shapes finally
+# found are held for the whole waveform.
+#
+# The shape strategy filters local maxima and consolidates shapes relative to the loudest of the whole array. These are
+# taken in passes over all tiles before the stage that needs them:
+# 1. The largest local maximum of each tile. The spectrogram of the tile and its halos is computed once, here, and
+#    written to a file of a temporary directory, from which the later passes read it.
+# 2. The shapes of each tile up to consolidation (see BaseShapeStrategy.getUnconsolidatedShapeList), and the
+#    magnitudes of its loudest shapes, which give the loudness threshold. Only the magnitudes are sent back. The shapes
+#    are copied out of the tile into a file of the temporary directory until pass 3.
+# 3. The consolidated shapes of each tile, from the shapes of pass 2. Shapes are not extracted again.
+# With a single tile, the shapes are those of the shape strategy on the whole array. The spectrogram of the whole
+# waveform is on disk between passes, but only that of a few tiles at a time is in memory.
+#
+# A shape running past the halo after the tile it starts in is cut there. If it starts within a halo of the end of the
+# tile, the next tile sees it from its start and further on, and the shape is taken from there, see stitchTile. Shapes
+# are those of the whole array where the halos cover how far shapes run and affect each other.
+class TiledShapeFinder:
+	# workers is the number of worker processes, one per core if None
+	def __init__(self, shapeStrategy, sampleRate, samplesPerInterval, tileIntervals, haloIntervals, workers=None, shapeExtraction="runs"):
+		self.shapeStrategy = shapeStrategy
+		self.strategyArgs = (shapeStrategy, sampleRate, samplesPerInterval, shapeExtraction)
+		self.samplesPerInterval = samplesPerInterval
+		self.spectrogram = Spectrogram(sampleRate, samplesPerInterval)
+		self.tileIntervals = tileIntervals
+		self.haloIntervals = haloIntervals
+		self.workers = workers or os.cpu_count()
+
+	# First and last interval of each tile, halos excluded
+	def getTiles(self, intervalCount):
+		return [(first, min(first + self.tileIntervals, intervalCount) - 1) for first in range(0, intervalCount, self.tileIntervals)]
+
+	# Samples of intervals firstInterval..lastInterval of the waveform, clipped to the intervals there are
+	def getSamples(self, waveform, sampleOffset, intervalCount, firstInterval, lastInterval):
+		firstInterval = max(firstInterval, 0)
+		lastInterval = min(lastInterval, intervalCount - 1)
+		return numpy.asarray(waveform[sampleOffset + firstInterval * self.samplesPerInterval: sampleOffset + (lastInterval + 1) * self.samplesPerInterval])
+
+	# Results of function for each task, in order. At most two tasks per worker are handed out at a time, so only the
+	# samples of these tiles are held.
+	def mapTiles(self, executor, function, tasks):
+		if executor is None:
+			for task in tasks:
+				yield function(*task)
+			return
+		futures = collections.deque()
+		for task in tasks:
+			futures.append(executor.submit(function, *task))
+			if len(futures) >= 2 * self.workers:
+				yield futures.popleft().result()
+		while futures:
+			yield futures.popleft().result()
+
+	# TileShapes of the spectrogram of the waveform after sampleOffset, by time index start
+	def getShapes(self, waveform, sampleOffset=0):
+		intervalCount = self.spectrogram.getIntervalCount(waveform, sampleOffset)
+		tiles = self.getTiles(intervalCount)
+		with tempfile.TemporaryDirectory() as directory:
+			if self.workers == 1 or len(tiles) < 2:
+				return self.findShapes(None, directory, waveform, sampleOffset, intervalCount, tiles)
+			with concurrent.futures.ProcessPoolExecutor(min(self.workers, len(tiles))) as executor:
+				return self.findShapes(executor, directory, waveform, sampleOffset, intervalCount, tiles)
+
+	# directory holds the spectrogram of each tile from pass 1 on, and its shapes between passes 2 and 3
+	def findShapes(self, executor, directory, waveform, sampleOffset, intervalCount, tiles):
+		halo = self.haloIntervals
+		# Spectrograms are of the tile with its halos, and at least one interval on either side of it.
+		# Rows are the intervals start..end, the tile's rows within them first - start..last - start.
+		extendedTiles = [(max(first - halo, 0), min(last + halo, intervalCount - 1)) for first, last in tiles]
+		spectrogramTiles = [(max(first - max(halo, 1), 0), min(last + max(halo, 1), intervalCount - 1)) for first, last in tiles]
+		spectrogramFiles = [os.path.join(directory, "tile%d.npy" % i) for i in range(len(tiles))]
+		shapeFiles = [os.path.join(directory, "tile%d.pickle" % i) for i in range(len(tiles))]
+
+		# Pass 1. With one interval on either side of a tile, its local maxima are those of the whole array.
+		largestLocalMaxima = [m for m in self.mapTiles(executor, getTileLargestLocalMaximum, ((self.strategyArgs,
+			self.getSamples(waveform, sampleOffset, intervalCount, spectrogramStart, spectrogramEnd), max(first - 1, 0) - spectrogramStart,
+			min(last + 1, intervalCount - 1) - spectrogramStart, spectrogramFile)
+			for (first, last), (spectrogramStart, spectrogramEnd), spectrogramFile in zip(tiles, spectrogramTiles, spectrogramFiles))) if m is not None]
+		largestLocalMaximum = max(largestLocalMaxima) if largestLocalMaxima else None
+
+		# Pass 2
+		loudestMagnitudes = []
+		for tileLoudestMagnitudes in self.mapTiles(executor, getTileUnconsolidatedShapes, ((self.strategyArgs, spectrogramFile, start - spectrogramStart,
+				end - spectrogramStart, first - start, last - start, largestLocalMaximum, shapeFile)
+				for (first, last), (start, end), (spectrogramStart, _), spectrogramFile, shapeFile in zip(tiles, extendedTiles, spectrogramTiles, spectrogramFiles, shapeFiles))):
+			loudestMagnitudes += tileLoudestMagnitudes
+		threshold = self.shapeStrategy.getLoudnessThreshold(loudestMagnitudes)
+
+		# Pass 3
+		shapes = []
+		openShapes = []	# Shapes cut at the end of the last tile with its halos
+		tileShapes = self.mapTiles(executor, getTileShapes, ((self.strategyArgs, spectrogramFile, start - spectrogramStart, end - spectrogramStart,
+			first - start, last - start, start, shapeFile, threshold)
+			for (first, last), (start, end), (spectrogramStart, _), spectrogramFile, shapeFile in zip(tiles, extendedTiles, spectrogramTiles, spectrogramFiles, shapeFiles)))
+		for (start, end), (ownShapes, continuedShapes) in zip(extendedTiles, tileShapes):
+			self.stitchTile(openShapes, continuedShapes)
+			shapes += ownShapes
+			openShapes = [s for s in openShapes + ownShapes if s.timeIndexEnd == end < intervalCount - 1]
+		return shapes
+
+	# Continues shapes cut at the end of the tiles before with the shapes the next tile sees starting in its halo. A shape
+	# is continued by the one starting at the same time with a similar center of mass, which the tile sees further on.
+	def stitchTile(self, openShapes, continuedShapes):
+		for shape in openShapes:
+			for continuedShape in continuedShapes:
+				if continuedShape.timeIndexStart == shape.timeIndexStart and utils.percentDiff(continuedShape.centerOfMass, shape.centerOfMass) < 0.01:
+					shape.timeIndexEnd = continuedShape.timeIndexEnd
+					shape.centerOfMass = continuedShape.centerOfMass
+					shape.magnitude = continuedShape.magnitude
+					break
+
+
+# The shape strategy of a tile, and rows startRow..endRow of the spectrogram pass 1 wrote to spectrogramFile, in the
+# process the tile is processed in
+def loadTileStrategy(strategyArgs, spectrogramFile, startRow, endRow):
+	shapeStrategy, sampleRate, samplesPerInterval, shapeExtraction = strategyArgs
+	d2Array = numpy.load(spectrogramFile)[startRow: endRow + 1]
+	return shapeStrategy(sampleRate, samplesPerInterval, shapeExtraction=shapeExtraction), d2Array
+
+
+# Pass 1 of a tile: writes the spectrogram of the samples to spectrogramFile, and returns the largest local maximum of
+# rows startRow..endRow of it, None if there is none. The first and last of these rows are never local maxima.
+def getTileLargestLocalMaximum(strategyArgs, samples, startRow, endRow, spectrogramFile):
+	shapeStrategy, sampleRate, samplesPerInterval, shapeExtraction = strategyArgs
+	d2Array = Spectrogram(sampleRate, samplesPerInterval).compute(samples)[0]
+	numpy.save(spectrogramFile, d2Array)
+	d2Array = d2Array[startRow: endRow + 1]
+	if len(d2Array) == 0:
+		return None
+	rows, columns = shapeStrategy(sampleRate, samplesPerInterval, shapeExtraction=shapeExtraction).get2dLocalMaxima(d2Array)
+	if len(rows) == 0:
+		return None
+	return d2Array[rows, columns].max().item()
+
+
+# Pass 2 of a tile: writes copies of its shapes up to consolidation to shapeFile, and returns the magnitudes of the
+# loudest of those starting within rows firstRow..lastRow of the tile with its halos, rows startRow..endRow of its
+# spectrogram.
+def getTileUnconsolidatedShapes(strategyArgs, spectrogramFile, startRow, endRow, firstRow, lastRow, largestLocalMaximum, shapeFile):
+	strategy, d2Array = loadTileStrategy(strategyArgs, spectrogramFile, startRow, endRow)
+	strategy.largestLocalMaximum = largestLocalMaximum
+	shapeList = strategy.getUnconsolidatedShapeList(d2Array)
+	with open(shapeFile, "wb") as f:
+		pickle.dump(strategy.copyShapeList([s for s in shapeList if s.isBaseCandidate]), f, pickle.HIGHEST_PROTOCOL)
+	return strategy.getLoudestMagnitudes([s for s in shapeList if firstRow <= s.timeIndexStart <= lastRow])
+
+
+# Pass 3 of a tile: consolidates the shapes pass 2 wrote to shapeFile. Returns the TileShapes starting within rows
+# firstRow..lastRow of the tile with its halos, and those starting before that continue into them. rowOffset is the
+# interval of the first row.
+def getTileShapes(strategyArgs, spectrogramFile, startRow, endRow, firstRow, lastRow, rowOffset, shapeFile, loudnessThreshold):
+	strategy, d2Array = loadTileStrategy(strategyArgs, spectrogramFile, startRow, endRow)
+	with open(shapeFile, "rb") as f:
+		shapeList = pickle.load(f)
+	strategy.loudnessThreshold = loudnessThreshold
+	ownShapes = []
+	continuedShapes = []
+	for shape in strategy.consolidateCopiedShapeList(shapeList, d2Array):
+		tileShape = TileShape(shape.timeIndexStart + rowOffset, shape.timeIndexEnd + rowOffset, shape.centerOfMass, shape.magnitude)
+		if firstRow <= shape.timeIndexStart <= lastRow:
+			ownShapes.append(tileShape)
+		elif shape.timeIndexStart < firstRow <= shape.timeIndexEnd:
+			continuedShapes.append(tileShape)
+	return ownShapes, continuedShapes
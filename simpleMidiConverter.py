@@ -1,38 +1,159 @@
 import time
+import collections.abc
+import concurrent.futures
 import copy
+import math
+import numpy
 
-from noteParser import NoteParser
+from activeNote import ActiveNote
+from decimator import Decimator
+from noteParser import NoteList, NoteParser
 from noteProcessors.discreteNoteProcessor.discreteNoteProcessor import DiscreteNoteProcessor
 from midiWriter import MidiWriter
 from wavParser import SimpleWavParser
 
 
 class SimpleMidiConverter:
-	def __init__(self, fileName, fileReader=None, noteParser=None, noteProcessor=None, midiWriter=None, **kwargs):
+	# readMode decides how the file is read:
+	# "full" decodes the whole file into memory before processing.
+	# "memmap" memory maps the file and decodes samples block by block as the note processor slices the waveform.
+	# "stream" reads the file (or a file-like object such as a pipe) sequentially and hands the note processor an
+	# iterator of sample blocks. Processors that can not consume blocks get the blocks joined into one waveform.
+	# cache is an optional ArtifactCache. The decoded waveform and the spectrograms computed by the note processor are
+	# stored in it, so later runs over the same file skip straight to note extraction.
+	# decimate resamples the waveform to the lowest rate that still holds the highest frequency the note processor
+	# reads, see AbstractNoteProcessor.getHighestFrequency, before it is handed to the note processor. For the
+	# continuous processor this follows from its noteRange. highestFrequency overrides it, and is needed for processors
+	# that read the whole spectrum, such as the discrete processor, which are otherwise not decimated.
+	# segmentSeconds splits the waveform into segments of that many seconds, which are transcribed independently by
+	# segmentWorkers processes and stitched back together. Only for note processors that support segments.
+	def __init__(self, fileName, fileReader=None, noteParser=None, noteProcessor=None, midiWriter=None, readMode="full", cache=None,
+			decimate=False, highestFrequency=None, segmentSeconds=None, segmentWorkers=1, **kwargs):
 
 		self.fileName = fileName
+		self.readMode = readMode
 		self.fileReader = fileReader or SimpleWavParser()
 		self.noteParser = noteParser or NoteParser()
 
 		self.midiWriter = midiWriter or MidiWriter(self.noteParser.parseNotes())
 		self.noteProcessor = noteProcessor or DiscreteNoteProcessor
 		self.noteProcessorArgs = kwargs
+		self.cache = cache
+		self.decimate = decimate
+		self.highestFrequency = highestFrequency
+		self.segmentSeconds = segmentSeconds
+		self.segmentWorkers = segmentWorkers
 		self.activeNotes = []
 
 	def getNotes(self):
 		print("Reading file...")
-		t = time.clock()
-		self.waveform, self.sampleRate, _ = self.fileReader.getSingleWaveform(self.fileName)
-		print("%f s" % (time.clock() - t))
+		t = time.perf_counter()
+		# Artifacts are keyed by the file's contents, so a stream that is not a file on disk is never cached.
+		artifacts = None
+		if self.cache is not None and isinstance(self.fileName, str):
+			artifacts = self.cache.getArtifacts(self.fileName)
+
+		if self.readMode == "memmap":
+			self.waveform, self.sampleRate, _ = self.fileReader.getMappedWaveform(self.fileName)
+		elif self.readMode == "stream":
+			self.waveform, self.sampleRate, _ = self.fileReader.getWaveformBlocks(self.fileName)
+		elif artifacts is not None:
+			self.waveform = artifacts.load("waveform")
+			self.sampleRate = self.fileReader.probe(self.fileName).sampleRate
+			if self.waveform is None:
+				self.waveform, self.sampleRate, _ = self.fileReader.getSingleWaveform(self.fileName)
+				artifacts.store("waveform", self.waveform)
+		else:
+			self.waveform, self.sampleRate, _ = self.fileReader.getSingleWaveform(self.fileName)
+
+		decimationFactor = 1
+		highestFrequency = self.highestFrequency
+		if self.decimate and highestFrequency is None:
+			highestFrequency = self.noteProcessor.getHighestFrequency(self.noteParser.parseNotes(), **self.noteProcessorArgs)
+		if self.decimate and highestFrequency is not None:
+			decimationFactor = Decimator.getFactor(self.sampleRate, highestFrequency)
+			if decimationFactor > 1:
+				decimator = Decimator(decimationFactor)
+				if isinstance(self.waveform, collections.abc.Iterator):
+					self.waveform = decimator.decimateBlocks(self.waveform)
+				else:
+					self.waveform = decimator.decimate(self.waveform)
+				self.sampleRate = self.sampleRate / decimationFactor
+		if isinstance(self.waveform, collections.abc.Iterator) and not self.noteProcessor.supportsStreaming:
+			self.waveform = numpy.concatenate(list(self.waveform))
+		print("%f s" % (time.perf_counter() - t))
+
+		if self.segmentSeconds is not None:
+			return self.getSegmentedNotes(decimationFactor)
 
 		# TODO refactor this
-		self.noteProcessor = self.noteProcessor(self.waveform, self.sampleRate, self.noteParser, **self.noteProcessorArgs)
+		self.noteProcessor = self.noteProcessor(self.waveform, self.sampleRate, self.noteParser, artifacts=artifacts,
+			decimationFactor=decimationFactor, **self.noteProcessorArgs)
 		print("Getting notes...")
-		t = time.clock()
+		t = time.perf_counter()
 		notes = self.noteProcessor.run()
-		print("%f s" % (time.clock() - t))
+		print("%f s" % (time.perf_counter() - t))
+		return notes
+
+	# Transcribes the waveform in segments of segmentSeconds. Each segment is extended by the note processor's
+	# segmentOverlap on both sides: before, so the processor has settled by the time the segment starts, and after, so
+	# notes starting near the end of the segment are seen to their end. A segment keeps the notes starting within it, the
+	# first and last segments also keep those starting before and after the waveform. The notes are then those of the
+	# whole waveform, see tests/testSegments.py.
+	# Notes are transcribed without normalised loudness, which is normalised over all segments at the end.
+	def getSegmentedNotes(self, decimationFactor):
+		assert self.noteProcessor.supportsSegments
+		if isinstance(self.waveform, collections.abc.Iterator):
+			self.waveform = numpy.concatenate(list(self.waveform))
+		print("Getting notes...")
+		t = time.perf_counter()
+		noteList = NoteList(self.noteParser.parseNotes())
+		processor = self.noteProcessor(self.waveform, self.sampleRate, self.noteParser, decimationFactor=decimationFactor, **self.noteProcessorArgs)
+		noteProcessorArgs = dict(self.noteProcessorArgs, **processor.getSegmentArgs())
+		# Segments start on the rows of the whole waveform, so a note is found at the same time in every segment
+		alignment = self.noteProcessor.segmentAlignment
+		segmentLength = alignment * max(1, round(self.segmentSeconds * self.sampleRate / alignment))
+		overlap = self.noteProcessor.segmentOverlap
+		segments = []
+		for start in range(0, len(self.waveform), segmentLength):
+			segmentStart = max(0, start - overlap)
+			segments.append((self.noteProcessor, numpy.asarray(self.waveform[segmentStart: start + segmentLength + overlap]), self.sampleRate,
+				noteList, decimationFactor, segmentStart, start / self.sampleRate if start > 0 else -math.inf,
+				(start + segmentLength) / self.sampleRate if start + segmentLength < len(self.waveform) else math.inf, noteProcessorArgs))
+
+		if self.segmentWorkers == 1:
+			segmentNotes = [transcribeSegment(*segment) for segment in segments]
+		else:
+			with concurrent.futures.ProcessPoolExecutor(self.segmentWorkers) as executor:
+				segmentNotes = list(executor.map(transcribeSegment, *zip(*segments)))
+			# Notes come back as copies. The midiWriter looks notes up in the noteParser's list, so they are swapped back.
+			notesByName = dict([(n.name, n) for n in self.noteParser.parseNotes()])
+			for notes in segmentNotes:
+				for activeNote in notes:
+					activeNote.note = notesByName[activeNote.note.name]
+
+		notes = self.noteProcessor.normaliseNotes(self.stitchSegments(segmentNotes))
+		print("%f s" % (time.perf_counter() - t))
+		return notes
+
+	# Joins the notes of consecutive segments. A note is only kept by the segment it starts in, so there is nothing to merge.
+	def stitchSegments(self, segmentNotes):
+		notes = [activeNote for notes in segmentNotes for activeNote in notes]
+		ActiveNote.sortList(notes)
 		return notes
 
 	def run(self):
 		self.activeNotes = self.getNotes()
 		self.midiWriter.writeActiveNotesToFile(self.activeNotes, self.fileName[:self.fileName.index(".")])
+
+
+# Transcribes one segment of a waveform, starting at sample firstSample of the whole waveform, possibly in another
+# process. Returns the notes starting between startTime and endTime, with times relative to the whole waveform.
+def transcribeSegment(noteProcessor, waveform, sampleRate, noteList, decimationFactor, firstSample, startTime, endTime,
+		noteProcessorArgs):
+	processor = noteProcessor(waveform, sampleRate, noteList, decimationFactor=decimationFactor, firstSample=firstSample, **noteProcessorArgs)
+	notes = []
+	for activeNote in processor.generateNotes():
+		if startTime <= activeNote.startTime < endTime:
+			notes.append(activeNote)
+	return notes
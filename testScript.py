@@ -1,12 +1,13 @@
 
+from artifactCache import ArtifactCache
 from simpleMidiConverter import SimpleMidiConverter
 from noteProcessors.discreteNoteProcessor.discreteNoteProcessor import DiscreteNoteProcessor
 from noteProcessors.continuousNoteProcessor.continuousNoteProcessor import ContinuousNoteProcessor
 from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy
 from noteProcessors.discreteNoteProcessor.shapeStrategies import FilterShapeStrategy
 
-smc = SimpleMidiConverter(fileName="audio/Ltheme2Modified.wav", noteProcessor=ContinuousNoteProcessor)
-#smc = SimpleMidiConverter(fileName="audio/Ltheme2Modified.wav", noteProcessor=DiscreteNoteProcessor, shapeStrategy=FilterShapeStrategy)
+smc = SimpleMidiConverter(fileName="audio/Ltheme2Modified.wav", noteProcessor=ContinuousNoteProcessor, cache=ArtifactCache())
+#smc = SimpleMidiConverter(fileName="audio/Ltheme2Modified.wav", noteProcessor=DiscreteNoteProcessor, shapeStrategy=FilterShapeStrategy, cache=ArtifactCache())
 smc.run()
 
 notes = [n for n in smc.activeNotes if n.note.frequency < 1760]
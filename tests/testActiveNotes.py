@@ -2,6 +2,7 @@ import inspect
 import json
 
 from activeNote import ActiveNote
+from artifactCache import ArtifactCache
 from simpleMidiConverter import SimpleMidiConverter
 from noteProcessors.discreteNoteProcessor.discreteNoteProcessor import DiscreteNoteProcessor
 from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy
@@ -90,9 +91,11 @@ def generateNewOutputFile(fileName, newNotes=None, **kwargs):
 		f.write(json.dumps({"notes" : newNotes}, indent=4))
 
 def run():
+	# Spectrograms only depend on the file, so they are reused across runs while shape strategies are tuned.
+	cache = ArtifactCache()
 	for processorArgs in testProcessors:
 		for fileName in testFiles:
-			smc = SimpleMidiConverter(fileName=fileName, **processorArgs)
+			smc = SimpleMidiConverter(fileName=fileName, cache=cache, **processorArgs)
 			newNotes = smc.getNotes()
 			resourceName = truncateFilename(fileName) + argsToString(**processorArgs) + ".json"
 			oldResourceName = "tests/oldTestResources/" + resourceName
@@ -0,0 +1,83 @@
+
+import numpy
+
+from noteParser import NoteParser
+from noteProcessors.continuousNoteProcessor.columnManager import ColumnManager
+from noteProcessors.continuousNoteProcessor.constants import Constants
+from noteProcessors.continuousNoteProcessor.message import Message, MessageType
+from noteProcessors.continuousNoteProcessor import propagation
+from noteProcessors.continuousNoteProcessor.rowGenerators import ContinuousGenerator
+import utils
+from wavParser import SimpleWavParser
+
+# Checks that ColumnProcessorGroup finds the notes of stepping the column processors through each row one at a time, in
+# order, with every processor seeing the propagation, comb filling and note ends of the ones before it.
+# The tuning of each file is fixed, so the same processors look at the same columns throughout.
+
+testFiles = [("audio/Ltheme2Modified.wav", 1.0013)]
+samplesPerInterval = 512
+intervalsPerFrame = 128
+
+# Steps one processor through the newest row of its manager's buffer.
+def stepProcessor(columnProcessor):
+	manager = columnProcessor.manager
+	buffer = manager.buffer
+	columnProcessor.peakIndex -= 1
+	if columnProcessor.peakIndex - columnProcessor.preNoteOffset - 2 < 0:
+		columnProcessor.resetPeak()
+		columnProcessor.peakIndex -= 1
+	columns = numpy.arange(columnProcessor.firstIndex, columnProcessor.lastIndex + 1)
+	changedColumns, depths = propagation.propagateUpNegativeRow(buffer.array, buffer.getPosition(numpy.arange(Constants.MAX_BUFFER_SIZE)), columns)
+	manager.invalidateColumns(changedColumns, Constants.MAX_BUFFER_SIZE - 1 - depths)
+	columnProcessor.processingIndex = int(Constants.MAX_BUFFER_SIZE / 2)
+	columnProcessor.fillComb()
+	manager.invalidateColumns(columns, columnProcessor.processingIndex)
+
+	initialSum = sum(buffer[columnProcessor.processingIndex][columns])
+	referenceSum = sum(buffer[columnProcessor.processingIndex - 2][columns])
+	if columnProcessor.peakIndex < 0:
+		if columnProcessor.checkPeak(initialSum, referenceSum):
+			columnProcessor.preNoteValue = referenceSum
+			columnProcessor.peakIndex = columnProcessor.processingIndex
+			columnProcessor.peakValue = initialSum
+			columnProcessor.maxValue = initialSum
+		return Message(MessageType.NO_EVENT)
+	if initialSum > columnProcessor.maxValue:
+		columnProcessor.maxValue = initialSum
+	if initialSum > columnProcessor.peakValue and utils.percentDiff(initialSum, columnProcessor.peakValue) > 2:
+		if columnProcessor.checkPeak(initialSum, referenceSum):
+			indexFromLastPeak = columnProcessor.processingIndex - columnProcessor.peakIndex
+			if indexFromLastPeak <= 2:
+				columnProcessor.preNoteOffset += indexFromLastPeak
+			else:
+				columnProcessor.preNoteValue = referenceSum
+			columnProcessor.peakIndex = columnProcessor.processingIndex
+			columnProcessor.peakValue = initialSum
+	cutOff = columnProcessor.maxValue / 10 + 9 * columnProcessor.preNoteValue / 10
+	if initialSum < cutOff or utils.percentDiff(initialSum, cutOff) < 0.2:
+		return columnProcessor.processNoteEnd()
+	return Message(MessageType.NO_EVENT)
+
+def stepInTurn(columnProcessors):
+	messages = [stepProcessor(columnProcessor) for columnProcessor in columnProcessors]
+	return [message for message in messages if message.messageType != MessageType.NO_EVENT]
+
+def getNotes(manager):
+	return [(n.note.name, n.startTime, n.endTime, n.loudness) for n in manager.activeNotes]
+
+def testInTurn():
+	for fileName, outOfTune in testFiles:
+		waveform, sampleRate, _ = SimpleWavParser().getSingleWaveform(fileName)
+		managers = [ColumnManager(outOfTune, NoteParser(), sampleRate, samplesPerInterval * intervalsPerFrame, samplesPerInterval) for i in range(2)]
+		columnProcessors = managers[1].columnProcessors
+		managers[1].columnProcessorGroup.processNewDataRow = lambda: stepInTurn(columnProcessors)
+		for row in ContinuousGenerator(samplesPerInterval, intervalsPerFrame, waveform).generate():
+			for manager in managers:
+				manager.processNewDataRow(row)
+		notes, expectedNotes = getNotes(managers[0]), getNotes(managers[1])
+		assert len(notes) > 0
+		assert [n[:3] for n in notes] == [n[:3] for n in expectedNotes], "%s gives different notes" % fileName
+		assert numpy.allclose([n[3] for n in notes], [n[3] for n in expectedNotes], rtol=1e-9, atol=0)
+
+def run():
+	testInTurn()
@@ -0,0 +1,71 @@
+
+import numpy
+
+from decimator import Decimator
+
+# Checks that decimating a waveform block by block gives the filtered samples computed one at a time, and the same
+# samples however the waveform is split into blocks.
+
+factors = [2, 4]
+waveformLengths = [1, 5, 333, 1000]
+
+# Output sample j is the filtered input sample j * factor, with the samples before and after the waveform taken as 0.
+# The taps are centred on the input sample.
+def decimateSamples(decimator, waveform):
+	center = (len(decimator.taps) - 1) // 2
+	decimated = []
+	for j in range(0, len(waveform), decimator.factor):
+		total = 0
+		for k in range(len(decimator.taps)):
+			index = j + center - k
+			if 0 <= index < len(waveform):
+				total += decimator.taps[k] * waveform[index]
+		decimated.append(total)
+	return numpy.array(decimated)
+
+def getBlocks(waveform, random):
+	blocks = []
+	start = 0
+	while start < len(waveform):
+		end = start + random.randint(0, 80)
+		blocks.append(waveform[start: end])
+		start = end
+	return blocks
+
+def testDecimate():
+	random = numpy.random.RandomState(0)
+	for factor in factors:
+		decimator = Decimator(factor)
+		for length in waveformLengths:
+			waveform = random.randint(-2 ** 15, 2 ** 15, size=length).astype(numpy.float64)
+			decimated = decimator.decimate(waveform, samplesPerBlock=100)
+			expected = decimateSamples(decimator, waveform)
+			assert len(decimated) == len(expected)
+			assert numpy.allclose(decimated, expected, rtol=0, atol=1e-9 * 2 ** 15)
+			# The filter sees the same samples whatever the blocks, empty ones included
+			for i in range(3):
+				blocks = getBlocks(waveform, random)
+				assert list(numpy.concatenate([numpy.zeros(0)] + list(decimator.decimateBlocks(blocks)))) == list(decimated)
+
+# The filter keeps frequencies up to the passband and has unity gain at 0 Hz
+def testFilter():
+	for factor in factors:
+		decimator = Decimator(factor)
+		assert abs(decimator.taps.sum() - 1) < 1e-12
+		assert list(decimator.taps) == list(decimator.taps[::-1])
+		response = numpy.abs(numpy.fft.rfft(decimator.taps, 1 << 16))
+		frequencies = numpy.fft.rfftfreq(1 << 16) * factor	# In cycles per decimated sample
+		assert numpy.all(numpy.abs(response[frequencies <= Decimator.PASSBAND] - 1) < 1e-3)
+		assert numpy.all(response[frequencies >= 1 - Decimator.PASSBAND] < 1e-3)
+
+def testFactor():
+	for sampleRate in [8000, 44100, 48000]:
+		for maxFrequency in [100, 1000, 4186, 10000]:
+			factor = Decimator.getFactor(sampleRate, maxFrequency)
+			assert factor == 1 or maxFrequency <= Decimator.PASSBAND * sampleRate / factor
+			assert maxFrequency > Decimator.PASSBAND * sampleRate / (factor * 2)
+
+def run():
+	testDecimate()
+	testFilter()
+	testFactor()
@@ -0,0 +1,106 @@
+
+import itertools
+
+import numpy
+
+import utils
+from noteProcessors.continuousNoteProcessor.columnProcessor import ColumnProcessor
+
+# Checks that the variances from running sums pick the same breaks as the variances of each slice did, and that
+# getJenksBreaks finds the least deviation of all splits.
+
+# Random values, and rows sums of a note: quiet rows, the note fading out, quiet rows again.
+def getArrays(count=50, seed=0):
+	random = numpy.random.RandomState(seed)
+	arrays = []
+	for i in range(count):
+		length = random.randint(1, 40)
+		arrays.append(random.uniform(-10, 10, size=length))
+		preNote = random.randint(1, min(4, length + 1))
+		postNote = random.randint(preNote, length + 1)
+		note = random.uniform(0, 1, size=length)
+		note[preNote: postNote] += numpy.linspace(100, 50, postNote - preNote)
+		arrays.append(note)
+	return arrays
+
+def getSliceVariance(arr, start, end):
+	return utils.getVariance(list(arr[start: end]))
+
+# naturalBreaksOptimize with the variance of each slice
+def naturalBreaksSlices(arr, indices):
+	ranges = list(indices) + [len(arr)]
+	finished = False
+	while not finished:
+		finished = True
+		for i in range(len(indices) - 1):
+			var1 = getSliceVariance(arr, ranges[i], ranges[i + 1])
+			var2 = getSliceVariance(arr, ranges[i + 1], ranges[i + 2])
+			newRange = ranges[i + 1] - 1
+			if var1 < var2:
+				newRange += 2
+			var3 = getSliceVariance(arr, ranges[i], newRange)
+			var4 = getSliceVariance(arr, newRange, ranges[i + 2])
+			if var3 + var4 < var1 + var2:
+				ranges[i + 1] = newRange
+				finished = False
+	return ranges[:-1]
+
+# ColumnProcessor.getNaturalBreaks with the variance of each slice
+def getNaturalBreaksSlices(arr):
+	middleIndex = max(4, int(len(arr) / 2))
+	minVariance = -1
+	preNoteIndex = 0
+	for i in range(0, 3):
+		var1 = getSliceVariance(arr, 0, i + 1)
+		var2 = getSliceVariance(arr, i + 1, middleIndex)
+		if var2 + var1 < minVariance or minVariance < 0:
+			minVariance = var1 + var2
+			preNoteIndex = i + 1
+
+	postNoteIndex = 0
+	minVariance = -1
+	for i in range(preNoteIndex, len(arr) - 1):
+		var1 = getSliceVariance(arr, preNoteIndex, i + 1)
+		var2 = getSliceVariance(arr, i + 1, len(arr))
+		if var2 + var1 < minVariance or minVariance < 0:
+			minVariance = var1 + var2
+			postNoteIndex = i + 1
+	return preNoteIndex, postNoteIndex
+
+def testSliceVariance():
+	for arr in getArrays(10):
+		sliceVariance = utils.SliceVariance(arr)
+		indices = range(-len(arr) - 2, len(arr) + 3)
+		for start in indices:
+			for end in indices:
+				assert numpy.isclose(sliceVariance.getVariance(start, end), getSliceVariance(arr, start, end), rtol=1e-9, atol=1e-9)
+		# Arrays of slices give the variance of each
+		starts = numpy.array(indices)
+		variances = sliceVariance.getVariance(starts, len(arr) // 2)
+		assert numpy.allclose(variances, [getSliceVariance(arr, start, len(arr) // 2) for start in starts], rtol=1e-9, atol=1e-9)
+
+def testNaturalBreaks():
+	for arr in getArrays():
+		assert ColumnProcessor.getNaturalBreaks(None, arr) == getNaturalBreaksSlices(arr)
+		for classCount in range(1, min(4, len(arr)) + 1):
+			indices = [i * len(arr) // classCount for i in range(classCount)]
+			assert utils.naturalBreaksOptimize(arr, indices) == naturalBreaksSlices(arr, indices)
+
+# Total squared deviation of the classes starting at indices
+def getDeviation(arr, indices):
+	ranges = list(indices) + [len(arr)]
+	return sum([getSliceVariance(arr, ranges[i], ranges[i + 1]) * (ranges[i + 1] - ranges[i]) for i in range(len(indices))])
+
+def testJenksBreaks():
+	for arr in getArrays(15):
+		for classCount in range(1, min(4, len(arr)) + 1):
+			indices = utils.getJenksBreaks(arr, classCount)
+			assert indices[0] == 0 and all([indices[i] < indices[i + 1] for i in range(classCount - 1)])
+			assert indices[-1] < len(arr)
+			leastDeviation = min([getDeviation(arr, [0] + list(breaks)) for breaks in itertools.combinations(range(1, len(arr)), classCount - 1)])
+			assert numpy.isclose(getDeviation(arr, indices), leastDeviation, rtol=1e-9, atol=1e-9)
+
+def run():
+	testSliceVariance()
+	testNaturalBreaks()
+	testJenksBreaks()
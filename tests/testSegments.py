@@ -0,0 +1,27 @@
+
+from simpleMidiConverter import SimpleMidiConverter
+from noteProcessors.continuousNoteProcessor.continuousNoteProcessor import ContinuousNoteProcessor
+
+# Checks that transcribing a file in segments gives exactly the notes of transcribing it whole.
+# Segments are short so that every file has segments starting past the overlap of the one before.
+
+testProcessors = [
+	{"noteProcessor": ContinuousNoteProcessor},
+	{"noteProcessor": ContinuousNoteProcessor, "noteRange": (200, 1000), "sparse": True},
+]
+testFiles = ["audio/Ltheme2Modified.wav", "audio/chandalier1.wav"]
+SEGMENT_SECONDS = 4
+
+def getNotes(fileName, **kwargs):
+	notes = SimpleMidiConverter(fileName=fileName, **kwargs).getNotes()
+	return sorted([(n.note.name, n.startTime, n.endTime, n.loudness) for n in notes])
+
+def testSegments():
+	for processorArgs in testProcessors:
+		for fileName in testFiles:
+			notes = getNotes(fileName, **processorArgs)
+			segmentedNotes = getNotes(fileName, segmentSeconds=SEGMENT_SECONDS, **processorArgs)
+			assert segmentedNotes == notes, "Segments of %s give different notes" % fileName
+
+def run():
+	testSegments()
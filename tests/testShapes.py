@@ -0,0 +1,58 @@
+
+import numpy
+
+from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy
+from noteProcessors.discreteNoteProcessor.shapeStrategies import FilterShapeStrategy
+
+# Checks that shapes found from the runs of all local maxima at once (see ShapeRuns) are those getShape walks out one
+# local maximum at a time, on synthetic spectrograms. Rows are time indices, columns frequency indices.
+
+SAMPLE_RATE = 44100
+INTERVALS_PER_SECOND = 86
+strategies = [BaseShapeStrategy, FilterShapeStrategy]
+
+# Noise with notes: ridges decaying down the rows of a column, spilling into the neighbouring columns, with harmonics.
+# Some notes start on top of others or run into each other, which getShape has to walk out.
+def getSpectrogram(rowCount, columnCount, noteCount, random):
+	d2Array = random.uniform(0, 1, size=(rowCount, columnCount))
+	for i in range(noteCount):
+		start = random.randint(0, rowCount - 1)
+		end = min(rowCount, start + random.randint(2, 40))
+		column = random.randint(1, columnCount // 3)
+		loudness = random.uniform(10, 1000)
+		decay = numpy.exp(-random.uniform(0, 0.2) * numpy.arange(end - start)) * random.uniform(0.8, 1.2, size=end - start)
+		for harmonic in range(1, 4):
+			harmonicColumn = column * harmonic
+			if harmonicColumn >= columnCount - 1:
+				break
+			ridge = loudness / harmonic * decay
+			d2Array[start: end, harmonicColumn] += ridge
+			d2Array[start: end, harmonicColumn + 1] += ridge * random.uniform(0.1, 1.3)
+			d2Array[start: end, harmonicColumn - 1] += ridge * random.uniform(0.1, 0.6)
+	return d2Array
+
+def getSpectrograms(count=20, seed=0):
+	random = numpy.random.RandomState(seed)
+	return [getSpectrogram(random.randint(3, 120), random.randint(6, 150), random.randint(0, 40), random) for i in range(count)]
+
+def getShapeProperties(shapeList):
+	return [(shape.timeIndexStart, shape.timeIndexEnd, shape.centerOfMass, shape.magnitude, shape.isBaseCandidate,
+		shape.harmonicCount, [tuple(p) for p in shape.points], [tuple(p) for p in shape.auxiliaryPoints],
+		list(shape.magnitudeByTime)) for shape in shapeList]
+
+# "check" asserts every shape from runs is the walked one
+def testCheck():
+	for d2Array in getSpectrograms():
+		for strategy in strategies:
+			strategy(SAMPLE_RATE, INTERVALS_PER_SECOND, shapeExtraction="check").getUnconsolidatedShapeList(d2Array)
+
+def testShapeList():
+	for d2Array in getSpectrograms(seed=1):
+		for strategy in strategies:
+			walkedShapes = strategy(SAMPLE_RATE, INTERVALS_PER_SECOND, shapeExtraction="walk").getShapeList(d2Array)
+			shapes = strategy(SAMPLE_RATE, INTERVALS_PER_SECOND, shapeExtraction="runs").getShapeList(d2Array)
+			assert getShapeProperties(shapes) == getShapeProperties(walkedShapes)
+
+def run():
+	testCheck()
+	testShapeList()
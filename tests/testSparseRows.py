@@ -0,0 +1,51 @@
+
+import numpy
+
+from simpleMidiConverter import SimpleMidiConverter
+from noteProcessors.continuousNoteProcessor.continuousNoteProcessor import ContinuousNoteProcessor
+from noteProcessors.continuousNoteProcessor.rowGenerators import ContinuousGenerator, SparseGenerator
+
+# Checks that the bins a SparseGenerator computes are the columns of the rows of a ContinuousGenerator, and that sparse
+# rows find the notes of full rows. The tuning is fixed, since sparse rows can not be retuned.
+
+samplesPerInterval = 64
+intervalsPerFrame = 32
+testFiles = [("audio/Ltheme2Modified.wav", 1.0013), ("audio/chandalier1.wav", 1), ("audio/chandalier1.wav", 1.0013)]
+NOTE_RANGE = (200, 1000)
+
+# Tones at and between bins, some high, on noise. A few waveforms are shorter than a frame and give no rows but the
+# trailing zeros.
+def getWaveform(length, random):
+	times = numpy.arange(length)
+	waveform = random.normal(0, 100, size=length)
+	for i in range(5):
+		frequency = random.uniform(0, 0.5)
+		waveform += random.uniform(1000, 10000) * numpy.sin(2 * numpy.pi * frequency * times + random.uniform(0, 2 * numpy.pi))
+	return waveform
+
+def testSparseRows():
+	random = numpy.random.RandomState(0)
+	rowWidth = samplesPerInterval * intervalsPerFrame // 2
+	for length in [100, samplesPerInterval * intervalsPerFrame * 3, 20000]:
+		waveform = getWaveform(length, random)
+		rows = numpy.array(list(ContinuousGenerator(samplesPerInterval, intervalsPerFrame, waveform).generate()))
+		for bins in [[0, 1, 2], sorted(random.choice(rowWidth, 50, replace=False)), [rowWidth - 1, 5, 700]]:
+			sparseRows = numpy.array(list(SparseGenerator(samplesPerInterval, intervalsPerFrame, waveform, bins).generate()))
+			assert sparseRows.shape == (len(rows), len(bins))
+			assert numpy.allclose(sparseRows, rows[:, bins], rtol=0, atol=1e-9 * numpy.abs(rows).max())
+
+def getNotes(fileName, outOfTune, sparse):
+	notes = SimpleMidiConverter(fileName=fileName, noteProcessor=ContinuousNoteProcessor, noteRange=NOTE_RANGE, sparse=sparse, outOfTune=outOfTune).getNotes()
+	return sorted([(n.note.name, n.startTime, n.endTime, n.loudness) for n in notes])
+
+def testSparseNotes():
+	for fileName, outOfTune in testFiles:
+		notes = getNotes(fileName, outOfTune, False)
+		sparseNotes = getNotes(fileName, outOfTune, True)
+		assert len(notes) > 0
+		assert [n[:3] for n in sparseNotes] == [n[:3] for n in notes], "Sparse rows of %s give different notes" % fileName
+		assert numpy.allclose([n[3] for n in sparseNotes], [n[3] for n in notes], rtol=1e-9, atol=0)
+
+def run():
+	testSparseRows()
+	testSparseNotes()
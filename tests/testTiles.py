@@ -0,0 +1,81 @@
+
+import numpy
+
+from noteProcessors.discreteNoteProcessor.baseShapeStrategy import BaseShapeStrategy
+from noteProcessors.discreteNoteProcessor.shapeStrategies import FilterShapeStrategy
+from noteProcessors.discreteNoteProcessor.spectrogram import Spectrogram
+from noteProcessors.discreteNoteProcessor.tiledShapeFinder import TiledShapeFinder
+
+# Checks that the shapes found tile by tile are those of the shape strategy on the spectrogram of the whole waveform,
+# with halos that cover the shapes, and with a halo the shapes run past, which stitchTile has to continue.
+
+SAMPLE_RATE = 8000
+SAMPLES_PER_INTERVAL = 400
+strategies = [BaseShapeStrategy, FilterShapeStrategy]
+
+# Notes of (onset, column, length, loudness), with 3 harmonics, on noise. A note holds each interval and decays from
+# one to the next, so it is a shape of about length intervals from its onset, in the columns of its harmonics.
+def getWaveform(intervalCount, notes, noise, random):
+	times = numpy.arange(SAMPLES_PER_INTERVAL) / SAMPLE_RATE
+	waveform = random.normal(0, noise, size=(intervalCount, SAMPLES_PER_INTERVAL))
+	for onset, column, length, loudness in notes:
+		decay = 2.9 ** (-1 / (length - 1))
+		for i in range(onset, intervalCount):
+			for harmonic in range(1, 4):
+				frequency = column * harmonic * SAMPLE_RATE / SAMPLES_PER_INTERVAL
+				waveform[i] += loudness / harmonic * decay ** (i - onset) * numpy.sin(2 * numpy.pi * frequency * times)
+	return waveform.ravel()
+
+def getRandomNotes(intervalCount, noteCount, random):
+	return [(random.randint(0, intervalCount - 10), random.randint(25, 60), random.randint(3, 40), random.uniform(500, 5000))
+		for i in range(noteCount)]
+
+def getShapeProperties(shapeList):
+	return sorted([(s.timeIndexStart, s.timeIndexEnd, s.centerOfMass, s.magnitude) for s in shapeList])
+
+def getExpectedShapes(strategy, waveform, sampleOffset=0):
+	d2Array = Spectrogram(SAMPLE_RATE, SAMPLES_PER_INTERVAL).compute(waveform, sampleOffset)[0]
+	return getShapeProperties(strategy(SAMPLE_RATE, SAMPLES_PER_INTERVAL).getShapeList(d2Array))
+
+def getTiledShapes(strategy, waveform, tileIntervals, haloIntervals, workers=1, sampleOffset=0):
+	shapeFinder = TiledShapeFinder(strategy, SAMPLE_RATE, SAMPLES_PER_INTERVAL, tileIntervals, haloIntervals, workers)
+	return getShapeProperties(shapeFinder.getShapes(waveform, sampleOffset))
+
+def testTiledShapes():
+	for seed in range(3):
+		random = numpy.random.RandomState(seed)
+		waveform = getWaveform(200, getRandomNotes(200, 30, random), 1, random)
+		for strategy in strategies:
+			expectedShapes = getExpectedShapes(strategy, waveform)
+			assert len(expectedShapes) > 0
+			for tileIntervals, haloIntervals, workers in [(1000, 0, 1), (25, 80, 1), (7, 80, 1), (25, 80, 2)]:
+				assert getTiledShapes(strategy, waveform, tileIntervals, haloIntervals, workers) == expectedShapes, \
+					"%s with tiles %s" % (strategy.__name__, (tileIntervals, haloIntervals, workers))
+
+# Notes starting within the halo before the end of a tile run past the halo after it
+def testStitchedShapes():
+	tileIntervals = 20
+	haloIntervals = 4
+	notes = [(5, 50, 8, 800), (17, 30, 24, 1000), (45, 41, 10, 3000), (58, 27, 20, 2000), (82, 33, 15, 1500)]
+	waveform = getWaveform(100, notes, 0, numpy.random.RandomState(0))
+	for strategy in strategies:
+		expectedShapes = getExpectedShapes(strategy, waveform)
+		stitchedShapes = [(start, end) for start, end, centerOfMass, magnitude in expectedShapes
+			if end > (start // tileIntervals + 1) * tileIntervals - 1 + haloIntervals]
+		assert (17, 39) in stitchedShapes and (58, 76) in stitchedShapes
+		for workers in [1, 2]:
+			assert getTiledShapes(strategy, waveform, tileIntervals, haloIntervals, workers) == expectedShapes, strategy.__name__
+
+# Shapes are found from sampleOffset on, and in waveforms shorter than a tile
+def testOffsets():
+	random = numpy.random.RandomState(3)
+	waveform = getWaveform(60, getRandomNotes(60, 10, random), 1, random)
+	for sampleOffset in [0, 123, SAMPLES_PER_INTERVAL * 5]:
+		expectedShapes = getExpectedShapes(FilterShapeStrategy, waveform, sampleOffset)
+		for tileIntervals, haloIntervals in [(1000, 4), (10, 80)]:
+			assert getTiledShapes(FilterShapeStrategy, waveform, tileIntervals, haloIntervals, sampleOffset=sampleOffset) == expectedShapes
+
+def run():
+	testTiledShapes()
+	testStitchedShapes()
+	testOffsets()
@@ -0,0 +1,172 @@
+
+import os
+import struct
+import tempfile
+
+import numpy
+
+from wavParser import SimpleWavParser
+
+# Checks that the bulk decoding of wav samples gives the same samples as decoding them one at a time, like the parser
+# used to. The reference decodes by the wav spec: 8 bit samples are unsigned, wider ones are two's complement.
+
+SAMPLE_RATE = 8000
+sampleWidths = [1, 2, 3, 4]
+channelCounts = [1, 2, 3]
+
+def decodeSample(sampleBytes):
+	if len(sampleBytes) == 1:
+		return sampleBytes[0] - 128
+	return int.from_bytes(sampleBytes, "little", signed=True)
+
+def encodeSample(value, bytesPerSample):
+	if bytesPerSample == 1:
+		return bytes([value + 128])
+	return value.to_bytes(bytesPerSample, "little", signed=True)
+
+# Samples of each channel, decoded one at a time
+def decodeWaveforms(dataSamples, bytesPerSample, numChannels):
+	dataCount = len(dataSamples) // (bytesPerSample * numChannels)
+	waveforms = [[0 for i in range(dataCount)] for n in range(numChannels)]
+	index = 0
+	for i in range(dataCount):
+		for j in range(numChannels):
+			waveforms[j][i] = decodeSample(dataSamples[index: index + bytesPerSample])
+			index += bytesPerSample
+	return waveforms
+
+# Random samples of the full range of the width, its extremes included
+def getSamples(dataCount, bytesPerSample, numChannels, seed=0):
+	maxInt = 2 ** (bytesPerSample * 8 - 1)
+	samples = numpy.random.RandomState(seed).randint(-maxInt, maxInt, size=(dataCount, numChannels), dtype=numpy.int64)
+	samples[0, 0] = -maxInt
+	samples[-1, -1] = maxInt - 1
+	return samples
+
+def encodeSamples(samples, bytesPerSample):
+	return b"".join([encodeSample(int(value), bytesPerSample) for value in samples.ravel()])
+
+def getChunk(chunkId, data, size=None):
+	chunk = chunkId + struct.pack("<I", len(data) if size is None else size) + data
+	return chunk + b"\x00" * (len(data) % 2)
+
+def getFormatChunk(bytesPerSample, numChannels, extensible=False):
+	blockAlign = bytesPerSample * numChannels
+	if not extensible:
+		return getChunk(b"fmt ", struct.pack("<HHIIHH", 1, numChannels, SAMPLE_RATE, SAMPLE_RATE * blockAlign, blockAlign, bytesPerSample * 8))
+	# Sub format GUID of PCM: the format code followed by the fixed part of the GUID
+	subFormat = struct.pack("<H", 1) + b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+	return getChunk(b"fmt ", struct.pack("<HHIIHHHHI", 0xFFFE, numChannels, SAMPLE_RATE, SAMPLE_RATE * blockAlign, blockAlign,
+		bytesPerSample * 8, 22, bytesPerSample * 8, 0) + subFormat)
+
+# chunks are the chunks of the file after the RIFF header, the data chunk among them
+def writeWav(fileName, chunks):
+	body = b"WAVE" + b"".join(chunks)
+	with open(fileName, "wb") as f:
+		f.write(b"RIFF" + struct.pack("<I", len(body)) + body)
+
+# A pipe: it can not be seeked and returns fewer bytes than asked for.
+class Pipe:
+	def __init__(self, data, readSize=5):
+		self.data = data
+		self.position = 0
+		self.readSize = readSize
+
+	def seekable(self):
+		return False
+
+	def read(self, size=-1):
+		size = self.readSize if size < 0 else min(size, self.readSize)
+		data = self.data[self.position: self.position + size]
+		self.position += len(data)
+		return data
+
+def testDecoding():
+	parser = SimpleWavParser()
+	with tempfile.TemporaryDirectory() as directory:
+		fileName = os.path.join(directory, "test.wav")
+		for bytesPerSample in sampleWidths:
+			for numChannels in channelCounts:
+				dataSamples = encodeSamples(getSamples(101, bytesPerSample, numChannels), bytesPerSample)
+				writeWav(fileName, [getFormatChunk(bytesPerSample, numChannels), getChunk(b"data", dataSamples)])
+				waveforms = decodeWaveforms(dataSamples, bytesPerSample, numChannels)
+
+				rawWaveforms, sampleRate, bitsPerSample = parser.getRawData(fileName)
+				assert (sampleRate, bitsPerSample) == (SAMPLE_RATE, bytesPerSample * 8)
+				assert [list(w) for w in rawWaveforms] == waveforms
+				waveform = parser.getSingleWaveform(fileName)[0]
+				assert list(waveform) == [sum(values) for values in zip(*waveforms)]
+
+def testChunks():
+	parser = SimpleWavParser()
+	with tempfile.TemporaryDirectory() as directory:
+		fileName = os.path.join(directory, "test.wav")
+		for bytesPerSample in sampleWidths:
+			# An odd number of 8 bit mono samples makes the data chunk odd sized as well.
+			dataSamples = encodeSamples(getSamples(51, bytesPerSample, 1), bytesPerSample)
+			writeWav(fileName, [getChunk(b"LIST", b"odd"), getFormatChunk(bytesPerSample, 1, extensible=True),
+				getChunk(b"junk", b"x" * 5), getChunk(b"data", dataSamples), getChunk(b"id3 ", b"tag")])
+
+			info = parser.probe(fileName)
+			assert [chunk.chunkId for chunk in info.chunks] == ["LIST", "fmt ", "junk", "data", "id3 "]
+			assert [chunk.offset for chunk in info.chunks] == [20, 32, 80, 94, 102 + len(dataSamples) + len(dataSamples) % 2]
+			assert (info.dataOffset, info.dataSize, info.duration) == (94, len(dataSamples), 51 / SAMPLE_RATE)
+			assert list(parser.getSingleWaveform(fileName)[0]) == decodeWaveforms(dataSamples, bytesPerSample, 1)[0]
+
+# Writers that stream their output leave the size of the data chunk unknown, the samples then run to the end of the file.
+def testUnknownDataSize():
+	parser = SimpleWavParser()
+	with tempfile.TemporaryDirectory() as directory:
+		fileName = os.path.join(directory, "test.wav")
+		dataSamples = encodeSamples(getSamples(64, 2, 2), 2)
+		waveform = [sum(values) for values in zip(*decodeWaveforms(dataSamples, 2, 2))]
+		for size in [0, 0xFFFFFFFF]:
+			writeWav(fileName, [getFormatChunk(2, 2), getChunk(b"data", dataSamples, size)])
+			assert parser.probe(fileName).dataSize == len(dataSamples)
+			assert list(parser.getSingleWaveform(fileName)[0]) == waveform
+			with open(fileName, "rb") as f:
+				blocks = parser.getWaveformBlocks(Pipe(f.read()), samplesPerBlock=7)[0]
+				assert list(numpy.concatenate(list(blocks))) == waveform
+
+def testMappedWaveform():
+	parser = SimpleWavParser()
+	with tempfile.TemporaryDirectory() as directory:
+		fileName = os.path.join(directory, "test.wav")
+		for bytesPerSample in sampleWidths:
+			dataSamples = encodeSamples(getSamples(200, bytesPerSample, 2), bytesPerSample)
+			writeWav(fileName, [getChunk(b"LIST", b"odd"), getFormatChunk(bytesPerSample, 2), getChunk(b"data", dataSamples)])
+			waveform = parser.getSingleWaveform(fileName)[0]
+
+			mappedWaveform, sampleRate, bitsPerSample = parser.getMappedWaveform(fileName)
+			assert (len(mappedWaveform), sampleRate, bitsPerSample) == (len(waveform), SAMPLE_RATE, bytesPerSample * 8)
+			for key in [slice(None), slice(0, 1), slice(13, 77), slice(150, 400), slice(-20, None), slice(5, 5)]:
+				assert mappedWaveform[key].dtype == numpy.float64
+				assert list(mappedWaveform[key]) == list(waveform[key])
+			del mappedWaveform
+
+def testWaveformBlocks():
+	parser = SimpleWavParser()
+	with tempfile.TemporaryDirectory() as directory:
+		fileName = os.path.join(directory, "test.wav")
+		for bytesPerSample in sampleWidths:
+			dataSamples = encodeSamples(getSamples(200, bytesPerSample, 2), bytesPerSample)
+			writeWav(fileName, [getChunk(b"LIST", b"odd"), getFormatChunk(bytesPerSample, 2, extensible=True),
+				getChunk(b"data", dataSamples), getChunk(b"id3 ", b"tag")])
+			waveform = list(parser.getSingleWaveform(fileName)[0])
+
+			for samplesPerBlock in [1, 7, 64, 1000]:
+				blocks, sampleRate, bitsPerSample = parser.getWaveformBlocks(fileName, samplesPerBlock=samplesPerBlock)
+				assert (sampleRate, bitsPerSample) == (SAMPLE_RATE, bytesPerSample * 8)
+				blocks = list(blocks)
+				assert all([len(block) <= samplesPerBlock for block in blocks])
+				assert list(numpy.concatenate(blocks)) == waveform
+				with open(fileName, "rb") as f:
+					blocks = parser.getWaveformBlocks(Pipe(f.read()), samplesPerBlock=samplesPerBlock)[0]
+					assert list(numpy.concatenate(list(blocks))) == waveform
+
+def run():
+	testDecoding()
+	testChunks()
+	testUnknownDataSize()
+	testMappedWaveform()
+	testWaveformBlocks()
@@ -1,4 +1,5 @@
 import copy
+import numpy
 from matplotlib import pyplot
 from matplotlib.style import context
 
@@ -64,26 +65,89 @@ def getVariance(arr):
 		variance += (a - avg) ** 2
 	return variance / len(arr)
 
+# Variances of slices of an array in constant time each, from running sums and sums of squares.
+# getVariance(start, end) is the same as getVariance(arr[start: end]) for any integer start and end, negative ones included,
+# and for arrays of them.
+class SliceVariance:
+	def __init__(self, arr):
+		values = numpy.asarray(arr, dtype=numpy.float64)
+		# Summing the deviations from the mean keeps the sums of squares from swamping the variances
+		values = values - (values.mean() if len(values) > 0 else 0)
+		self.length = len(values)
+		self.sums = numpy.concatenate(([0], numpy.cumsum(values)))
+		self.squareSums = numpy.concatenate(([0], numpy.cumsum(values ** 2)))
+
+	# Negative indices count from the end, like in slices
+	def getIndex(self, index):
+		index = numpy.asarray(index)
+		return numpy.where(index < 0, index + self.length, index)
+
+	# Sum of squared deviations from the mean of each slice, and the slice lengths
+	def getDeviations(self, start, end):
+		start = numpy.clip(self.getIndex(start), 0, self.length)
+		end = numpy.clip(self.getIndex(end), start, self.length)
+		count = end - start
+		total = self.sums[end] - self.sums[start]
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			deviations = numpy.where(count > 0, self.squareSums[end] - self.squareSums[start] - total * total / count, 0)
+		return numpy.maximum(deviations, 0), count
+
+	def getVariance(self, start, end):
+		deviations, count = self.getDeviations(start, end)
+		return numpy.where(count > 0, deviations / numpy.maximum(count, 1), 0)
+
 # I don't fully understand https://en.wikipedia.org/wiki/Jenks_natural_breaks_optimization
 # Not real Jenks, just some wannabe algo that serves a similar purpose. TBH I dont understand the algorithm and I dont trust using some cryptic port of it.
 # arr is input array
 # Indices is start index of each class/group
+# getJenksBreaks finds the real Jenks breaks instead.
 def naturalBreaksOptimize(arr, indices):
+	sliceVariance = SliceVariance(arr)
 	ranges = copy.deepcopy(indices)
 	ranges.append(len(arr))
 	finished = False
 	while not finished:
 		finished = True
 		for i in range(len(indices) - 1):
-			var1 = getVariance(arr[ranges[i]: ranges[i + 1]])
-			var2 = getVariance(arr[ranges[i + 1]: ranges[i + 2]])
+			var1 = sliceVariance.getVariance(ranges[i], ranges[i + 1])
+			var2 = sliceVariance.getVariance(ranges[i + 1], ranges[i + 2])
 			varSum = var1 + var2
 			newRange = ranges[i + 1] - 1
 			if var1 < var2:
 				 newRange += 2
-			var3 = getVariance(arr[ranges[i]: newRange])
-			var4 = getVariance(arr[newRange: ranges[i + 2]])
+			var3 = sliceVariance.getVariance(ranges[i], newRange)
+			var4 = sliceVariance.getVariance(newRange, ranges[i + 2])
 			if var3 + var4 < varSum:
 				ranges[i + 1] = newRange
 				finished = False
 	return ranges[:-1]
+
+# Jenks natural breaks: splits arr into classCount non empty consecutive classes with the least total squared deviation
+# from the class means. Solved exactly by dynamic programming over the end of the last class.
+# Returns the start index of each class, like naturalBreaksOptimize.
+def getJenksBreaks(arr, classCount):
+	sliceVariance = SliceVariance(arr)
+	length = len(arr)
+	assert 0 < classCount <= length
+	starts = numpy.arange(length + 1)
+	# cost[j] is the least deviation of arr[0: j] split into the classes so far, classStarts[c][j] the start of its last class
+	cost = sliceVariance.getDeviations(0, starts)[0]
+	cost[0] = numpy.inf
+	classStarts = [numpy.zeros(length + 1, dtype=int)]
+	for c in range(1, classCount):
+		newCost = numpy.full(length + 1, numpy.inf)
+		lastStarts = numpy.zeros(length + 1, dtype=int)
+		for end in range(c + 1, length + 1):
+			candidates = cost[c: end] + sliceVariance.getDeviations(starts[c: end], end)[0]
+			best = numpy.argmin(candidates)
+			newCost[end] = candidates[best]
+			lastStarts[end] = best + c
+		cost = newCost
+		classStarts.append(lastStarts)
+
+	indices = [0] * classCount
+	end = length
+	for c in range(classCount - 1, 0, -1):
+		indices[c] = int(classStarts[c][end])
+		end = indices[c]
+	return indices
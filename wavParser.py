@@ -1,114 +1,246 @@
 # Wav specs http://soundfile.sapp.org/doc/WaveFormat/
 
+import os
+import struct
+
+import numpy
+
 # Simple .wav parser that parses the contents of a wav file into memory.
 # TODO: could extend to use Audacity to convert from other formats.
 
 # using pythons wave std library is considered, but it parses samples as a string, possibly adding extra run time.
+# Samples are decoded in bulk with numpy instead of one at a time, so reading is bound by disk speed.
 class SimpleWavParser:
-	# Little Endian	
-	maxInt = [2 ** (i * 8 - 1) for i in range(0, 10)]
-	def getIntFromBytes(self, bytes, byteLength):
-		total = 0
-		for i in range(0, byteLength):
-			total += bytes[i] << (i * 8)
-
-		if total > SimpleWavParser.maxInt[byteLength]:
-			return total - SimpleWavParser.maxInt[byteLength] * 2
+	# numpy dtypes for sample widths that map directly onto a machine type. 24 bit samples are unpacked by hand.
+	# All samples are little endian.
+	sampleDtypes = {1: numpy.dtype('u1'), 2: numpy.dtype('<i2'), 4: numpy.dtype('<i4')}
+
+	# Walks the RIFF chunks of a wav file and returns a WavInfo describing them.
+	# Only the fmt chunk is read, every other chunk is skipped over, so the cost does not depend on the file size.
+	# f must be positioned at the start of the file. With stopAtData, the walk ends at the data chunk and leaves f
+	# at the first sample, which is how files that can not be seeked (pipes) are read.
+	def readInfo(self, f, stopAtData=False):
+		riffHeader = self.readFully(f, 12)
+		assert(riffHeader[0:4] == b'RIFF' and riffHeader[8:12] == b'WAVE')
+
+		info = WavInfo()
+		position = 12
+		while True:
+			chunkHeader = self.readFully(f, 8)
+			if len(chunkHeader) < 8:
+				break
+			chunkId = chunkHeader[0:4].decode('latin-1')
+			chunkSize = struct.unpack('<I', chunkHeader[4:8])[0]
+			position += 8
+			info.chunks.append(WavChunk(chunkId, position, chunkSize))
+
+			bytesRead = 0
+			if chunkId == 'fmt ':
+				self.readFormatChunk(self.readFully(f, chunkSize), info)
+				bytesRead = chunkSize
+			elif chunkId == 'data':
+				info.dataOffset = position
+				info.dataSize = chunkSize
+				# Writers that stream their output do not know the length up front and write 0 or 0xFFFFFFFF.
+				# The samples then run to the end of the file and there is no chunk after them.
+				if stopAtData or chunkSize in (0, 0xFFFFFFFF):
+					if chunkSize in (0, 0xFFFFFFFF):
+						info.dataSize = None
+					break
+			# Chunks are word aligned, odd sized chunks are followed by a pad byte.
+			paddedSize = chunkSize + chunkSize % 2
+			self.skipBytes(f, paddedSize - bytesRead)
+			position += paddedSize
+
+		assert(info.dataOffset is not None)
+		return info
+
+	def readFormatChunk(self, data, info):
+		info.audioFormat, info.numChannels, info.sampleRate, info.byteRate, info.blockAlign, info.bitsPerSample = \
+			struct.unpack('<HHIIHH', data[0:16])
+		# WAVE_FORMAT_EXTENSIBLE keeps the real format code in the first 2 bytes of its sub format GUID.
+		if info.audioFormat == WavInfo.FORMAT_EXTENSIBLE and len(data) >= 40:
+			info.audioFormat = struct.unpack('<H', data[24:26])[0]
+
+	def skipBytes(self, f, size):
+		if size <= 0:
+			return
+		if f.seekable():
+			f.seek(size, 1)
 		else:
-			return total
+			while size > 0:
+				skipped = len(f.read(min(size, 65536)))
+				if skipped == 0:
+					break
+				size -= skipped
+
+	# Returns a WavInfo for the file without touching its sample data.
+	# Fast enough to triage large batches of files by sample rate, channel count, bit depth and duration.
+	def probe(self, filename):
+		with open(filename, 'rb') as f:
+			info = self.readInfo(f)
+		info.clampToFileSize(os.path.getsize(filename))
+		return info
+
+	# Lists every chunk in the file, with the offset of its data.
+	def getChunks(self, filename):
+		return self.probe(filename).chunks
+
+	# Asserts that the samples are something the parser can decode.
+	def checkInfo(self, info):
+		assert(info.audioFormat == WavInfo.FORMAT_PCM)	# 1 for uncompressed
+		assert(info.byteRate == info.sampleRate * info.numChannels * info.bitsPerSample / 8) # Assertion suggested by Wav specs
+
+	# Decodes raw little endian sample bytes (a uint8 array) into a flat int32 array.
+	# 8 bit wav samples are unsigned and are shifted so that silence is 0 like the other widths.
+	def decodeSamples(self, raw, bytesPerSample):
+		if bytesPerSample == 3:
+			# Pad each 3 byte sample with a low zero byte, read it as int32 and shift back down to sign extend.
+			padded = numpy.zeros((raw.size // 3, 4), dtype=numpy.uint8)
+			padded[:, 1:] = raw.reshape(-1, 3)
+			return padded.view('<i4').reshape(-1) >> 8
+		samples = raw.reshape(-1).view(SimpleWavParser.sampleDtypes[bytesPerSample]).astype(numpy.int32)
+		if bytesPerSample == 1:
+			samples -= 128
+		return samples
+
+	# Decodes interleaved sample bytes into an int32 array of shape (dataCount, numChannels).
+	def getSamplesFromBytes(self, dataSamples, bytesPerSample, numChannels):
+		raw = numpy.frombuffer(dataSamples, dtype=numpy.uint8)
+		return self.decodeSamples(raw, bytesPerSample).reshape(-1, numChannels)
+
+	# Reads and decodes every sample in the data chunk.
+	def getSamples(self, filename):
+		with open(filename, 'rb') as f:
+			info = self.readInfo(f, stopAtData=True)
+			self.checkInfo(info)
+			if info.dataSize is None:
+				dataSamples = f.read()
+			else:
+				dataSamples = f.read(info.dataSize)
+		bytesPerFrame = info.bytesPerSample() * info.numChannels
+		# A truncated file may hold less than what the header claims; only decode whole sample frames.
+		dataSamples = dataSamples[:len(dataSamples) - len(dataSamples) % bytesPerFrame]
+
+		return self.getSamplesFromBytes(dataSamples, info.bytesPerSample(), info.numChannels), info.sampleRate, info.bitsPerSample
 
 	# Waveform list elements corresponds to the different channels.
 	# Every amplitude value go from -2^(bitsPerSample-1) to 2 ^ (bitsPerSample-1)
 	def getRawData(self, filename):
-		data = []
-		with open(filename, 'rb') as f:
-			data = f.read(44)	# Wav file metadata length. Should remain this till the end of time.
-
-		chunkSize = self.getIntFromBytes(data[4:8], 4)	# We might not need this.
-		audioFormat = self.getIntFromBytes(data[20:21], 1)
-		numChannels = self.getIntFromBytes(data[22:23], 1)
-		sampleRate = self.getIntFromBytes(data[24:28], 4)
-		byteRate = self.getIntFromBytes(data[28:32], 4)
-		blockAlign = self.getIntFromBytes(data[32:34], 2)	# We might not need this.
-		bitsPerSample = self.getIntFromBytes(data[34:35], 1)
-		dataSize = self.getIntFromBytes(data[40:44], 4)
-
-		# print "chunkSize %s" % chunkSize
-		# print "audioFormat %s" % audioFormat
-		# print "numChannels %s" % numChannels
-		# print "sampleRate %s" % sampleRate
-		# print "byteRate %s" % byteRate
-		# print "blockAlign %s" % blockAlign
-		# print "bitsPerSample %s" % bitsPerSample
-		# print "dataSize %s" % dataSize
-
-		assert(audioFormat == 1)	# 1 for uncompressed
-		assert(byteRate == sampleRate * numChannels * bitsPerSample / 8) # Assertion suggested by Wav specs
-
+		samples, sampleRate, bitsPerSample = self.getSamples(filename)
 		# One waveform for each channel.
-		bytesPerSample = bitsPerSample // 8
-		dataCount = (dataSize // bytesPerSample) // numChannels
-
-		waveforms = [[0 for i in range(dataCount)] for n in range(numChannels)]
-		dataSamples = []
-
-		with open(filename, 'rb') as f:
-			f.read(44)	# Skip meta data
-			dataSamples = f.read(bytesPerSample * numChannels * dataCount)
-		index = 0
-
-		for i in range(dataCount):
-			for j in range(numChannels):
-				waveHeight = self.getIntFromBytes(dataSamples[index: index + bytesPerSample], bytesPerSample)
-				waveforms[j][i] = waveHeight
-				index += bytesPerSample
-
+		waveforms = samples.T
 		return waveforms, sampleRate, bitsPerSample
 
 	# Takes a lot less space compared to raw data
 	# Returns waveform superpositioned from all channels
 	def getSingleWaveform(self, filename):
-		data = []
-		with open(filename, 'rb') as f:
-			data = f.read(44)	# Wav file metadata length. Should remain this till the end of time.
-
-		chunkSize = self.getIntFromBytes(data[4:8], 4)	# We might not need this.
-		audioFormat = self.getIntFromBytes(data[20:21], 1)
-		numChannels = self.getIntFromBytes(data[22:23], 1)
-		sampleRate = self.getIntFromBytes(data[24:28], 4)
-		byteRate = self.getIntFromBytes(data[28:32], 4)
-		blockAlign = self.getIntFromBytes(data[32:34], 2)	# We might not need this.
-		bitsPerSample = self.getIntFromBytes(data[34:35], 1)
-		dataSize = self.getIntFromBytes(data[40:44], 4)
-
-		# print "chunkSize %s" % chunkSize
-		# print "audioFormat %s" % audioFormat
-		# print "numChannels %s" % numChannels
-		# print "sampleRate %s" % sampleRate
-		# print "byteRate %s" % byteRate
-		# print "blockAlign %s" % blockAlign
-		# print "bitsPerSample %s" % bitsPerSample
-		# print "dataSize %s" % dataSize
-
-		assert(audioFormat == 1)	# 1 for uncompressed
-		assert(byteRate == sampleRate * numChannels * bitsPerSample / 8) # Assertion suggested by Wav specs
-
-		# One waveform for each channel.
-		bytesPerSample = bitsPerSample // 8
-		dataCount = (dataSize // bytesPerSample) // numChannels
-
-		waveform = [0 for i in range(dataCount)]
-		dataSamples = []
-
-		with open(filename, 'rb') as f:
-			f.read(44)	# Skip meta data
-			dataSamples = f.read(bytesPerSample * numChannels * dataCount)
-		index = 0
-
-		for i in range(dataCount):
-			for j in range(numChannels):
-				waveHeight = self.getIntFromBytes(dataSamples[index: index + bytesPerSample], bytesPerSample)
-				waveform[i] += waveHeight
-				index += bytesPerSample
-
+		samples, sampleRate, bitsPerSample = self.getSamples(filename)
+		waveform = samples.sum(axis=1, dtype=numpy.int64)
 		return waveform, sampleRate, bitsPerSample
+
+	# Memory maps the data chunk instead of reading it. Nothing is decoded until the returned waveform is sliced.
+	def getMappedWaveform(self, filename):
+		info = self.probe(filename)
+		self.checkInfo(info)
+		waveform = MappedWaveform(self, filename, info.dataOffset, info.getDataCount(), info.numChannels, info.bytesPerSample())
+		return waveform, info.sampleRate, info.bitsPerSample
+
+	# Reads the file sequentially and yields the superpositioned waveform in blocks of samplesPerBlock float samples.
+	# source is a filename or a binary file-like object (eg. a pipe), which is never seeked.
+	# The header is read up front so sampleRate and bitsPerSample are known before the first block is requested.
+	def getWaveformBlocks(self, source, samplesPerBlock=65536):
+		f = open(source, 'rb') if isinstance(source, str) else source
+		info = self.readInfo(f, stopAtData=True)
+		self.checkInfo(info)
+		blocks = self.generateWaveformBlocks(f, f is not source, info.numChannels, info.bytesPerSample(), info.dataSize, samplesPerBlock)
+		return blocks, info.sampleRate, info.bitsPerSample
+
+	def generateWaveformBlocks(self, f, ownsFile, numChannels, bytesPerSample, dataSize, samplesPerBlock):
+		bytesPerFrame = bytesPerSample * numChannels
+		# A dataSize of None means the length is unknown and the samples run to the end of the stream.
+		bytesLeft = dataSize
+		try:
+			while bytesLeft is None or bytesLeft > 0:
+				readSize = samplesPerBlock * bytesPerFrame
+				if bytesLeft is not None:
+					readSize = min(readSize, bytesLeft)
+				data = self.readFully(f, readSize)
+				data = data[:len(data) - len(data) % bytesPerFrame]
+				if not data:
+					break
+				if bytesLeft is not None:
+					bytesLeft -= len(data)
+				yield self.getSamplesFromBytes(data, bytesPerSample, numChannels).sum(axis=1, dtype=numpy.float64)
+		finally:
+			if ownsFile:
+				f.close()
+
+	# Pipes may return less than asked for, so keep reading until size bytes arrive or the stream ends.
+	def readFully(self, f, size):
+		data = b''
+		while len(data) < size:
+			chunk = f.read(size - len(data))
+			if not chunk:
+				break
+			data += chunk
+		return data
+
+
+# Read only, zero-copy view of the samples of a wav file.
+# Slicing it decodes only the requested block and superpositions its channels into float samples, so it can stand in
+# for the waveform returned by getSingleWaveform while memory use stays independent of file length.
+class MappedWaveform:
+	def __init__(self, parser, filename, dataOffset, dataCount, numChannels, bytesPerSample):
+		self.parser = parser
+		self.numChannels = numChannels
+		self.bytesPerSample = bytesPerSample
+		self.samples = numpy.memmap(filename, dtype=numpy.uint8, mode='r', offset=dataOffset,
+			shape=(dataCount, numChannels * bytesPerSample))
+
+	def __len__(self):
+		return len(self.samples)
+
+	def __getitem__(self, key):
+		block = numpy.ascontiguousarray(self.samples[key])
+		channels = self.parser.decodeSamples(block, self.bytesPerSample).reshape(block.shape[:-1] + (self.numChannels,))
+		return channels.sum(axis=-1, dtype=numpy.float64)
+
+
+# A chunk of a RIFF file. offset is the file offset of the chunk's data, just past its 8 byte header.
+class WavChunk:
+	def __init__(self, chunkId, offset, size):
+		self.chunkId = chunkId
+		self.offset = offset
+		self.size = size
+
+
+# Everything known about a wav file from its headers.
+class WavInfo:
+	FORMAT_PCM = 1
+	FORMAT_EXTENSIBLE = 0xFFFE
+
+	def __init__(self):
+		self.audioFormat = None	# Format code, resolved through the sub format for WAVE_FORMAT_EXTENSIBLE
+		self.numChannels = None
+		self.sampleRate = None
+		self.byteRate = None
+		self.blockAlign = None
+		self.bitsPerSample = None
+		self.dataOffset = None	# File offset of the first sample
+		self.dataSize = None	# Size in bytes of the sample data. None if the length is unknown.
+		self.duration = None	# Length in seconds. Only known once the size of the data is known.
+		self.chunks = []	# Every chunk found, in file order
+
+	def bytesPerSample(self):
+		return self.bitsPerSample // 8
+
+	# Number of samples per channel
+	def getDataCount(self):
+		return self.dataSize // (self.bytesPerSample() * self.numChannels)
+
+	# The data chunk can not extend past the end of the file, whatever its header says.
+	def clampToFileSize(self, fileSize):
+		if self.dataSize is None or self.dataOffset + self.dataSize > fileSize:
+			self.dataSize = max(0, fileSize - self.dataOffset)
+		self.duration = self.getDataCount() / self.sampleRate